@@ -5,7 +5,17 @@ import sys
 import os
 import datetime
 import shutil
+import time
+import queue
+import threading
 from rag_system import RAGSystem
+from llm_streaming import stream_question
+from answer_cache import AnswerCache, history_fingerprint
+from answer_generator import AnswerGenerator
+from retrieval_system import print_startup_timings
+from index_watcher import IndexWatcher, RetrievalSlot
+from sharded_index import use_configured_retrieval
+import config
 
 
 class NeuroHelpApp:
@@ -56,12 +66,43 @@ class NeuroHelpApp:
             os.makedirs(self.sources_dir)
 
         # Инициализация RAG системы
+        start = time.perf_counter()
         self.rag_system = RAGSystem()
         self.rag_initialized = self.rag_system.initialize_system()
+        # Атрибут RAG-системы с RetrievalSystem (retrieval.rag_attribute в конфиге): через него
+        # кэш и потоковая генерация ищут фрагменты, а наблюдатель подменяет обновлённый индекс
+        self.retrieval_slot = RetrievalSlot(self.rag_system)
+        if self.rag_initialized:
+            if self.retrieval_slot.get() is None:
+                print(f"⚠️ В RAG-системе нет RetrievalSystem в атрибуте {self.retrieval_slot.name}: "
+                      f"кэш ответов, потоковая генерация и фоновое обновление индекса отключены")
+            # Шардированный индекс (retrieval.shards в конфиге) вместо общего
+            use_configured_retrieval(self.retrieval_slot)
+        retrieval_ready = self.rag_initialized and self.retrieval_slot.get() is not None
+        print_startup_timings(self.rag_system, time.perf_counter() - start)
 
         if not self.rag_initialized:
             print("⚠️ RAG система не инициализирована. Будет использоваться простой режим.")
 
+        # Повторные и перефразированные вопросы отвечаются из кэша без поиска и генерации
+        self.answer_cache = AnswerCache.from_config() if retrieval_ready else None
+
+        # Ответ LLM выводится в окно по мере генерации (llm.streaming): на модели, уже загруженной RAG-системой
+        self.answer_generator = None
+        # Одна модель и один PromptCache: ответы генерируются по очереди
+        self.answer_lock = threading.Lock()
+        if retrieval_ready:
+            try:
+                self.answer_generator = AnswerGenerator.from_config(self.rag_system)
+            except Exception as e:
+                print(f"⚠️ Потоковая генерация недоступна, ответы целиком: {e}")
+
+        # Фоновое обновление индекса при изменениях в папке документов
+        self.index_watcher = None
+        if retrieval_ready and config.SYSTEM_CONFIG.get('ingestion', {}).get('watch', True):
+            self.index_watcher = IndexWatcher(self.retrieval_slot, folder=self.sources_dir)
+            self.index_watcher.start()
+
         self.show_login_screen()
 
     def load_chats(self):
@@ -441,36 +482,75 @@ class NeuroHelpApp:
         self.main_app.after(500, lambda: self.bot_response(message))
 
     def bot_response(self, message):
-        try:
-            if hasattr(self, 'rag_system') and self.rag_initialized:
-                # Используем RAG систему
-                response = self.rag_system.process_question(message)
-                answer_text = response[0]  # Берем первый элемент массива - текст ответа
-                context_chunks = response[1]
-                confidence = response[2]
-
-                # Преобразуем confidence в строку с форматированием
-                confidence_str = f"{confidence:.3f}"
+        if not (hasattr(self, 'rag_system') and self.rag_initialized):
+            # Заглушка, если RAG система не работает
+            self.add_message("Это тестовый ответ. RAG система не инициализирована.", "ai")
+            return
 
-                # Формируем полный ответ с уверенностью
-                full_answer = f"{answer_text}\n\n🎯 Степень уверенности: {confidence_str} / 1.0"
+        # Ответ генерируется в фоновом потоке, а окно дописывает его по мере появления токенов
+        answer_label = self.add_message("⏳ Ищу ответ...", "ai", add_to_history=False)
+        updates = queue.Queue()
+        # Кэш отвечает только в том же контексте: реплики чата до текущего вопроса
+        history = [(item['sender'], item['message']) for item in self.get_user_chat()['messages']]
+        if history and history[-1] == ("user", message):
+            history.pop()
+        context = history_fingerprint(history)
+
+        def generate():
+            # Следующий вопрос ждёт, пока допишется предыдущий ответ
+            with self.answer_lock:
+                try:
+                    stream = stream_question(self.rag_system, message, self.answer_cache, self.answer_generator,
+                                             self.retrieval_slot.get(), context)
+                    for delta in stream:
+                        updates.put(('delta', delta))
+                    updates.put(('done', stream))
+                except Exception as e:
+                    updates.put(('error', e))
+
+        threading.Thread(target=generate, name="answer-stream", daemon=True).start()
+        self.main_app.after(50, lambda: self._poll_answer(updates, answer_label, ""))
+
+    def _poll_answer(self, updates, answer_label, text):
+        """Перенос накопившихся фрагментов ответа в сообщение (Tk трогаем только из главного потока)"""
+        finished = None
+        while finished is None:
+            try:
+                kind, value = updates.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'delta':
+                text += value
+            else:
+                finished = kind, value
+
+        if finished is None:
+            if text and answer_label.cget('text') != text:
+                answer_label.config(text=text)
+                self.chat_canvas.update_idletasks()
+                self.chat_canvas.yview_moveto(1.0)
+            self.main_app.after(50, lambda: self._poll_answer(updates, answer_label, text))
+            return
 
-                # Отправляем основной ответ
-                self.add_message(full_answer, "ai")
+        kind, value = finished
+        if kind == 'error':
+            print(f"Ошибка при получении ответа: {value}")
+            answer_label.config(text="Произошла ошибка при обработке запроса")
+            self.save_message("Произошла ошибка при обработке запроса", "ai")
+            return
 
-                # Отправляем отдельное сообщение с документами-гиперссылками
-                if context_chunks:
-                    self.add_documents_message(context_chunks)
-                else:
-                    self.add_message("📚 Использованные документы: не найдены", "ai")
+        stream = value
+        stream.report()
+        # Формируем полный ответ с уверенностью
+        full_answer = f"{stream.text}\n\n🎯 Степень уверенности: {stream.confidence:.3f} / 1.0"
+        answer_label.config(text=full_answer)
+        self.save_message(full_answer, "ai")
 
-            else:
-                # Заглушка, если RAG система не работает
-                self.add_message("Это тестовый ответ. RAG система не инициализирована.", "ai")
-
-        except Exception as e:
-            print(f"Ошибка при получении ответа: {e}")
-            self.add_message("Произошла ошибка при обработке запроса", "ai")
+        # Отправляем отдельное сообщение с документами-гиперссылками
+        if stream.sources:
+            self.add_documents_message(stream.sources)
+        else:
+            self.add_message("📚 Использованные документы: не найдены", "ai")
 
     def add_documents_message(self, context_chunks):
         """Добавление сообщения с документами-гиперссылками (с фильтрацией дубликатов)"""
@@ -558,20 +638,22 @@ class NeuroHelpApp:
         unique_docs = {}
 
         for chunk in context_chunks:
-            file_path = chunk.get('source')
-            if not file_path:
-                continue
-
             similarity = chunk.get('similarity', 0)
             # Безопасное преобразование similarity в float
             similarity_float = float(similarity) if hasattr(similarity, 'item') else float(similarity)
 
-            # Если документ уже есть в списке, берем максимальную схожесть
-            if file_path in unique_docs:
-                if similarity_float > unique_docs[file_path]:
+            # Текст почти-дубликатов хранится один раз, остальные документы приходят в also_in
+            paths = [chunk.get('source')] + [ref.get('source') for ref in chunk.get('also_in', [])]
+            for file_path in paths:
+                if not file_path:
+                    continue
+
+                # Если документ уже есть в списке, берем максимальную схожесть
+                if file_path in unique_docs:
+                    if similarity_float > unique_docs[file_path]:
+                        unique_docs[file_path] = similarity_float
+                else:
                     unique_docs[file_path] = similarity_float
-            else:
-                unique_docs[file_path] = similarity_float
 
         # Сортируем по убыванию схожести
         sorted_docs = sorted(unique_docs.items(), key=lambda x: x[1], reverse=True)
@@ -626,20 +708,24 @@ class NeuroHelpApp:
         if not messages:
             self.add_message("Добро пожаловать в NeuroHelp! Я ваш AI-помощник. Чем могу помочь?", "ai")
 
+    def save_message(self, message, sender):
+        """Сохранение сообщения в историю чата пользователя"""
+        user_chat = self.get_user_chat()
+        if 'messages' not in user_chat:
+            user_chat['messages'] = []
+
+        user_chat['messages'].append({
+            'sender': sender,
+            'message': message,
+            'time': datetime.datetime.now().isoformat()
+        })
+        self.save_chats()
+
     def add_message(self, message, sender, add_to_history=True):
-        """Добавление сообщения с премиальным дизайном"""
+        """Добавление сообщения с премиальным дизайном; возвращает Label с текстом,
+        чтобы потоковый ответ мог дописывать его"""
         if add_to_history:
-            # Сохраняем в историю
-            user_chat = self.get_user_chat()
-            if 'messages' not in user_chat:
-                user_chat['messages'] = []
-
-            user_chat['messages'].append({
-                'sender': sender,
-                'message': message,
-                'time': datetime.datetime.now().isoformat()
-            })
-            self.save_chats()
+            self.save_message(message, sender)
 
         # Создаем фрейм для сообщения
         msg_frame = Frame(self.scrollable_frame, bg=self.colors['background'])
@@ -699,7 +785,7 @@ class NeuroHelpApp:
                           bg=message_bg,
                           fg=text_color,
                           relief='flat',
-                          command=lambda: self.copy_text(message))
+                          command=lambda: self.copy_text(msg_label.cget('text')))
         copy_btn.pack(side=RIGHT)
 
         # Автоматическое обновление размера контейнера
@@ -708,6 +794,7 @@ class NeuroHelpApp:
         # Прокрутка вниз
         self.chat_canvas.update_idletasks()
         self.chat_canvas.yview_moveto(1.0)
+        return msg_label
 
     def update_message_container_size(self, container):
         """Автоматическое обновление размера контейнера сообщения"""
@@ -768,6 +855,8 @@ class NeuroHelpApp:
             self.save_chats()
 
             RAGSystem.clear_history(self)
+            if self.answer_generator is not None:
+                self.answer_generator.reset_conversation()
 
             # Очищаем отображение
             for widget in self.scrollable_frame.winfo_children():
@@ -955,7 +1044,10 @@ class NeuroHelpApp:
 
             try:
                 shutil.copy2(file_path, dest_path)
-                messagebox.showinfo("Успех", f"Документ '{filename}' добавлен в библиотеку")
+                if self.index_watcher is not None:
+                    self.index_watcher.notify()
+                messagebox.showinfo("Успех", f"Документ '{filename}' добавлен в библиотеку "
+                                             f"и будет проиндексирован в фоне")
 
                 # Обновляем список документов
                 self.fill_documents_list()
@@ -969,6 +1061,8 @@ class NeuroHelpApp:
             try:
                 file_path = os.path.join(self.sources_dir, filename)
                 os.remove(file_path)
+                if self.index_watcher is not None:
+                    self.index_watcher.notify()
                 messagebox.showinfo("Успех", f"Документ '{filename}' удален")
 
                 # Обновляем список документов
@@ -1123,6 +1217,10 @@ class NeuroHelpApp:
 
     def run(self):
         self.main_app.mainloop()
+        if self.index_watcher is not None:
+            self.index_watcher.stop(timeout=5)
+        if self.answer_cache is not None:
+            self.answer_cache.report()
 
 
 if __name__ == "__main__":
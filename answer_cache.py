@@ -0,0 +1,178 @@
+import time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import config
+from lexical_index import tokenize, query_codes, is_code_query
+
+
+def normalize_question(question):
+    return " ".join(tokenize(question))
+
+
+def question_codes(question):
+    return sorted(set(query_codes(question)))
+
+
+def history_fingerprint(history):
+    """Отпечаток предыдущих реплик разговора; None - вопрос задан первым.
+    Уточнение вида «а что в пункте 3?» означает разное в разных разговорах"""
+    if not history:
+        return None
+    return hashlib.sha1(json.dumps(list(history), ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class AnswerCache:
+    """Кэш ответов RAG-системы по смыслу вопроса. Вопрос кодируется тем же энкодером, что и поиск;
+    если среди сохранённых есть вопрос с косинусом не ниже threshold, ответ, источники и уверенность
+    возвращаются без поиска и генерации. Ответ годится только для того же контекста разговора
+    (history_fingerprint предыдущих реплик): первый вопрос разговора - общий. Вытеснение LRU (max_entries) и по возрасту (ttl секунд).
+    Кэш сбрасывается, как только меняется версия индекса: после пересборки, обновления
+    или подмены RetrievalSystem фоновым наблюдателем."""
+
+    def __init__(self, threshold=0.95, max_entries=512, ttl=24 * 3600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()    # номер записи -> запись (вопрос, эмбеддинг, ответ, ...)
+        self.version = None
+        self._next_key = 0
+        self._matrix = None         # эмбеддинги записей _matrix_keys
+        self._matrix_keys = []
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.saved_s = 0.0
+
+    @classmethod
+    def from_config(cls):
+        cache_config = config.SYSTEM_CONFIG.get('answer_cache', {})
+        if not cache_config.get('enabled', True):
+            return None
+        return cls(cache_config.get('threshold', 0.95), cache_config.get('max_entries', 512),
+                   cache_config.get('ttl_hours', 24) * 3600)
+
+    def lookup(self, retrieval, question, context=None):
+        """(запись или None, эмбеддинг вопроса, версия индекса) - последние два нужны для store.
+        Сначала ищется тот же вопрос с точностью до регистра и пунктуации - без энкодера;
+        похожий по смыслу вопрос подходит, только если в нём те же обозначения документов.
+        context - history_fingerprint разговора: записи из другого контекста не подходят"""
+        start = time.perf_counter()
+        if retrieval is None:
+            return None, None, None
+        version = retrieval.index_version()
+        normalized, codes = normalize_question(question), question_codes(question)
+
+        with self._lock:
+            self._check_version(version)
+            key = next((key for key, entry in self.entries.items()
+                        if entry['normalized'] == normalized and entry['context'] == context), None)
+            if key is not None:
+                entry = self._hit(key, start)
+                print(f"💾 Ответ из кэша (тот же вопрос «{entry['question']}»)")
+                return entry, entry['embedding'], version
+            if is_code_query(question):
+                # Вопрос из одних обозначений ищется лексически: энкодер ради кэша не загружаем
+                self.misses += 1
+                return None, None, version
+
+        embedding = retrieval.encode_queries([question])[0]
+        with self._lock:
+            self._check_version(version)
+            if self._matrix is None:
+                self._matrix_keys = [key for key, entry in self.entries.items() if entry['embedding'] is not None]
+                self._matrix = np.array([self.entries[key]['embedding'] for key in self._matrix_keys])
+            if self._matrix_keys:
+                # РБ-089-14 и РБ-089-15 для энкодера почти одно и то же, а ответы у них разные
+                same_codes = np.array([self.entries[key]['codes'] == codes and self.entries[key]['context'] == context
+                                       for key in self._matrix_keys])
+                scores = np.where(same_codes, self._matrix @ embedding, -np.inf)
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    entry = self._hit(self._matrix_keys[best], start)
+                    print(f"💾 Ответ из кэша (сходство {scores[best]:.3f} с «{entry['question']}»)")
+                    return entry, embedding, version
+            self.misses += 1
+        return None, embedding, version
+
+    def store(self, question, embedding, version, answer, sources, confidence, seconds, context=None):
+        """embedding None - вопрос из одних обозначений: он находится только точным совпадением"""
+        if not answer.strip():
+            return
+        with self._lock:
+            if version != self.version:
+                return      # индекс сменился, пока шла генерация
+            self.entries[self._next_key] = {
+                'question': question,
+                'normalized': normalize_question(question),
+                'codes': question_codes(question),
+                'context': context,
+                'embedding': embedding,
+                'answer': answer,
+                'sources': [dict(chunk) for chunk in sources],
+                'confidence': confidence,
+                'seconds': seconds,
+                'created': time.time(),
+            }
+            self._next_key += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self._matrix = None
+
+    def process_question(self, rag_system, retrieval, question, context=None):
+        """process_question RAG-системы через кэш; retrieval - её текущий RetrievalSystem"""
+        start = time.perf_counter()
+        entry, embedding, version = self.lookup(retrieval, question, context)
+        if entry is not None:
+            return entry['answer'], entry['sources'], entry['confidence']
+        answer, sources, confidence = rag_system.process_question(question)
+        self.store(question, embedding, version, answer, sources, confidence, time.perf_counter() - start, context)
+        return answer, sources, confidence
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'saved_s': round(self.saved_s, 2),
+            'entries': len(self.entries),
+        }
+
+    def report(self):
+        stats = self.stats()
+        print(f"💾 Кэш ответов: попаданий {stats['hits']} из {stats['hits'] + stats['misses']} "
+              f"({stats['hit_rate']:.0%}), сэкономлено {stats['saved_s']:.1f} с, записей {stats['entries']}")
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self.entries:
+                print("♻️ Индекс изменился, кэш ответов сброшен")
+            self._clear()
+            self.version = version
+        self._expire()
+
+    def _hit(self, key, start):
+        entry = self.entries[key]
+        self.entries.move_to_end(key)
+        self._matrix = None
+        self.hits += 1
+        self.saved_s += max(entry['seconds'] - (time.perf_counter() - start), 0.0)
+        return entry
+
+    def _expire(self):
+        if not self.ttl:
+            return
+        deadline = time.time() - self.ttl
+        expired = [key for key, entry in self.entries.items() if entry['created'] < deadline]
+        for key in expired:
+            del self.entries[key]
+        if expired:
+            self._matrix = None
+
+    def _clear(self):
+        self.entries.clear()
+        self._matrix = None
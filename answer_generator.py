@@ -0,0 +1,82 @@
+import os
+import config
+from llm_streaming import AnswerStream, generate_stream
+
+SYSTEM_PROMPT = ("Ты - помощник по нормативным документам. Отвечай на русском языке только по приведённым "
+                 "фрагментам документов, указывай обозначения документов. Если во фрагментах нет ответа, "
+                 "так и скажи.")
+NO_CONTEXT_ANSWER = "В загруженных документах не найдено информации по этому вопросу."
+
+
+class AnswerGenerator:
+    """Потоковый ответ LLM по найденным чанкам: поиск идёт через RetrievalSystem RAG-системы
+    (в том числе подменённую фоновым наблюдателем), текст выдаётся по мере генерации через generate_stream."""
+
+    def __init__(self, model, tokenizer, system_prompt=SYSTEM_PROMPT, max_new_tokens=512, timeout=None,
+                 prompt_cache=None, context_builder=None, format_prompt=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.system_prompt = system_prompt
+        # format_prompt(question, chunks) LocalLLM: тот же промпт (системный промпт, история), что и без потока
+        self.format_prompt = format_prompt
+        self.max_new_tokens = max_new_tokens
+        self.timeout = timeout
+        # prompt_cache.PromptCache, прогретый на system_prompt: prefill системного промпта не повторяется
+        self.prompt_cache = prompt_cache
+        # context_builder.ContextBuilder: контекст без перекрытий соседних чанков и в пределах бюджета токенов
+        self.context_builder = context_builder
+
+    @classmethod
+    def from_config(cls, rag_system):
+        """Генератор поверх LocalLLM, уже загруженной RAG-системой: вторая копия модели не загружается.
+        None, пока потоковая генерация не включена в конфиге (llm.streaming)"""
+        from prompt_cache import PromptCache
+        from context_builder import ContextBuilder
+
+        llm_config = config.SYSTEM_CONFIG.get('llm', {})
+        if not llm_config.get('streaming', False):
+            return None
+        llm = rag_system.llm
+        model, tokenizer = llm.model, llm.tokenizer
+        system_prompt = getattr(llm, 'system_prompt', None) or llm_config.get('system_prompt', SYSTEM_PROMPT)
+        return cls(model, tokenizer, system_prompt, llm_config.get('max_new_tokens', 512),
+                   llm_config.get('stream_timeout'), PromptCache.from_config(model, tokenizer, system_prompt),
+                   ContextBuilder.from_config(tokenizer), getattr(llm, 'format_prompt', None))
+
+    def reset_conversation(self):
+        if self.prompt_cache is not None:
+            self.prompt_cache.reset_conversation()
+
+    def build_context(self, chunks):
+        if self.context_builder is not None:
+            context, _ = self.context_builder.build(chunks)
+            self.context_builder.report()
+            return context
+        return "\n\n".join(f"[{os.path.basename(chunk['source'])}, стр. {chunk['page'] or 1}]\n{chunk['text']}"
+                           for chunk in chunks)
+
+    def build_prompt(self, question, chunks):
+        if self.format_prompt is not None:
+            if self.context_builder is not None:
+                # Склеенные без перекрытий блоки в пределах бюджета вместо исходных чанков
+                _, chunks = self.context_builder.build(chunks)
+                self.context_builder.report()
+            return self.format_prompt(question, chunks)
+        # Системный промпт всегда в начале: это неизменная часть промпта между вопросами
+        return (f"{self.system_prompt}\n\nФрагменты документов:\n{self.build_context(chunks)}\n\n"
+                f"Вопрос: {question}\nОтвет:")
+
+    def stream(self, retrieval, question):
+        """AnswerStream для stream_question: источники и уверенность известны сразу после поиска"""
+        if retrieval is None:
+            raise RuntimeError("В RAG-системе нет RetrievalSystem")
+        chunks = retrieval.search(question)
+        stream = AnswerStream(sources=chunks, confidence=retrieval.calculate_confidence(question, chunks))
+        if not chunks:
+            stream.deltas = iter([NO_CONTEXT_ANSWER])
+            return stream
+        stream.deltas = generate_stream(self.model, self.tokenizer, self.build_prompt(question, chunks),
+                                        timeout=self.timeout, prompt_cache=self.prompt_cache,
+                                        max_new_tokens=self.max_new_tokens,
+                                        do_sample=False, pad_token_id=self.tokenizer.eos_token_id)
+        return stream
@@ -0,0 +1,165 @@
+import os
+import config
+from ingestion import SENTENCE_END_RE
+
+
+def overlap_length(left, right, min_overlap=20, max_overlap=600):
+    """Длина конца left, с которого начинается right (перекрытие соседних чанков); 0 - не соседи"""
+    if len(right) < min_overlap:
+        return 0
+    anchor = right[:min_overlap]
+    pos = left.find(anchor, max(0, len(left) - max_overlap))
+    while pos != -1:
+        # Первое совпадение слева - самое длинное перекрытие
+        if right.startswith(left[pos:]):
+            return len(left) - pos
+        pos = left.find(anchor, pos + 1)
+    return 0
+
+
+def merge_adjacent(chunks, min_overlap=20, max_overlap=600):
+    """Склейка чанков одной страницы, идущих в тексте подряд, без повтора перекрытия;
+    чанк, целиком вошедший в другой, отбрасывается. Возвращает блоки и число убранных символов"""
+    blocks = [{'text': chunk['text'], 'source': chunk.get('source', ''), 'page': chunk.get('page'),
+               'similarity': chunk.get('similarity', 0.0), 'chunks': [chunk]} for chunk in chunks]
+    removed = 0
+
+    def join(i, j):
+        a, b = blocks[i], blocks[j]
+        if b['text'] in a['text']:
+            return a['text']
+        if a['text'] in b['text']:
+            return b['text']
+        k = overlap_length(a['text'], b['text'], min_overlap, max_overlap)
+        if k:
+            return a['text'] + b['text'][k:]
+        k = overlap_length(b['text'], a['text'], min_overlap, max_overlap)
+        if k:
+            return b['text'] + a['text'][k:]
+        return None
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(blocks)):
+            for j in range(i + 1, len(blocks)):
+                if (blocks[i]['source'], blocks[i]['page']) != (blocks[j]['source'], blocks[j]['page']):
+                    continue
+                text = join(i, j)
+                if text is None:
+                    continue
+                removed += len(blocks[i]['text']) + len(blocks[j]['text']) - len(text)
+                blocks[i] = dict(blocks[i], text=text,
+                                 similarity=max(blocks[i]['similarity'], blocks[j]['similarity']),
+                                 chunks=blocks[i]['chunks'] + blocks[j]['chunks'])
+                del blocks[j]
+                merged = True
+                break
+            if merged:
+                break
+    return blocks, removed
+
+
+class ContextBuilder:
+    """Сборка контекста для промпта LLM: соседние чанки страницы склеиваются без перекрытия,
+    блоки берутся по убыванию сходства, пока помещаются в бюджет токенов токенизатора LLM;
+    последний неполностью влезающий блок обрезается по концу предложения."""
+
+    def __init__(self, tokenizer, max_tokens=1536, template="[{name}, стр. {page}]\n{text}", separator="\n\n",
+                 min_tail_tokens=48):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.template = template
+        self.separator = separator
+        self.min_tail_tokens = min_tail_tokens
+        self.last = {}
+
+    @classmethod
+    def from_config(cls, tokenizer):
+        llm_config = config.SYSTEM_CONFIG.get('llm', {})
+        return cls(tokenizer, llm_config.get('context_tokens', 1536))
+
+    def count(self, texts):
+        return [len(ids) for ids in self.tokenizer(list(texts), add_special_tokens=False)['input_ids']]
+
+    def format(self, block, text=None):
+        return self.template.format(name=os.path.basename(block['source']), page=block['page'] or 1,
+                                    text=block['text'] if text is None else text)
+
+    def build(self, chunks):
+        """(контекст, использованные блоки); у блока 'chunks' - вошедшие в него чанки поиска"""
+        chunks = list(chunks)
+        if not chunks:
+            self.last = {}
+            return "", []
+        naive = self.count([self.separator.join(self.format(chunk) for chunk in chunks)])[0]
+
+        blocks, removed_chars = merge_adjacent(chunks)
+        blocks.sort(key=lambda block: block['similarity'], reverse=True)
+        formatted = [self.format(block) for block in blocks]
+        lengths = self.count(formatted)
+        separator_tokens = self.count([self.separator])[0]
+
+        parts, used, total = [], [], 0
+        for block, text, length in zip(blocks, formatted, lengths):
+            extra = separator_tokens if parts else 0
+            if total + extra + length > self.max_tokens:
+                remaining = self.max_tokens - total - extra
+                if remaining < self.min_tail_tokens:
+                    continue
+                # Заголовок блока остаётся целым, режется только текст
+                header = self.count([self.format(block, "")])[0]
+                text = self.format(block, self.truncate(block['text'], remaining - header))
+                length = self.count([text])[0]
+                if total + extra + length > self.max_tokens:
+                    continue
+            parts.append(text)
+            used.append(block)
+            total += extra + length
+
+        context = self.separator.join(parts)
+        tokens = self.count([context])[0]
+        if tokens > self.max_tokens:
+            # На стыках частей токенизация может немного отличаться от суммы длин частей
+            context = self.truncate(context, self.max_tokens)
+            tokens = self.count([context])[0]
+
+        self.last = {
+            'chunks': len(chunks),
+            'blocks': len(used),
+            'merged': len(chunks) - len(blocks),
+            'dropped': len(blocks) - len(used),
+            'overlap_chars': removed_chars,
+            'naive_tokens': naive,
+            'context_tokens': tokens,
+            'saved_tokens': naive - tokens,
+        }
+        return context, used
+
+    def truncate(self, text, max_tokens):
+        """Начало text не длиннее max_tokens токенов, по возможности до конца предложения"""
+        if max_tokens <= 0:
+            return ""
+        try:
+            encoding = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        except NotImplementedError:
+            # У медленных токенизаторов нет offset_mapping
+            ids = self.tokenizer(text, add_special_tokens=False)['input_ids']
+            return text if len(ids) <= max_tokens else \
+                self.tokenizer.decode(ids[:max_tokens], skip_special_tokens=True)
+        if len(encoding['input_ids']) <= max_tokens:
+            return text
+        cut = text[:encoding['offset_mapping'][max_tokens - 1][1]]
+        ends = [match.end() for match in SENTENCE_END_RE.finditer(cut)]
+        if ends and ends[-1] > len(cut) // 2:
+            cut = cut[:ends[-1]]
+        return cut.rstrip()
+
+    def report(self):
+        stats = self.last
+        if not stats:
+            return
+        share = stats['saved_tokens'] / stats['naive_tokens'] if stats['naive_tokens'] else 0.0
+        print(f"✂️ Контекст: {stats['context_tokens']} токенов вместо {stats['naive_tokens']} "
+              f"(-{share:.0%}): склеено {stats['merged']}, отброшено {stats['dropped']}, "
+              f"перекрытий {stats['overlap_chars']} символов")
@@ -0,0 +1,115 @@
+import os
+import re
+import zlib
+import numpy as np
+from metadata_store import chunk_id
+
+SIGNATURES_FILE = "dedup_signatures.npz"
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+WORD_RE = re.compile(r'\w+')
+
+
+class NearDuplicateFilter:
+    """Поиск почти одинаковых чанков через MinHash + LSH. Из группы похожих чанков в индекс
+    попадает первый, остальные запоминаются как дополнительные ссылки на него."""
+
+    def __init__(self, threshold=0.85, num_perm=64, bands=16, shingle_size=3, seed=1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm={num_perm} должно делиться на bands={bands}")
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 1 << 32, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 32, num_perm, dtype=np.uint64)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+        self.ids = []           # id представителей
+        self.signatures = []
+        self.buckets = {}       # (полоса, значения полосы) -> номера представителей
+        self.references = {}    # id представителя -> [{'id', 'source', 'page'}] его дубликатов
+
+        self.seen = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+
+    def signature(self, text):
+        words = WORD_RE.findall(text.lower())
+        if not words:
+            return None
+        hashes = np.array([zlib.crc32(word.encode('utf-8')) for word in words], dtype=np.uint64)
+        # Хэш шингла - полиномиальная свёртка хэшей соседних слов, без склейки строк
+        shingles = hashes[:len(hashes) - self.shingle_size + 1] if len(hashes) >= self.shingle_size else hashes[:1]
+        for offset in range(1, min(self.shingle_size, len(hashes))):
+            shingles = (shingles * np.uint64(1000003) + hashes[offset:offset + len(shingles)]) & np.uint64(0xFFFFFFFF)
+        values = (self.a[:, None] * shingles[None, :]) % MERSENNE_PRIME
+        return ((values + self.b[:, None]) % MERSENNE_PRIME).min(axis=1)
+
+    def filter(self, chunks):
+        """Поток чанков без почти-дубликатов уже пропущенных (или загруженных через load) чанков"""
+        for chunk in chunks:
+            cid = chunk_id(chunk)
+            signature = self.signature(chunk['text'])
+            self.seen += 1
+            if signature is None:
+                yield chunk
+                continue
+
+            rep = self._find(signature)
+            if rep is None:
+                self._add(cid, signature)
+                yield chunk
+            elif self.ids[rep] != cid:
+                self.references.setdefault(self.ids[rep], []).append(
+                    {'id': cid, 'source': chunk.get('source', ''), 'page': chunk.get('page') or 1})
+                self.dropped += 1
+                self.dropped_bytes += len(chunk['text'].encode('utf-8'))
+
+    def report(self, dimension=None):
+        if not self.seen:
+            return
+        kept = self.seen - self.dropped
+        line = (f"🧹 Почти-дубликаты: чанков {self.seen} -> {kept} (-{self.dropped / self.seen:.1%}), "
+                f"текста -{self.dropped_bytes / 1024 / 1024:.2f} МБ")
+        if dimension:
+            line += f", векторов -{self.dropped * dimension * 4 / 1024 / 1024:.2f} МБ"
+        print(line)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        signatures = np.array(self.signatures, dtype=np.uint64).reshape(-1, len(self.a))
+        np.savez(os.path.join(path, SIGNATURES_FILE),
+                 ids=np.array(self.ids, dtype=object).astype(str), signatures=signatures)
+
+    def load(self, path, drop_ids=()):
+        """Подгрузка сигнатур представителей, уже лежащих в индексе, кроме удаляемых"""
+        file_path = os.path.join(path, SIGNATURES_FILE)
+        if not os.path.exists(file_path):
+            return
+        drop_ids = set(drop_ids)
+        with np.load(file_path) as data:
+            for cid, signature in zip(data['ids'], data['signatures']):
+                if str(cid) not in drop_ids:
+                    self._add(str(cid), signature)
+
+    def _find(self, signature):
+        checked = set()
+        for key in self._band_keys(signature):
+            for rep in self.buckets.get(key, ()):
+                if rep in checked:
+                    continue
+                checked.add(rep)
+                if np.mean(self.signatures[rep] == signature) >= self.threshold:
+                    return rep
+        return None
+
+    def _add(self, cid, signature):
+        rep = len(self.ids)
+        self.ids.append(cid)
+        self.signatures.append(signature)
+        for key in self._band_keys(signature):
+            self.buckets.setdefault(key, []).append(rep)
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
@@ -0,0 +1,208 @@
+import os
+import re
+import json
+import hashlib
+import numpy as np
+from filelock import FileLock
+
+
+class EmbeddingCache:
+    """Дисковый кэш эмбеддингов по (модель, хэш текста): memmap-массив float32 + индекс смещений.
+    Кэш может быть открыт сразу в нескольких процессах (приложение, rebuild_index.py): чтение
+    и запись идут под файловой блокировкой, а index.json перечитывается, если его сменил другой процесс"""
+
+    def __init__(self, cache_dir, model_name, max_size_mb=2048):
+        safe_name = re.sub(r'[^\w.-]+', '_', model_name)
+        self.path = os.path.join(cache_dir, safe_name)
+        self.vectors_path = os.path.join(self.path, "vectors.f32")
+        self.index_path = os.path.join(self.path, "index.json")
+        self.lock_path = os.path.join(self.path, "cache.lock")
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+
+        self.dim = None
+        self.capacity = 0
+        self.tick = 0
+        self.entries = {}      # хэш текста -> [номер строки в массиве, время последнего обращения]
+        self.free_slots = []
+        self.vectors = None
+        self._stamp = None      # какой index.json прочитан последним
+        os.makedirs(self.path, exist_ok=True)
+        self._lock = FileLock(self.lock_path)
+
+        self.hits = 0
+        self.misses = 0
+
+        with self._lock:
+            self._load()
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def encode(self, texts, encode_fn):
+        """Эмбеддинги для texts: из кэша, а промахи считаются через encode_fn одним вызовом"""
+        keys = [self.key(text) for text in texts]
+        cached = {}
+        with self._lock:
+            self._load()
+            for i, key in enumerate(keys):
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.tick += 1
+                    entry[1] = self.tick
+                    cached[i] = np.array(self.vectors[entry[0]])
+        missing = [i for i in range(len(texts)) if i not in cached]
+        self.hits += len(cached)
+        self.misses += len(missing)
+
+        new_embeddings = None
+        if missing:
+            # Кодирование - самое долгое, оно идёт без блокировки
+            new_embeddings = np.asarray(encode_fn([texts[i] for i in missing]), dtype=np.float32)
+            if self.dim is not None and new_embeddings.shape[1] != self.dim:
+                # Сменилась размерность модели - старый кэш бесполезен
+                self.hits -= len(cached)
+                self.misses -= len(missing)
+                with self._lock:
+                    self.clear()
+                return self.encode(texts, encode_fn)
+
+        dim = self.dim if new_embeddings is None else new_embeddings.shape[1]
+        embeddings = np.empty((len(texts), dim), dtype=np.float32)
+        for i, vector in cached.items():
+            embeddings[i] = vector
+        if missing:
+            embeddings[missing] = new_embeddings
+            self.put_many([keys[i] for i in missing], new_embeddings)
+        return embeddings
+
+    def put_many(self, keys, embeddings):
+        """Запись сразу попадает на диск: строки массива выделяются по свежему index.json,
+        чтобы два процесса не заняли одну и ту же строку"""
+        with self._lock:
+            self._load()
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+
+            max_entries = max(self.max_bytes // (self.dim * 4), 1)
+            keys = keys[-max_entries:]
+            embeddings = embeddings[-max_entries:]
+            self._evict(len(self.entries) + len(keys) - max_entries)
+
+            needed = len(keys) - len(self.free_slots)
+            if needed > 0:
+                self._grow(min(max(self.capacity * 2, self.capacity + needed), max_entries))
+
+            for key, vector in zip(keys, embeddings):
+                if key in self.entries:
+                    continue
+                slot = self.free_slots.pop()
+                self.vectors[slot] = vector
+                self.tick += 1
+                self.entries[key] = [slot, self.tick]
+            self._write_index()
+
+    def save(self):
+        """Сохранение времени обращений (для вытеснения LRU); сами векторы пишет put_many"""
+        with self._lock:
+            self._load()
+            self._write_index()
+
+    def _write_index(self):
+        if self.vectors is not None:
+            self.vectors.flush()
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'dim': self.dim,
+                'capacity': self.capacity,
+                'tick': self.tick,
+                'entries': self.entries,
+            }, f)
+        os.replace(tmp_path, self.index_path)
+        self._stamp = self._index_stamp()
+
+    def clear(self):
+        self.dim = None
+        self.capacity = 0
+        self.tick = 0
+        self.entries = {}
+        self.free_slots = []
+        self.vectors = None
+        self._stamp = None
+        for path in (self.vectors_path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'size_mb': round(self.capacity * (self.dim or 0) * 4 / 1024 / 1024, 2),
+        }
+
+    def _index_stamp(self):
+        try:
+            stat = os.stat(self.index_path)
+        except OSError:
+            return None
+        # index.json всегда подменяется через os.replace, так что новый файл - новый inode
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        """Перечитывание index.json, если он изменился с прошлого чтения или записи; под блокировкой.
+        Время обращений к записям, ещё не сохранённое этим процессом, не теряется"""
+        stamp = self._index_stamp()
+        if stamp == self._stamp:
+            return
+        if stamp is None or not os.path.exists(self.vectors_path):
+            # Кэш удалили (или сменилась модель) в другом процессе
+            self.clear()
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            ticks = {key: tick for key, (_, tick) in self.entries.items()}
+            self.dim = data['dim']
+            self.tick = max(self.tick, data['tick'])
+            self.entries = data['entries']
+            for key, entry in self.entries.items():
+                entry[1] = max(entry[1], ticks.get(key, 0))
+            # Массив мог вырасти или быть пересоздан, поэтому отображается заново
+            self.capacity = data['capacity']
+            self.vectors = None
+            if self.capacity:
+                self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+',
+                                         shape=(self.capacity, self.dim))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ Кэш эмбеддингов повреждён, создаётся заново: {e}")
+            self.clear()
+            return
+
+        used = {slot for slot, _ in self.entries.values()}
+        self.free_slots = [slot for slot in range(self.capacity - 1, -1, -1) if slot not in used]
+        self._stamp = stamp
+
+    def _evict(self, count):
+        if count <= 0:
+            return
+        # Вытесняем давно не использованные записи, их строки переиспользуются
+        oldest = sorted(self.entries.items(), key=lambda item: item[1][1])[:count]
+        for key, (slot, _) in oldest:
+            del self.entries[key]
+            self.free_slots.append(slot)
+
+    def _grow(self, capacity):
+        if capacity <= self.capacity:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        if self.vectors is not None:
+            self.vectors.flush()
+            del self.vectors
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(capacity * self.dim * 4)
+        self.free_slots = list(range(capacity - 1, self.capacity - 1, -1)) + self.free_slots
+        self.capacity = capacity
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+',
+                                 shape=(self.capacity, self.dim))
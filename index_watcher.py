@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+import config
+import ingestion
+import rebuild_index
+from retrieval_system import RetrievalSystem
+from sharded_index import ShardedRetrievalSystem
+
+
+class RetrievalSlot:
+    """Место RetrievalSystem в RAG-системе, заданное явно: атрибут name (retrieval.rag_attribute
+    в конфиге). Подмена идёт через rag_system.swap_retrieval(), если он есть, иначе присваиванием"""
+
+    def __init__(self, rag_system, name=None):
+        self.rag_system = rag_system
+        self.name = name or config.SYSTEM_CONFIG['retrieval'].get('rag_attribute', 'retrieval_system')
+
+    def get(self):
+        retrieval = getattr(self.rag_system, self.name, None)
+        return retrieval if isinstance(retrieval, RetrievalSystem) else None
+
+    def swap(self, retrieval):
+        swap_retrieval = getattr(self.rag_system, 'swap_retrieval', None)
+        if swap_retrieval is not None:
+            swap_retrieval(retrieval)
+        else:
+            setattr(self.rag_system, self.name, retrieval)
+
+
+def snapshot(folder):
+    state = {}
+    for path in ingestion.list_documents(folder):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue    # файл удалили между обходом папки и stat
+        state[path] = (stat.st_size, stat.st_mtime_ns)
+    return state
+
+
+class IndexWatcher:
+    """Фоновое обновление индекса при изменениях в папке документов.
+
+    Папка опрашивается раз в interval секунд (с inotify_simple изменения будят поток сразу).
+    После изменения ждём, пока папка debounce секунд не меняется, инкрементально обновляем
+    копию индекса и подменяем RetrievalSystem в RAG-системе через slot (RetrievalSlot):
+    запросы, начатые до подмены, дорабатывают со старым индексом."""
+
+    def __init__(self, slot, folder=None, index_path=None, interval=None, debounce=None):
+        watch_config = config.SYSTEM_CONFIG.get('ingestion', {})
+        self.slot = slot
+        self.folder = folder or config.SYSTEM_CONFIG['paths'].get('documents', './data/documents')
+        self.index_path = index_path or config.SYSTEM_CONFIG['paths']['vector_db']
+        self.interval = interval if interval is not None else watch_config.get('watch_interval', 2.0)
+        self.debounce = debounce if debounce is not None else watch_config.get('watch_debounce', 3.0)
+        # Разбор в фоне не должен отнимать все ядра у ответов на вопросы
+        self.workers = watch_config.get('watch_workers', 1)
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._inotify = None
+        self.updates = 0
+        self.last_error = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._inotify = self._open_inotify()
+        self._thread = threading.Thread(target=self._run, name="index-watcher", daemon=True)
+        self._thread.start()
+        mode = "inotify" if self._inotify is not None else f"опрос каждые {self.interval} с"
+        print(f"👀 Наблюдение за папкой {self.folder} ({mode})")
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def notify(self):
+        """Проверить папку без ожидания очередного опроса (после добавления/удаления из интерфейса)"""
+        self._wake.set()
+
+    def _run(self):
+        last = snapshot(self.folder)
+        while not self._stop.is_set():
+            self._wait(self.interval)
+            current = snapshot(self.folder)
+            if current == last:
+                continue
+
+            # Пачка изменений (копирование нескольких файлов) обрабатывается одним обновлением
+            while not self._stop.is_set():
+                self._stop.wait(self.debounce)
+                self._drain()
+                settled = snapshot(self.folder)
+                if settled == current:
+                    break
+                current = settled
+            if self._stop.is_set():
+                break
+
+            try:
+                self._update()
+                last = current
+            except Exception as e:
+                # Ошибка не должна останавливать наблюдение; повторим при следующем изменении
+                self.last_error = e
+                print(f"❌ Фоновое обновление индекса не удалось: {e}")
+                last = current
+
+    def _update(self):
+        live = self.slot.get()
+        if live is None:
+            print(f"⚠️ В атрибуте {self.slot.name} RAG-системы нет RetrievalSystem, обновлять нечего")
+            return
+
+        if isinstance(live, ShardedRetrievalSystem):
+            self._update_shards(live)
+            return
+
+        settings = rebuild_index.manifest_settings(self.index_path)
+        if settings is None:
+            print("⚠️ Нет манифеста документов или он от другой версии нарезки: выполните rebuild_index.py --full")
+            return
+
+        start = time.perf_counter()
+        print("🔄 Фоновое обновление индекса...")
+        shadow = live.clone()
+        splitter, dedup = rebuild_index.components_from_settings(settings, shadow)
+        # Файлы индекса сохраняются во временные и подменяются через os.replace, поэтому живой
+        # экземпляр дочитывает старые. Windows не даёт подменить файл, отображённый в память
+        if os.name == 'nt':
+            live.detach_files()
+        if not rebuild_index.rebuild_changed(self.index_path, workers=self.workers, splitter=splitter,
+                                             retrieval=shadow, dedup=dedup,
+                                             paths=ingestion.list_documents(self.folder)):
+            return
+
+        self.slot.swap(shadow)
+        self.updates += 1
+        print(f"✅ Индекс в работающей системе обновлён за {time.perf_counter() - start:.1f} с. "
+              f"Чанков: {len(shadow.metadata)}")
+
+    def _update_shards(self, live):
+        """Перестраиваются только шарды изменившихся коллекций, остальные переходят в новый экземпляр"""
+        start = time.perf_counter()
+        print("🔄 Фоновое обновление шардов...")
+        if os.name == 'nt':
+            for shard in live.shards.values():
+                shard.detach_files()
+        updated = rebuild_index.refresh_shards(live, self.index_path, workers=self.workers, folder=self.folder)
+        if updated is None:
+            return
+        self.slot.swap(updated)
+        self.updates += 1
+        print(f"✅ Шарды в работающей системе обновлены за {time.perf_counter() - start:.1f} с. "
+              f"Чанков: {updated.chunk_count()}")
+
+    def _wait(self, timeout):
+        if self._inotify is not None:
+            # События нужны только как сигнал проснуться; что именно изменилось, покажет snapshot
+            self._inotify.read(timeout=int(timeout * 1000))
+        else:
+            self._wake.wait(timeout)
+        self._wake.clear()
+
+    def _drain(self):
+        self._wake.clear()
+        if self._inotify is not None:
+            self._inotify.read(timeout=0)
+
+    def _open_inotify(self):
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            return None
+        inotify = INotify()
+        mask = flags.CREATE | flags.DELETE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_FROM | flags.MOVED_TO
+        for root, _, _ in os.walk(self.folder):
+            inotify.add_watch(root, mask)
+        return inotify
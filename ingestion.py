@@ -0,0 +1,341 @@
+import os
+import re
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import config
+import numpy as np
+from metadata_store import chunk_id
+from manifest import file_hash
+from page_cache import PageCache
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.docx', '.txt')
+# Версия разбора и нарезки: манифест с другой версией описывает другие чанки, индекс собирается заново
+CHUNKER_VERSION = 2
+
+# Конец предложения (с закрывающими кавычками/скобками) или пустая строка между абзацами
+SENTENCE_END_RE = re.compile(r'[.!?…]+["»)\]]*\s+|\n\s*\n')
+
+
+def list_documents(folder):
+    """Поддерживаемые файлы папки в детерминированном порядке"""
+    paths = []
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if name.lower().endswith(SUPPORTED_EXTENSIONS) and not name.startswith('~$'):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def load_pdf(path, start=0, end=None):
+    """Страницы PDF с номерами start+1..end (по умолчанию - все)"""
+    import fitz
+
+    pages = []
+    with fitz.open(path) as doc:
+        for number in range(start, min(end or doc.page_count, doc.page_count)):
+            text = doc[number].get_text()
+            if text.strip():
+                pages.append({'text': text, 'source': path, 'page': number + 1})
+    return pages
+
+
+def page_ranges(page_count, pages_per_task):
+    """Диапазоны страниц для параллельного разбора большого PDF; None - разбирать целиком"""
+    if not pages_per_task or page_count <= pages_per_task:
+        return None
+    return [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+
+
+def page_cache():
+    ingestion_config = config.SYSTEM_CONFIG.get('ingestion', {})
+    cache_dir = ingestion_config.get('page_cache_dir', './data/page_cache')
+    return PageCache(cache_dir, ingestion_config.get('page_cache_max_mb', 2048)) if cache_dir else None
+
+
+def load_docx(path):
+    import docx
+
+    document = docx.Document(path)
+    text = "\n".join(paragraph.text for paragraph in document.paragraphs if paragraph.text.strip())
+    return [{'text': text, 'source': path, 'page': 1}] if text else []
+
+
+def load_txt(path):
+    for encoding in ('utf-8', 'cp1251'):
+        try:
+            with open(path, 'r', encoding=encoding) as f:
+                text = f.read()
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError("не удалось определить кодировку")
+    return [{'text': text, 'source': path, 'page': 1}] if text.strip() else []
+
+
+LOADERS = {'.pdf': load_pdf, '.docx': load_docx, '.txt': load_txt}
+
+
+def load_file(path, page_range=None):
+    """Разбор одного файла (или диапазона страниц PDF): (путь, страницы, ошибка).
+    Исключения не выходят за пределы воркера"""
+    try:
+        if page_range is not None:
+            return path, load_pdf(path, *page_range), None
+        loader = LOADERS[os.path.splitext(path)[1].lower()]
+        return path, loader(path), None
+    except Exception as e:
+        return path, [], f"{type(e).__name__}: {e}"
+
+
+def load_document(path, cache_dir=None, digest=None, pages_per_task=None):
+    """Разбор файла в воркере: (путь, страницы, ошибка, хэш, диапазоны страниц, попадание в кэш).
+    Хэш и число страниц PDF считаются здесь же, а не в родительском процессе. Большой PDF
+    не разбирается: возвращаются диапазоны, которые родитель раздаёт пулу"""
+    try:
+        digest = digest or file_hash(path)
+    except OSError as e:
+        return path, [], f"{type(e).__name__}: {e}", None, None, None
+    if not path.lower().endswith('.pdf'):
+        return load_file(path) + (digest, None, None)
+
+    # Кэшируются только PDF - их разбор дорогой; hit None - кэш выключен
+    cache = PageCache(cache_dir) if cache_dir else None
+    hit = False if cache is not None else None
+    if cache is not None:
+        pages = cache.get(digest, path)
+        if pages is not None:
+            return path, pages, None, digest, None, True
+    if pages_per_task:
+        try:
+            import fitz
+
+            with fitz.open(path) as doc:
+                ranges = page_ranges(doc.page_count, pages_per_task)
+        except Exception:
+            ranges = None    # ошибку открытия покажет сам разбор
+        if ranges:
+            return path, [], None, digest, ranges, hit
+    path, pages, error = load_file(path)
+    if cache is not None and not error:
+        cache.put(digest, pages)
+    return path, pages, error, digest, None, hit
+
+
+def iter_loaded(paths, workers=None, digests=None):
+    """Параллельный разбор файлов в пуле процессов. Результаты отдаются в порядке paths,
+    в работе одновременно не больше 2 * workers задач. Большие PDF делятся на диапазоны
+    страниц, которые разбираются параллельно; страницы PDF берутся из кэша, если файл уже разбирался.
+    digests - sha1 файлов по нормализованному пути: уже известные (из манифеста) повторно не
+    считаются, посчитанные воркерами дописываются туда же"""
+    paths = list(paths)
+    ingestion_config = config.SYSTEM_CONFIG.get('ingestion', {})
+    if workers is None:
+        workers = ingestion_config.get('workers') or os.cpu_count() or 1
+    pages_per_task = ingestion_config.get('pdf_pages_per_task', 100)
+    cache = page_cache()
+    cache_dir = cache.cache_dir if cache is not None else None
+    digests = digests if digests is not None else {}
+
+    def finish(result, parts=None):
+        """Сборка результата load_document с разобранными диапазонами страниц"""
+        path, pages, error, digest, ranges, hit = result
+        if parts is not None:
+            error = next((error for _, _, error in parts if error), None)
+            pages = [page for _, part, _ in parts for page in part]
+            if cache is not None and not error:
+                cache.put(digest, pages)
+        if hit is not None and cache is not None:
+            if hit:
+                cache.hits += 1
+            else:
+                cache.misses += 1
+        if digest:
+            digests[os.path.normpath(path)] = digest
+        return path, pages, error
+
+    if workers <= 1:
+        for path in paths:
+            result = load_document(path, cache_dir, digests.get(os.path.normpath(path)))
+            yield finish(result)
+    else:
+        yield from _iter_pooled(paths, workers, pages_per_task, cache_dir, digests, finish)
+    if cache is not None:
+        cache.prune()
+        cache.report()
+
+
+def _iter_pooled(paths, workers, pages_per_task, cache_dir, digests, finish):
+    pending = deque(paths)
+    in_flight = deque()    # [путь, задача load_document, задачи по диапазонам страниц или None]
+    executor = ProcessPoolExecutor(max_workers=workers)
+
+    def submit(executor, path):
+        return [path, executor.submit(load_document, path, cache_dir, digests.get(os.path.normpath(path)),
+                                      pages_per_task), None]
+
+    def expand(executor, item):
+        """Диапазоны страниц большого PDF уходят в пул, как только воркер посчитал страницы"""
+        probe = item[1]
+        if item[2] is None and probe.done() and probe.exception() is None and probe.result()[4]:
+            item[2] = [executor.submit(load_file, item[0], page_range) for page_range in probe.result()[4]]
+
+    def collect(executor, item):
+        item[1].result()
+        expand(executor, item)
+        return finish(item[1].result(), [future.result() for future in item[2]] if item[2] else None)
+
+    def load(item):
+        return 1 + len(item[2] or ())
+
+    try:
+        while pending or in_flight:
+            while pending and sum(load(item) for item in in_flight) < workers * 2:
+                in_flight.append(submit(executor, pending.popleft()))
+            try:
+                for item in in_flight:
+                    expand(executor, item)
+                result = collect(executor, in_flight[0])
+                in_flight.popleft()
+            except BrokenProcessPool:
+                # Воркер упал целиком (например, на битом PDF), и по пулу не понять, на каком файле.
+                # Файлы, бывшие в работе, разбираются заново по одному в отдельном пуле:
+                # ошибкой помечается только тот, что роняет пул и в одиночку
+                executor.shutdown(wait=False, cancel_futures=True)
+                suspects = list(in_flight)
+                in_flight.clear()
+                for item in suspects:
+                    futures = [item[1]] + (item[2] or [])
+                    done = all(future.done() and future.exception() is None for future in futures)
+                    if done and (item[2] is not None or not item[1].result()[4]):
+                        yield finish(item[1].result(), [future.result() for future in item[2]] if item[2] else None)
+                        continue
+                    with ProcessPoolExecutor(max_workers=workers) as single:
+                        try:
+                            result = collect(single, submit(single, item[0]))
+                        except BrokenProcessPool as e:
+                            result = item[0], [], f"процесс разбора аварийно завершился: {e}"
+                    yield result
+                executor = ProcessPoolExecutor(max_workers=workers)
+                continue
+            yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+@functools.lru_cache(maxsize=None)
+def char_splitter(chunk_size, chunk_overlap):
+    from document_processor import DocumentProcessor
+
+    return DocumentProcessor(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def split_text(text, chunk_size=800, chunk_overlap=150):
+    """Посимвольная нарезка DocumentProcessor._split_text: полная сборка, инкрементальные
+    обновления и фоновый наблюдатель режут текст одной реализацией"""
+    return char_splitter(chunk_size, chunk_overlap)._split_text(text)
+
+
+class TokenSplitter:
+    """Нарезка в токенах энкодера: чанк целиком помещается в окно модели и по возможности
+    заканчивается на границе предложения. Страницы токенизируются одним пакетным вызовом"""
+
+    def __init__(self, tokenizer, max_tokens, overlap_tokens=24):
+        if not getattr(tokenizer, 'is_fast', False):
+            raise ValueError("Для нарезки по токенам нужен быстрый токенизатор (offset mapping)")
+        if not 0 <= overlap_tokens < max_tokens // 2:
+            raise ValueError(f"overlap_tokens должно быть меньше max_tokens / 2 ({max_tokens // 2})")
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+
+    @classmethod
+    def from_encoder(cls, model, overlap_tokens=24):
+        # Два места в окне занимают служебные [CLS] и [SEP]
+        return cls(model.tokenizer, model.max_seq_length - 2, overlap_tokens)
+
+    def split(self, text):
+        return self.split_many([text])[0]
+
+    def split_many(self, texts):
+        encoded = self.tokenizer(list(texts), add_special_tokens=False, return_offsets_mapping=True,
+                                 return_attention_mask=False, return_token_type_ids=False, verbose=False)
+        return [self._split_tokens(text, np.asarray(offsets, dtype=np.int64).reshape(-1, 2))
+                for text, offsets in zip(texts, encoded['offset_mapping'])]
+
+    def _split_tokens(self, text, offsets):
+        n = len(offsets)
+        if not n:
+            return []
+        # Номера токенов, с которых начинаются предложения
+        ends = [m.end() for m in SENTENCE_END_RE.finditer(text)]
+        bounds = np.unique(np.searchsorted(offsets[:, 0], ends))
+
+        chunks = []
+        start = 0
+        while start < n:
+            end = start + self.max_tokens
+            if end < n:
+                j = np.searchsorted(bounds, end, side='right') - 1
+                if j >= 0 and bounds[j] > start + self.max_tokens // 2:
+                    end = int(bounds[j])
+            end = min(end, n)
+            chunk = text[offsets[start, 0]:offsets[end - 1, 1]].strip()
+            if chunk:
+                chunks.append(chunk)
+            if end >= n:
+                break
+            # Перекрытие начинается с ближайшего предложения внутри хвоста чанка
+            back = end - self.overlap_tokens
+            k = np.searchsorted(bounds, back)
+            start = int(bounds[k]) if k < len(bounds) and bounds[k] < end else back
+        return chunks
+
+
+def split_pages(pages, chunk_size=800, chunk_overlap=150, splitter=None):
+    if splitter is not None:
+        page_texts = splitter.split_many([page['text'] for page in pages])
+    else:
+        page_texts = [split_text(page['text'], chunk_size, chunk_overlap) for page in pages]
+
+    chunks = []
+    for page, texts in zip(pages, page_texts):
+        for text in texts:
+            chunk = {'text': text, 'source': page['source'], 'page': page['page']}
+            chunk['id'] = chunk_id(chunk)
+            chunks.append(chunk)
+    return chunks
+
+
+def iter_chunks(folder=None, chunk_size=800, chunk_overlap=150, workers=None, failed=None, splitter=None,
+                digests=None):
+    """Поток чанков папки документов: файл разбирается, режется и отдаётся, не дожидаясь остальных"""
+    if folder is None:
+        folder = config.SYSTEM_CONFIG['paths'].get('documents', './data/documents')
+    paths = list_documents(folder)
+    print(f"📂 Найдено документов: {len(paths)}")
+
+    for _, chunks in iter_file_chunks(paths, chunk_size, chunk_overlap, workers, failed, splitter, digests):
+        yield from chunks
+
+
+def iter_file_chunks(paths, chunk_size=800, chunk_overlap=150, workers=None, failed=None, splitter=None,
+                     digests=None):
+    """Чанки по файлам: (путь, чанки файла). Файлы с ошибкой разбора не отдаются, а попадают в failed"""
+    for path, pages, error in iter_loaded(paths, workers, digests):
+        if error:
+            print(f"❌ {os.path.basename(path)}: {error}")
+            if failed is not None:
+                failed.append(path)
+            continue
+        yield path, split_pages(pages, chunk_size, chunk_overlap, splitter)
+
+
+def process_documents(folder=None, chunk_size=800, chunk_overlap=150, workers=None, splitter=None, digests=None):
+    """Разбор всей папки документов в пуле процессов; ошибки отдельных файлов не прерывают прогон"""
+    failed = []
+    chunks = list(iter_chunks(folder, chunk_size, chunk_overlap, workers, failed, splitter, digests))
+    print(f"✅ Файлов с ошибками: {len(failed)}, чанков: {len(chunks)}")
+    return chunks
@@ -0,0 +1,319 @@
+import os
+import re
+import json
+import math
+import shutil
+import tempfile
+from collections import Counter
+import numpy as np
+
+DASHES = str.maketrans({'–': '-', '—': '-', '‑': '-', '−': '-'})
+TOKEN_RE = re.compile(r'\w+(?:[-./]\w+)*')
+
+# Служебные слова, которые не мешают считать запрос «чистым» поиском по обозначению
+QUERY_STOPWORDS = {
+    'что', 'такое', 'это', 'документ', 'документа', 'обозначение', 'обозначением',
+    'найди', 'найти', 'покажи', 'где', 'какой', 'какая', 'о', 'об', 'про', 'по',
+}
+
+FILES = {
+    'terms': "lexical_terms.json",
+    'term_start': "lexical_term_start.npy",
+    'post_doc': "lexical_post_doc.npy",
+    'post_tf': "lexical_post_tf.npy",
+    'doc_ids': "lexical_doc_ids.npy",
+    'doc_len': "lexical_doc_len.npy",
+}
+
+
+def is_code(token):
+    """Обозначение документа: буквы и цифры в одном токене (РБ-089-14, НП-045-18, 12.1.004-91)"""
+    has_digit = any(c.isdigit() for c in token)
+    return has_digit and (any(c.isalpha() for c in token) or any(c in '-./' for c in token))
+
+
+def tokenize(text):
+    """Слова в нижнем регистре; составные обозначения сохраняются целиком и дополнительно по частям"""
+    tokens = []
+    for token in TOKEN_RE.findall(text.lower().translate(DASHES)):
+        tokens.append(token)
+        if is_code(token):
+            tokens.extend(part for part in re.split(r'[-./]', token) if part)
+    return tokens
+
+
+def query_codes(query):
+    return [token for token in TOKEN_RE.findall(query.lower().translate(DASHES)) if is_code(token)]
+
+
+def is_code_query(query):
+    """Запрос состоит только из обозначений документов (и служебных слов)"""
+    words = [token for token in TOKEN_RE.findall(query.lower().translate(DASHES))
+             if token not in QUERY_STOPWORDS]
+    return bool(words) and all(is_code(token) for token in words)
+
+
+class LexicalIndex:
+    """Инвертированный индекс BM25 по faiss-id чанков. Постинги отсортированы по термину
+    и хранятся плоскими массивами, которые после загрузки отображаются в память."""
+
+    def __init__(self, k1=1.5, b=0.75, spill_postings=2_000_000):
+        self.k1 = k1
+        self.b = b
+        # Больше стольких постингов из add() - пачки сбрасываются во временные файлы на диске,
+        # и столько же постингов в памяти за раз при их слиянии
+        self.spill_postings = spill_postings
+        self.terms = {}                                    # термин -> номер
+        self.term_start = np.zeros(1, dtype=np.int64)       # границы постингов термина
+        self.post_doc = np.empty(0, dtype=np.int64)
+        self.post_tf = np.empty(0, dtype=np.float32)
+        self.doc_ids = np.empty(0, dtype=np.int64)          # отсортированы
+        self.doc_len = np.empty(0, dtype=np.float32)
+        self._pending = []    # пачки из add(), сливаются с постингами при первом чтении
+        self._pending_postings = 0
+        self._runs = []       # пачки, уже сброшенные на диск: постинги отсортированы по термину (memmap)
+        self._spill_dir = None
+
+    def add(self, doc_ids, texts):
+        new_terms, new_docs, new_tfs, new_lens = [], [], [], []
+        for doc_id, text in zip(doc_ids, texts):
+            counts = Counter(tokenize(text))
+            new_lens.append(sum(counts.values()))
+            for term, tf in counts.items():
+                new_terms.append(self.terms.setdefault(term, len(self.terms)))
+                new_docs.append(doc_id)
+                new_tfs.append(tf)
+        self._pending.append((
+            np.array(new_terms, dtype=np.int64),
+            np.array(new_docs, dtype=np.int64),
+            np.array(new_tfs, dtype=np.float32),
+            np.array(list(doc_ids), dtype=np.int64),
+            np.array(new_lens, dtype=np.float32),
+        ))
+        self._pending_postings += len(new_terms)
+        if self._pending_postings >= self.spill_postings:
+            self._spill()
+
+    def _spill(self):
+        """Накопленные пачки - отсортированным по термину прогоном во временную папку:
+        постинги прогона на диске (memmap), в памяти остаются только длины чанков"""
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="lexical-")
+        terms, docs, tfs, doc_ids, doc_len = (np.concatenate(part) for part in zip(*self._pending))
+        order = np.argsort(terms, kind='stable')
+        run = {'term_start': np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=len(self.terms)))]),
+               'doc_ids': doc_ids, 'doc_len': doc_len}
+        for name, value in (('post_doc', docs), ('post_tf', tfs)):
+            path = os.path.join(self._spill_dir, f"run{len(self._runs)}_{name}.npy")
+            np.save(path, value[order])
+            run[name] = np.load(path, mmap_mode='r')
+        self._runs.append(run)
+        self._pending = []
+        self._pending_postings = 0
+
+    def _merge(self, path=None):
+        """Слияние пачек из add() с постингами. Если пачки сбрасывались на диск - k-путевое слияние
+        по номеру термина: выходные постинги пишутся блоками не больше spill_postings прямо в файлы
+        (при save - во временные файлы папки индекса path). True - постинги уже записаны в path"""
+        if not self._runs:
+            if self._pending:
+                self._merge_pending()
+            return False
+        if self._pending:
+            self._spill()
+
+        n_terms = len(self.terms)
+        sources = [(self.term_start, self.post_doc, self.post_tf)] + \
+                  [(run['term_start'], run['post_doc'], run['post_tf']) for run in self._runs]
+        # Прогоны сброшены, когда терминов было меньше: у новых терминов в них пусто
+        sources = [(np.concatenate([start, np.full(n_terms + 1 - len(start), start[-1])]), doc, tf)
+                   for start, doc, tf in sources]
+        term_start = np.sum([start for start, _, _ in sources], axis=0).astype(np.int64)
+
+        if path is not None:
+            out_dir, names = path, {name: FILES[name] + ".tmp" for name in ('post_doc', 'post_tf')}
+        else:
+            out_dir = tempfile.mkdtemp(prefix="lexical-")
+            names = {name: f"{name}.npy" for name in ('post_doc', 'post_tf')}
+        out_doc = np.lib.format.open_memmap(os.path.join(out_dir, names['post_doc']), mode='w+',
+                                            dtype=np.int64, shape=(int(term_start[-1]),))
+        out_tf = np.lib.format.open_memmap(os.path.join(out_dir, names['post_tf']), mode='w+',
+                                           dtype=np.float32, shape=(int(term_start[-1]),))
+        self._write_merged(sources, term_start, out_doc, out_tf)
+        out_doc.flush()
+        out_tf.flush()
+
+        doc_ids = np.concatenate([self.doc_ids] + [run['doc_ids'] for run in self._runs])
+        doc_len = np.concatenate([self.doc_len] + [run['doc_len'] for run in self._runs])
+        order = np.argsort(doc_ids, kind='stable')
+        self.doc_ids, self.doc_len = doc_ids[order], doc_len[order]
+        self.term_start = term_start
+        # Ссылки на memmap прогонов и прошлого слияния отпускаем до удаления файлов (Windows)
+        del sources
+        self._runs = []
+        self.post_doc, self.post_tf = out_doc, out_tf
+        shutil.rmtree(self._spill_dir, ignore_errors=True)
+        self._spill_dir = None if path is not None else out_dir
+        return path is not None
+
+    def _write_merged(self, sources, term_start, out_doc, out_tf):
+        """Постинги источников (отсортированных по термину) в out_doc/out_tf по блокам терминов"""
+        n_terms = len(term_start) - 1
+        first = 0
+        while first < n_terms:
+            last = int(np.searchsorted(term_start, term_start[first] + self.spill_postings, side='right')) - 1
+            last = min(max(last, first + 1), n_terms)
+            block_terms, block_docs, block_tfs = [], [], []
+            for start, doc, tf in sources:
+                if start[first] == start[last]:
+                    continue
+                block_terms.append(np.repeat(np.arange(first, last), np.diff(start[first:last + 1])))
+                block_docs.append(np.asarray(doc[start[first]:start[last]]))
+                block_tfs.append(np.asarray(tf[start[first]:start[last]]))
+            if block_terms:
+                # Устойчивая сортировка: у термина постинги идут в порядке источников, как при слиянии в памяти
+                order = np.argsort(np.concatenate(block_terms), kind='stable')
+                out_doc[term_start[first]:term_start[last]] = np.concatenate(block_docs)[order]
+                out_tf[term_start[first]:term_start[last]] = np.concatenate(block_tfs)[order]
+            first = last
+
+    def _merge_pending(self):
+        new_terms, new_docs, new_tfs, new_ids, new_lens = (list(part) for part in zip(*self._pending))
+        self._pending = []
+        self._pending_postings = 0
+
+        post_term = np.repeat(np.arange(len(self.term_start) - 1), np.diff(self.term_start))
+        self._set_postings(
+            np.concatenate([post_term] + new_terms),
+            np.concatenate([self.post_doc] + new_docs),
+            np.concatenate([self.post_tf] + new_tfs),
+        )
+        doc_ids = np.concatenate([self.doc_ids] + new_ids)
+        doc_len = np.concatenate([self.doc_len] + new_lens)
+        order = np.argsort(doc_ids, kind='stable')
+        self.doc_ids, self.doc_len = doc_ids[order], doc_len[order]
+
+    def remove(self, doc_ids):
+        self._merge()
+        doc_ids = np.asarray(list(doc_ids), dtype=np.int64)
+        if not len(doc_ids):
+            return
+        keep = ~np.isin(self.post_doc, doc_ids)
+        post_term = np.repeat(np.arange(len(self.term_start) - 1), np.diff(self.term_start))
+        self._set_postings(post_term[keep], self.post_doc[keep], self.post_tf[keep])
+        keep = ~np.isin(self.doc_ids, doc_ids)
+        self.doc_ids, self.doc_len = self.doc_ids[keep], self.doc_len[keep]
+
+    def stats(self, query):
+        """(число чанков, суммарная длина, частоты терминов запроса) - BM25-статистика,
+        которую складывают по шардам, чтобы оценки разных индексов были сравнимы"""
+        self._merge()
+        df = {}
+        for term in set(tokenize(query)):
+            term_id = self.terms.get(term)
+            if term_id is not None:
+                df[term] = int(self.term_start[term_id + 1] - self.term_start[term_id])
+        return len(self.doc_ids), float(self.doc_len.sum()), df
+
+    def search(self, query, top_k, stats=None):
+        """BM25: (оценки, faiss-id) по убыванию оценки. stats - общая статистика нескольких индексов
+        (сумма stats()) вместо статистики этого индекса"""
+        self._merge()
+        n_docs = len(self.doc_ids)
+        terms = [(term, self.terms[term]) for term in set(tokenize(query)) if term in self.terms]
+        if not n_docs or not terms:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+
+        if stats is not None:
+            total_docs, avg_len = stats[0], stats[1] / stats[0]
+        else:
+            total_docs, avg_len = n_docs, float(self.doc_len.mean())
+        docs, partial = [], []
+        for word, term in terms:
+            start, end = self.term_start[term], self.term_start[term + 1]
+            if start == end:
+                continue
+            post_doc = np.asarray(self.post_doc[start:end])
+            tf = np.asarray(self.post_tf[start:end])
+            doc_len = self.doc_len[np.searchsorted(self.doc_ids, post_doc)]
+            df = stats[2][word] if stats is not None else len(post_doc)
+            idf = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+            docs.append(post_doc)
+            partial.append(idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * doc_len / avg_len)))
+        if not docs:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+
+        unique_docs, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(partial)).astype(np.float32)
+        top = np.argsort(-scores, kind='stable')[:top_k]
+        return scores[top], unique_docs[top]
+
+    def docs_with_all(self, terms):
+        """faiss-id чанков, содержащих все указанные термины"""
+        self._merge()
+        result = None
+        for term in terms:
+            term_id = self.terms.get(term)
+            if term_id is None:
+                return np.empty(0, dtype=np.int64)
+            docs = np.asarray(self.post_doc[self.term_start[term_id]:self.term_start[term_id + 1]])
+            result = docs if result is None else np.intersect1d(result, docs)
+        return result if result is not None else np.empty(0, dtype=np.int64)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        merged = self._merge(path)
+        terms = sorted(self.terms, key=self.terms.get)
+        with open(os.path.join(path, FILES['terms'] + ".tmp"), 'w', encoding='utf-8') as f:
+            json.dump(terms, f, ensure_ascii=False)
+        for name in ('term_start', 'post_doc', 'post_tf', 'doc_ids', 'doc_len'):
+            if merged and name in ('post_doc', 'post_tf'):
+                setattr(self, name, None)   # уже в .tmp-файлах; memmap закрывается перед заменой
+                continue
+            # Копия в памяти отпускает mmap старого файла перед его заменой
+            value = np.array(getattr(self, name))
+            setattr(self, name, value)
+            with open(os.path.join(path, FILES[name] + ".tmp"), 'wb') as f:
+                np.save(f, value)
+        # Файлы заменяются целиком, а не перезаписываются: другие экземпляры и процессы,
+        # отобразившие старые файлы в память, дорабатывают со старыми данными
+        for name in FILES:
+            os.replace(os.path.join(path, FILES[name] + ".tmp"), os.path.join(path, FILES[name]))
+        if merged:
+            self.post_doc = np.load(os.path.join(path, FILES['post_doc']), mmap_mode='r')
+            self.post_tf = np.load(os.path.join(path, FILES['post_tf']), mmap_mode='r')
+        if self._spill_dir is not None:
+            # Постинги прошлого слияния уже скопированы в память или в файлы path
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+    def load_into_memory(self):
+        self.post_doc = np.array(self.post_doc)
+        self.post_tf = np.array(self.post_tf)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(os.path.join(path, FILES['terms']), 'r', encoding='utf-8') as f:
+            index.terms = {term: i for i, term in enumerate(json.load(f))}
+        index.term_start = np.load(os.path.join(path, FILES['term_start']))
+        index.post_doc = np.load(os.path.join(path, FILES['post_doc']), mmap_mode='r')
+        index.post_tf = np.load(os.path.join(path, FILES['post_tf']), mmap_mode='r')
+        index.doc_ids = np.load(os.path.join(path, FILES['doc_ids']))
+        index.doc_len = np.load(os.path.join(path, FILES['doc_len']))
+        return index
+
+    @staticmethod
+    def exists(path):
+        return all(os.path.exists(os.path.join(path, name)) for name in FILES.values())
+
+    def __len__(self):
+        return len(self.doc_ids) + sum(len(run['doc_ids']) for run in self._runs) + \
+            sum(len(part[3]) for part in self._pending)
+
+    def _set_postings(self, post_term, post_doc, post_tf):
+        order = np.argsort(post_term, kind='stable')
+        self.post_doc = post_doc[order]
+        self.post_tf = post_tf[order]
+        counts = np.bincount(post_term, minlength=len(self.terms))
+        self.term_start = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
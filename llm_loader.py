@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import config
+
+DEFAULT_MODEL_PATH = "./data/models/saiga_mistral_7b"
+CPU_MODES = ('fp32', 'bf16', 'int8')
+BENCH_PROMPT = "Какие требования предъявляются к сварке трубопроводов атомных станций?"
+
+
+def llm_config():
+    return config.SYSTEM_CONFIG.get('llm', {})
+
+
+def quantize_linear_layers(model):
+    """Динамическая int8-квантизация линейных слоёв по одному: в отличие от quantize_dynamic
+    на всей модели, в fp32 одновременно бывает только один слой, а не все 28 ГБ весов 7B"""
+    import torch
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicLinear
+    from torch.ao.quantization import default_dynamic_qconfig
+
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if type(child) is torch.nn.Linear:
+                child.float()
+                child.qconfig = default_dynamic_qconfig
+                setattr(parent, name, DynamicLinear.from_float(child))
+    # Остальное (эмбеддинги, нормировки) - в fp32: квантизованные слои отдают fp32
+    return model.float()
+
+
+def dynamic_linear_layers(model):
+    """Линейные слои model заменяются пустыми динамическими int8 того же размера"""
+    import torch
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicLinear
+
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if type(child) is torch.nn.Linear:
+                setattr(parent, name, DynamicLinear(child.in_features, child.out_features,
+                                                    bias_=child.bias is not None, dtype=torch.qint8))
+    return model
+
+
+def save_quantized(model, path):
+    import torch
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    torch.save(model.state_dict(), path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def load_quantized(skeleton, path):
+    """Веса квантизованной модели из path в skeleton (dynamic_linear_layers той же архитектуры)"""
+    import torch
+
+    # Только тензоры, без произвольных объектов; mmap - веса не копируются в память ещё раз
+    skeleton.load_state_dict(torch.load(path, weights_only=True, mmap=True), assign=True)
+    return skeleton.eval()
+
+
+def quantized_skeleton(model_path):
+    """Модель из config.json с динамическими int8-слоями вместо линейных и без весов остальных слоёв
+    (meta-тензоры): в неё загружается сохранённый state_dict квантизованной модели"""
+    import torch
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(AutoConfig.from_pretrained(model_path), torch_dtype=torch.float32)
+    dynamic_linear_layers(model)
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    except OSError:
+        pass
+    return model
+
+
+def checkpoint_signature(model_path):
+    """Что должно совпасть, чтобы квантизованный чекпойнт можно было взять вместо исходной модели"""
+    import torch
+    import transformers
+
+    files = {}
+    for name in sorted(os.listdir(model_path)):
+        if name.endswith(('.json', '.safetensors', '.bin')):
+            stat = os.stat(os.path.join(model_path, name))
+            files[name] = [stat.st_size, stat.st_mtime_ns]
+    return {'files': files, 'torch': torch.__version__, 'transformers': transformers.__version__,
+            'format': 'state_dict'}
+
+
+def quantized_path(model_path, cache_dir=None):
+    cache_dir = cache_dir or llm_config().get('quantized_cache_dir', './data/models/quantized')
+    return os.path.join(cache_dir, f"{os.path.basename(os.path.normpath(model_path))}-int8.pt")
+
+
+def load_llm(model_path=None, cpu_mode=None, cache_dir=None, num_threads=None):
+    """Модель и токенизатор LLM (LocalLLM и бенчмарк грузят модель только через неё). С CUDA - fp16 на GPU; на CPU - cpu_mode (llm.cpu_mode в конфиге):
+    fp32 (по умолчанию, как раньше), bf16 (вдвое меньше памяти) или int8 (динамическая квантизация
+    линейных слоёв; её state_dict сохраняется на диск, и следующие запуски загружают готовые веса)"""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    settings = llm_config()
+    model_path = model_path or settings.get('model_path', DEFAULT_MODEL_PATH)
+    cpu_mode = cpu_mode or settings.get('cpu_mode', 'fp32')
+    num_threads = num_threads or settings.get('num_threads')
+    if cpu_mode not in CPU_MODES:
+        raise ValueError(f"Неизвестный режим CPU: {cpu_mode}. Доступны: {', '.join(CPU_MODES)}")
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    if torch.cuda.is_available():
+        model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float16, device_map='auto')
+        return model.eval(), tokenizer
+
+    if cpu_mode != 'int8':
+        dtype = torch.bfloat16 if cpu_mode == 'bf16' else torch.float32
+        print(f"🔧 Загрузка LLM в {cpu_mode}...")
+        model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=dtype, low_cpu_mem_usage=True)
+        return model.eval(), tokenizer
+
+    path = quantized_path(model_path, cache_dir)
+    signature = checkpoint_signature(model_path)
+    try:
+        with open(path + ".json", 'r', encoding='utf-8') as f:
+            fresh = json.load(f) == signature
+    except (OSError, ValueError):
+        fresh = False
+    if fresh:
+        print(f"🔧 Загрузка квантизованной LLM из {path}...")
+        return load_quantized(quantized_skeleton(model_path), path), tokenizer
+
+    print("🔧 Квантизация LLM в int8 (только при первом запуске)...")
+    # bf16 при загрузке вдвое снижает пик памяти; в fp32 переводится по одному слою перед квантизацией
+    model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True)
+    model = quantize_linear_layers(model).eval()
+    save_quantized(model, path)
+    with open(path + ".json", 'w', encoding='utf-8') as f:
+        json.dump(signature, f)
+    print(f"💾 Квантизованная LLM сохранена: {path}")
+    return model, tokenizer
+
+
+def benchmark_mode(cpu_mode, model_path=None, prompt=BENCH_PROMPT, new_tokens=64, num_threads=None):
+    """Загрузка, время до первого токена и скорость генерации в одном режиме; в отдельном процессе"""
+    import torch
+    from retrieval_benchmark import peak_rss_mb
+
+    start = time.perf_counter()
+    model, tokenizer = load_llm(model_path, cpu_mode, num_threads=num_threads)
+    result = {'mode': cpu_mode, 'load_s': round(time.perf_counter() - start, 2),
+              'rss_after_load_mb': peak_rss_mb()}
+
+    inputs = tokenizer(prompt, return_tensors='pt').to(model.device)
+    with torch.no_grad():
+        start = time.perf_counter()
+        model.generate(**inputs, max_new_tokens=1, do_sample=False)
+        result['first_token_s'] = round(time.perf_counter() - start, 3)
+
+        start = time.perf_counter()
+        output = model.generate(**inputs, max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=False)
+        elapsed = time.perf_counter() - start
+    generated = output[0, inputs['input_ids'].shape[1]:]
+    result['tokens_per_s'] = round(len(generated) / elapsed, 2)
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['text'] = tokenizer.decode(generated, skip_special_tokens=True)
+    return result
+
+
+def run_benchmark(modes=('fp32', 'int8'), model_path=None, new_tokens=64, num_threads=None):
+    """Каждый режим в новом процессе, чтобы пиковый RSS не копился. int8 замеряется дважды:
+    первая загрузка квантизует и сохраняет чекпойнт, вторая берёт его с диска"""
+    runs = []
+    for mode in modes:
+        for attempt in range(2 if mode == 'int8' else 1):
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(benchmark_mode, mode, model_path, BENCH_PROMPT,
+                                         new_tokens, num_threads).result()
+            if mode == 'int8':
+                result['mode'] = 'int8 (кэш)' if attempt else 'int8 (квантизация)'
+            runs.append(result)
+
+    print(f"\n{'режим':<20}{'загрузка':>10}{'RSS МБ':>9}{'пик МБ':>9}{'1-й ток.':>10}{'ток/с':>8}")
+    for run in runs:
+        print(f"{run['mode']:<20}{run['load_s']:>9.1f}с{run['rss_after_load_mb'] or 0:>9.0f}"
+              f"{run['peak_rss_mb'] or 0:>9.0f}{run['first_token_s']:>9.2f}с{run['tokens_per_s']:>8.2f}")
+    for run in runs:
+        print(f"\n💬 {run['mode']}: {run['text'][:200]}")
+    return runs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Загрузка и скорость LLM на CPU: fp32 против int8")
+    parser.add_argument("--modes", nargs='+', default=['fp32', 'int8'], choices=CPU_MODES)
+    parser.add_argument("--model", default=None, help="папка модели (по умолчанию llm.model_path)")
+    parser.add_argument("--tokens", type=int, default=64, help="сколько токенов генерировать")
+    parser.add_argument("--threads", type=int, default=None, help="число потоков torch")
+    parser.add_argument("--output", default=None, help="файл для JSON-отчёта")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.modes, args.model, args.tokens, args.threads)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 Отчёт сохранён: {args.output}")
@@ -0,0 +1,104 @@
+import threading
+import time
+
+
+class AnswerStream:
+    """Ответ RAG-системы по мере генерации: итерация отдаёт новые фрагменты текста.
+    sources и confidence известны до генерации (поиск идёт первым), замеры - после исчерпания."""
+
+    def __init__(self, deltas=None, sources=None, confidence=0.0):
+        self.deltas = deltas
+        self.sources = sources or []
+        self.confidence = confidence
+        self.text = ""
+        self.started = time.perf_counter()
+        self.first_token_s = None
+        self.total_s = None
+        self.chunks = 0
+
+    def __iter__(self):
+        for delta in self.deltas:
+            if not delta:
+                continue
+            if self.first_token_s is None:
+                self.first_token_s = time.perf_counter() - self.started
+            self.text += delta
+            self.chunks += 1
+            yield delta
+        self.total_s = time.perf_counter() - self.started
+
+    def report(self):
+        if self.total_s is None:
+            return
+        first = self.first_token_s if self.first_token_s is not None else self.total_s
+        generating = self.total_s - first
+        rate = f", {self.chunks / generating:.1f} фрагм./с" if generating > 0 and self.chunks > 1 else ""
+        print(f"⏱️ Первый токен через {first:.2f} с, ответ целиком за {self.total_s:.2f} с{rate}")
+
+
+def generate_stream(model, tokenizer, prompt, timeout=None, prompt_cache=None, **generate_kwargs):
+    """Генерация с выдачей текста по мере появления токенов. model.generate работает в отдельном
+    потоке и пишет в TextIteratorStreamer; исключение генерации пробрасывается в итерирующий поток.
+    С prompt_cache (prompt_cache.PromptCache) prefill закэшированного начала промпта пропускается"""
+    from transformers import TextIteratorStreamer
+
+    if prompt_cache is not None:
+        prompt = prompt_cache.prepare(prompt)
+        prompt_cache.report()
+    elif isinstance(prompt, str):
+        prompt = tokenizer(prompt, return_tensors="pt").to(model.device)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=timeout)
+    errors = []
+
+    def run():
+        try:
+            model.generate(**prompt, streamer=streamer, **generate_kwargs)
+        except Exception as e:
+            errors.append(e)
+            streamer.end()
+
+    thread = threading.Thread(target=run, name="llm-generate", daemon=True)
+    thread.start()
+    yield from streamer
+    thread.join()
+    if errors:
+        raise errors[0]
+    if prompt_cache is not None:
+        prompt_cache.remember(prompt)
+
+
+def stream_question(rag_system, question, answer_cache=None, generator=None, retrieval=None, context=None):
+    """Потоковый ответ RAG-системы: process_question_stream, если он есть у системы, иначе generator
+    (answer_generator.AnswerGenerator), иначе process_question одним фрагментом.
+    С answer_cache (answer_cache.AnswerCache) похожий вопрос отвечается из кэша, а новый ответ
+    попадает в кэш, когда поток дочитан до конца. retrieval - текущий RetrievalSystem RAG-системы,
+    нужен кэшу и generator; context - answer_cache.history_fingerprint предыдущих реплик разговора"""
+    entry = embedding = version = None
+    if answer_cache is not None:
+        entry, embedding, version = answer_cache.lookup(retrieval, question, context)
+        if entry is not None:
+            return AnswerStream(iter([entry['answer']]), entry['sources'], entry['confidence'])
+
+    if hasattr(rag_system, 'process_question_stream'):
+        stream = rag_system.process_question_stream(question)
+    elif generator is not None:
+        stream = generator.stream(retrieval, question)
+    else:
+        stream = AnswerStream()
+
+        def whole_answer():
+            answer, stream.sources, stream.confidence = rag_system.process_question(question)
+            yield answer
+
+        stream.deltas = whole_answer()
+
+    if answer_cache is not None:
+        deltas = stream.deltas
+
+        def cache_when_done():
+            yield from deltas
+            answer_cache.store(question, embedding, version, stream.text, stream.sources, stream.confidence,
+                               time.perf_counter() - stream.started, context)
+
+        stream.deltas = cache_when_done()
+    return stream
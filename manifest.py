@@ -0,0 +1,116 @@
+import os
+import json
+import hashlib
+from metadata_store import chunk_id
+
+MANIFEST_FILE = "manifest.json"
+
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DocumentManifest:
+    """Состояние проиндексированных файлов: путь -> размер, mtime, хэш содержимого и id чанков.
+    Хранится рядом с индексом, чтобы описывать ровно то, что в нём лежит."""
+
+    def __init__(self, files=None, settings=None):
+        self.files = files if files is not None else {}
+        self.settings = settings or {}   # параметры нарезки: при их смене старые чанки не годятся
+        self._fingerprints = {}   # отпечатки, снятые scan() для новых и изменённых файлов
+        # sha1 по нормализованному пути, посчитанные при разборе (ingestion.iter_loaded(digests=...)):
+        # record() не читает такой файл второй раз
+        self.digests = {}
+
+    @classmethod
+    def load(cls, index_path):
+        with open(os.path.join(index_path, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['files'], data.get('settings'))
+
+    @staticmethod
+    def exists(index_path):
+        return os.path.exists(os.path.join(index_path, MANIFEST_FILE))
+
+    def save(self, index_path):
+        os.makedirs(index_path, exist_ok=True)
+        path = os.path.join(index_path, MANIFEST_FILE)
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump({'settings': self.settings, 'files': self.files}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def scan(self, paths):
+        """Сравнение файлов папки с манифестом. Хэш считается только при смене размера или mtime"""
+        changes = {'added': [], 'changed': [], 'unchanged': [], 'removed': []}
+        current = set()
+        for path in paths:
+            key = os.path.normpath(path)
+            current.add(key)
+            stat = os.stat(path)
+            entry = self.files.get(key)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                changes['unchanged'].append(path)
+                continue
+
+            fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': file_hash(path)}
+            self.digests[key] = fingerprint['sha1']
+            if entry is None:
+                self._fingerprints[key] = fingerprint
+                changes['added'].append(path)
+            elif entry['sha1'] == fingerprint['sha1']:
+                # Файл переписан без изменений (копирование, touch) - запоминаем новый mtime
+                entry.update(size=fingerprint['size'], mtime=fingerprint['mtime'])
+                changes['unchanged'].append(path)
+            else:
+                self._fingerprints[key] = fingerprint
+                changes['changed'].append(path)
+        changes['removed'] = sorted(key for key in self.files if key not in current)
+        return changes
+
+    def chunk_ids(self, paths):
+        ids = []
+        for path in paths:
+            entry = self.files.get(os.path.normpath(path))
+            if entry is not None:
+                ids.extend(entry['chunk_ids'])
+        return ids
+
+    def record(self, path, chunk_ids):
+        key = os.path.normpath(path)
+        fingerprint = self._fingerprints.pop(key, None)
+        if fingerprint is None:
+            stat = os.stat(path)
+            digest = self.digests.pop(key, None) or file_hash(path)
+            fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': digest}
+        self.files[key] = dict(fingerprint, chunk_ids=list(chunk_ids))
+
+    def forget(self, path):
+        self.files.pop(os.path.normpath(path), None)
+
+    def record_chunks(self, paths, chunks):
+        """Запись файлов по уже нарезанным чанкам; источник чанка сопоставляется с путём или именем файла.
+        Файлы без чанков не записываются: при следующем запуске они будут разобраны снова"""
+        by_source = {}
+        for chunk in chunks:
+            source = os.path.normpath(str(chunk.get('source', '')))
+            by_source.setdefault(source, []).append(chunk_id(chunk))
+            if os.path.basename(source) != source:
+                by_source.setdefault(os.path.basename(source), []).append(chunk_id(chunk))
+        for path in paths:
+            key = os.path.normpath(path)
+            ids = by_source.get(key) or by_source.get(os.path.basename(key))
+            if ids:
+                self.record(path, ids)
+
+    def track(self, chunks):
+        """Пропускает поток чанков, запоминая id по файлам; запись в манифест - по завершении потока"""
+        by_source = {}
+        for chunk in chunks:
+            by_source.setdefault(chunk['source'], []).append(chunk_id(chunk))
+            yield chunk
+        for source, ids in by_source.items():
+            self.record(source, ids)
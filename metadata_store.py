@@ -0,0 +1,266 @@
+import os
+import json
+import mmap
+import hashlib
+import numpy as np
+
+RECORDS_FILE = "metadata.npy"
+TEXTS_FILE = "metadata_texts.bin"
+SOURCES_FILE = "metadata_sources.json"
+REFERENCES_FILE = "metadata_references.json"
+
+
+def chunk_id(chunk):
+    """Идентификатор чанка: hashlib-id из DocumentProcessor либо хэш содержимого"""
+    if chunk.get('id'):
+        return str(chunk['id'])
+    raw = f"{chunk.get('source', '')}:{chunk.get('page', 1)}:{chunk['text']}"
+    return hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+
+def faiss_id(cid):
+    """Преобразование строкового id чанка в int64 для IndexIDMap2"""
+    return int(hashlib.md5(cid.encode('utf-8')).hexdigest()[:15], 16)
+
+
+def record_dtype(id_width):
+    return np.dtype([
+        ('chunk_id', f'S{id_width}'),
+        ('faiss_id', '<i8'),
+        ('source', '<i4'),
+        ('page', '<i4'),
+        ('text_offset', '<i8'),
+        ('text_length', '<i4'),
+    ])
+
+
+def build_records(chunks, source_id, offset, id_width=32):
+    """Записи для пачки чанков и их тексты одним UTF-8 блоком, начиная со смещения offset"""
+    id_width = max([id_width] + [len(chunk['id'].encode('utf-8')) for chunk in chunks])
+    records = np.zeros(len(chunks), dtype=record_dtype(id_width))
+    blob = bytearray()
+    for record, chunk in zip(records, chunks):
+        data = chunk['text'].encode('utf-8')
+        record['chunk_id'] = chunk['id'].encode('utf-8')
+        record['faiss_id'] = faiss_id(chunk['id'])
+        record['source'] = source_id(chunk.get('source', ''))
+        record['page'] = chunk.get('page') or 1
+        record['text_offset'] = offset + len(blob)
+        record['text_length'] = len(data)
+        blob.extend(data)
+    return records, blob
+
+
+def concat_records(parts):
+    width = max(part.dtype['chunk_id'].itemsize for part in parts)
+    return np.concatenate([part.astype(record_dtype(width)) for part in parts])
+
+
+class MetadataStore:
+    """Метаданные чанков: записи фиксированной ширины + общий UTF-8 блоб текстов через mmap.
+    Текст чанка декодируется только при обращении к нему."""
+
+    def __init__(self, records=None, blob=b"", sources=None):
+        self.records = records if records is not None else np.empty(0, dtype=record_dtype(32))
+        self.blob = blob
+        self.extra = bytearray()   # тексты, добавленные после загрузки, идут после блоба
+        self.sources = sources if sources is not None else []
+        self._source_ids = {source: i for i, source in enumerate(self.sources)}
+        self.references = {}   # id чанка -> [{'id', 'source', 'page'}] схлопнутых в него почти-дубликатов
+        self._file = None
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        store = cls()
+        store.extend(chunks)
+        return store
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, SOURCES_FILE), 'r', encoding='utf-8') as f:
+            sources = json.load(f)
+        records = np.load(os.path.join(path, RECORDS_FILE), mmap_mode='r')
+        store = cls(records, b"", sources)
+        references_path = os.path.join(path, REFERENCES_FILE)
+        if os.path.exists(references_path):
+            with open(references_path, 'r', encoding='utf-8') as f:
+                store.references = json.load(f)
+        texts_path = os.path.join(path, TEXTS_FILE)
+        if os.path.getsize(texts_path):
+            store._file = open(texts_path, 'rb')
+            store.blob = mmap.mmap(store._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return store
+
+    @staticmethod
+    def exists(path):
+        return all(os.path.exists(os.path.join(path, name)) for name in (RECORDS_FILE, TEXTS_FILE, SOURCES_FILE))
+
+    def save(self, path):
+        """Запись с уплотнением: в блоб попадают только тексты живых записей"""
+        os.makedirs(path, exist_ok=True)
+        records = self.records = np.array(self.records)
+        with open(os.path.join(path, TEXTS_FILE + ".tmp"), 'wb') as f:
+            offset = 0
+            for record in records:
+                data = self._text_bytes(record['text_offset'], record['text_length'])
+                f.write(data)
+                record['text_offset'] = offset
+                offset += len(data)
+        np.save(os.path.join(path, RECORDS_FILE + ".tmp.npy"), records)
+        with open(os.path.join(path, SOURCES_FILE + ".tmp"), 'w', encoding='utf-8') as f:
+            json.dump(self.sources, f, ensure_ascii=False)
+        self.save_references(path)
+
+        # Перед заменой файлов освобождаем старый mmap (иначе Windows не даст их перезаписать)
+        self.close()
+        os.replace(os.path.join(path, TEXTS_FILE + ".tmp"), os.path.join(path, TEXTS_FILE))
+        os.replace(os.path.join(path, RECORDS_FILE + ".tmp.npy"), os.path.join(path, RECORDS_FILE))
+        os.replace(os.path.join(path, SOURCES_FILE + ".tmp"), os.path.join(path, SOURCES_FILE))
+
+        reloaded = MetadataStore.load(path)
+        self.records, self.blob, self._file = reloaded.records, reloaded.blob, reloaded._file
+        self.extra = bytearray()
+
+    def save_references(self, path):
+        """Ссылки на дубликаты сохраняются только для живых чанков"""
+        live = set(self.ids)
+        self.references = {cid: refs for cid, refs in self.references.items() if cid in live and refs}
+        with open(os.path.join(path, REFERENCES_FILE + ".tmp"), 'w', encoding='utf-8') as f:
+            json.dump(self.references, f, ensure_ascii=False)
+        os.replace(os.path.join(path, REFERENCES_FILE + ".tmp"), os.path.join(path, REFERENCES_FILE))
+
+    def add_references(self, references):
+        for cid, refs in references.items():
+            self.references.setdefault(cid, []).extend(refs)
+
+    def drop_references(self, sources):
+        """Удаление ссылок на дубликаты из указанных файлов (удалённых или переразбираемых)"""
+        sources = {os.path.normpath(source) for source in sources}
+        for cid in list(self.references):
+            refs = [ref for ref in self.references[cid] if os.path.normpath(ref['source']) not in sources]
+            if refs:
+                self.references[cid] = refs
+            else:
+                del self.references[cid]
+
+    def load_into_memory(self):
+        records, blob = np.array(self.records), bytes(self.blob)
+        file = self._file
+        self.records, self.blob, self._file = records, blob, None
+        if file is not None:
+            file.close()
+
+    def close(self):
+        if isinstance(self.blob, mmap.mmap):
+            self.blob.close()
+        if self._file is not None:
+            self._file.close()
+        self.blob, self._file = b"", None
+
+    def extend(self, chunks):
+        chunks = list(chunks)
+        if not chunks:
+            return
+        new_records, data = build_records(chunks, self._source_id, len(self.blob) + len(self.extra))
+        self.extra.extend(data)
+        self.records = concat_records([self.records, new_records])
+
+    def select(self, positions):
+        """Новое хранилище из записей по позициям; тексты не копируются"""
+        store = MetadataStore(self.records[np.asarray(positions, dtype=np.int64)], self.blob, self.sources)
+        store.extra = self.extra
+        store.references = self.references
+        store._file = self._file
+        return store
+
+    @property
+    def ids(self):
+        return [chunk_id.decode('utf-8') for chunk_id in self.records['chunk_id']]
+
+    @property
+    def faiss_ids(self):
+        return np.asarray(self.records['faiss_id'], dtype=np.int64)
+
+    def positions_for_source(self, source):
+        source_id = self._source_ids.get(source)
+        if source_id is None:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(self.records['source'] == source_id)
+
+    def text(self, pos):
+        record = self.records[pos]
+        return self._text_bytes(record['text_offset'], record['text_length']).decode('utf-8')
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, pos):
+        record = self.records[pos]
+        chunk = {
+            'id': record['chunk_id'].decode('utf-8'),
+            'text': self.text(pos),
+            'source': self.sources[record['source']],
+            'page': int(record['page']),
+        }
+        if chunk['id'] in self.references:
+            chunk['also_in'] = self.references[chunk['id']]
+        return chunk
+
+    def __iter__(self):
+        for pos in range(len(self)):
+            yield self[pos]
+
+    def _text_bytes(self, offset, length):
+        offset, length = int(offset), int(length)
+        base = len(self.blob)
+        if offset >= base:
+            return bytes(self.extra[offset - base:offset - base + length])
+        return self.blob[offset:offset + length]
+
+    def _source_id(self, source):
+        if source not in self._source_ids:
+            self._source_ids[source] = len(self.sources)
+            self.sources.append(source)
+        return self._source_ids[source]
+
+
+class MetadataWriter:
+    """Потоковая запись хранилища: тексты пачек сразу уходят на диск, в памяти только записи"""
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._texts = open(os.path.join(path, TEXTS_FILE + ".tmp"), 'wb')
+        self._offset = 0
+        self._records = []
+        self._sources = []
+        self._source_ids = {}
+
+    def add(self, chunks):
+        records, data = build_records(chunks, self._source_id, self._offset)
+        self._texts.write(data)
+        self._offset += len(data)
+        self._records.append(records)
+
+    def __len__(self):
+        return sum(len(records) for records in self._records)
+
+    def finish(self):
+        self._texts.close()
+        records = concat_records(self._records) if self._records else np.empty(0, dtype=record_dtype(32))
+        np.save(os.path.join(self.path, RECORDS_FILE + ".tmp.npy"), records)
+        with open(os.path.join(self.path, SOURCES_FILE + ".tmp"), 'w', encoding='utf-8') as f:
+            json.dump(self._sources, f, ensure_ascii=False)
+        os.replace(os.path.join(self.path, TEXTS_FILE + ".tmp"), os.path.join(self.path, TEXTS_FILE))
+        os.replace(os.path.join(self.path, RECORDS_FILE + ".tmp.npy"), os.path.join(self.path, RECORDS_FILE))
+        os.replace(os.path.join(self.path, SOURCES_FILE + ".tmp"), os.path.join(self.path, SOURCES_FILE))
+        # Ссылки на дубликаты от прежнего индекса к новым записям не относятся
+        if os.path.exists(os.path.join(self.path, REFERENCES_FILE)):
+            os.remove(os.path.join(self.path, REFERENCES_FILE))
+        return MetadataStore.load(self.path)
+
+    def _source_id(self, source):
+        if source not in self._source_ids:
+            self._source_ids[source] = len(self._sources)
+            self._sources.append(source)
+        return self._source_ids[source]
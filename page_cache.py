@@ -0,0 +1,77 @@
+import os
+import json
+
+
+class PageCache:
+    """Тексты страниц PDF по (хэш файла, номер страницы). Смена нарезки или переименование файла
+    не требуют повторного разбора: страницы берутся отсюда. Размер ограничен max_mb: prune()
+    удаляет давно не читанные файлы (чтение обновляет mtime)."""
+
+    def __init__(self, cache_dir, max_mb=None):
+        self.cache_dir = cache_dir
+        self.max_mb = max_mb
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+
+    def get(self, file_hash, source):
+        path = self._path(file_hash)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return [{'text': text, 'source': source, 'page': number} for number, text in data['pages']]
+
+    def put(self, file_hash, pages):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(file_hash)
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump({'pages': [[page['page'], page['text']] for page in pages]}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def prune(self):
+        """Удаление самых давно использованных файлов, пока кэш не уложится в max_mb"""
+        if not self.max_mb:
+            return 0
+        entries = []
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return 0
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        limit = self.max_mb * 1024 * 1024
+        removed = 0
+        for _, size, name in sorted(entries):
+            if total <= limit:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self.pruned += removed
+        return removed
+
+    def report(self):
+        if self.hits or self.misses:
+            pruned = f", вытеснено файлов {self.pruned}" if self.pruned else ""
+            print(f"📄 Кэш страниц PDF: попаданий {self.hits}, промахов {self.misses}{pruned}")
+
+    def _path(self, file_hash):
+        return os.path.join(self.cache_dir, f"{file_hash}.json")
@@ -0,0 +1,149 @@
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import config
+
+_worker_model = None
+
+
+def adaptive_batches(texts, max_chars=16384, max_batch=256):
+    """Номера текстов, разбитые на пачки по убыванию длины: в пачке тексты близкой длины
+    (меньше паддинга), короткие идут большими пачками, длинные - маленькими"""
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+    batches, batch = [], []
+    for i in order:
+        # Первый текст пачки самый длинный, до него паддятся все остальные
+        width = len(texts[batch[0]]) if batch else len(texts[i])
+        if batch and (len(batch) >= max_batch or (len(batch) + 1) * max(width, 1) > max_chars):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _init_worker(model_name, quantize, num_threads):
+    global _worker_model
+    from retrieval_system import RetrievalSystem
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    # Кэш эмбеддингов ведёт основной процесс, воркеру он не нужен
+    config.SYSTEM_CONFIG['retrieval']['embedding_cache_dir'] = None
+    # Загрузка (офлайн, повторы, int8) та же, что и в основном процессе
+    _worker_model = RetrievalSystem(model_name, quantize, num_threads).model
+
+
+def _encode_batch(texts):
+    return np.asarray(_worker_model.encode(texts, batch_size=len(texts), show_progress_bar=False),
+                      dtype=np.float32)
+
+
+class ParallelEncoder:
+    """Пул процессов, в каждом своя копия энкодера с фиксированным числом потоков torch.
+    Тексты сортируются по длине, режутся на пачки адаптивного размера и раздаются процессам,
+    эмбеддинги собираются в исходном порядке."""
+
+    def __init__(self, model_name, workers=None, threads_per_worker=None, quantize=False,
+                 max_chars=16384, max_batch=256):
+        self.workers = workers or os.cpu_count() or 1
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.workers)
+        self.max_chars = max_chars
+        self.max_batch = max_batch
+        # spawn вместо fork: форк процесса с уже запущенными потоками torch может зависнуть
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker, initargs=(model_name, quantize, self.threads_per_worker))
+
+    @classmethod
+    def from_config(cls, model_name, quantize=False, workers=None):
+        retrieval_config = config.SYSTEM_CONFIG['retrieval']
+        return cls(model_name, workers or retrieval_config.get('encode_workers'),
+                   retrieval_config.get('encode_threads_per_worker'), quantize,
+                   retrieval_config.get('encode_max_chars', 16384))
+
+    def encode(self, texts):
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        batches = adaptive_batches(texts, self.max_chars, self.max_batch)
+        results = self._executor.map(_encode_batch, [[texts[i] for i in batch] for batch in batches])
+
+        embeddings = None
+        for batch, batch_embeddings in zip(batches, results):
+            if embeddings is None:
+                embeddings = np.empty((len(texts), batch_embeddings.shape[1]), dtype=np.float32)
+            embeddings[batch] = batch_embeddings
+        return embeddings
+
+    def warm_up(self):
+        """Запуск всех процессов и загрузка в них энкодера до первых настоящих пачек"""
+        list(self._executor.map(_encode_batch, [["прогрев"]] * self.workers))
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_texts(n_texts):
+    """Тексты чанков текущего индекса, а без индекса - синтетический корпус бенчмарка"""
+    from metadata_store import MetadataStore
+    index_path = config.SYSTEM_CONFIG['paths']['vector_db']
+    if MetadataStore.exists(index_path):
+        store = MetadataStore.load(index_path)
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(store), min(n_texts, len(store)), replace=False)
+        texts = [store.text(pos) for pos in sample]
+        store.close()
+        return texts
+    from retrieval_benchmark import synthetic_chunks
+    return [chunk['text'] for chunk in synthetic_chunks(n_texts)]
+
+
+def scaling_report(worker_counts=(1, 2, 4, 8), n_texts=2000, repeats=2):
+    """Скорость кодирования в одном процессе и в пулах разного размера"""
+    from retrieval_system import RetrievalSystem
+    model_name = config.SYSTEM_CONFIG['retrieval']['model']
+    quantize = config.SYSTEM_CONFIG['retrieval'].get('quantize', False)
+    texts = load_texts(n_texts)
+    print(f"📄 Текстов: {len(texts)}, ядер: {os.cpu_count()}")
+
+    model = RetrievalSystem(model_name, quantize).model
+    model.encode(texts[:32], batch_size=32)
+    start = time.perf_counter()
+    baseline = model.encode(texts, batch_size=32, show_progress_bar=False)
+    single = time.perf_counter() - start
+    baseline = baseline / np.linalg.norm(baseline, axis=1, keepdims=True)
+
+    print(f"\n{'процессов':>10}{'потоков':>9}{'текстов/с':>11}{'ускорение':>11}{'на процесс':>12}{'косинус':>9}")
+    print(f"{'без пула':>10}{'':>9}{len(texts) / single:>11.1f}{1:>11.2f}{1:>12.2f}{1:>9.4f}")
+    for workers in worker_counts:
+        with ParallelEncoder(model_name, workers, quantize=quantize) as encoder:
+            encoder.warm_up()
+            best, embeddings = None, None
+            for _ in range(repeats):
+                start = time.perf_counter()
+                embeddings = encoder.encode(texts)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            threads = encoder.threads_per_worker
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        cosine = float(np.sum(embeddings * baseline, axis=1).min())
+        speedup = single / best
+        print(f"{workers:>10}{threads:>9}{len(texts) / best:>11.1f}{speedup:>11.2f}"
+              f"{speedup / workers:>12.2f}{cosine:>9.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Масштабирование кодирования по числу процессов")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument("--texts", type=int, default=2000, help="число текстов")
+    args = parser.parse_args()
+    scaling_report(args.workers, args.texts)
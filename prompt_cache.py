@@ -0,0 +1,105 @@
+import copy
+import config
+
+
+def common_prefix(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class PromptCache:
+    """KV-кэш начала промпта для LocalLLM. Системный промпт прогоняется через модель один раз
+    при загрузке, и generate каждого вопроса считает prefill только для остатка промпта.
+    С reuse_turns кэш последнего запроса тоже запоминается: уточняющий вопрос в том же диалоге
+    берёт из него всё совпадающее начало (системный промпт, историю, прошлый вопрос)."""
+
+    def __init__(self, model, tokenizer, system_prompt=None, reuse_turns=True):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.reuse_turns = reuse_turns
+        self.system_prompt = None
+        self.system_entry = None    # (id токенов, кэш) системного промпта - не меняется
+        self.turn_entry = None      # то же для последнего запроса
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+        self.last = (0, 0)          # (взято из кэша, всего токенов) последнего запроса
+        if system_prompt:
+            self.warm(system_prompt)
+
+    @classmethod
+    def from_config(cls, model, tokenizer, system_prompt):
+        llm_config = config.SYSTEM_CONFIG.get('llm', {})
+        if not llm_config.get('prefix_cache', True):
+            return None
+        return cls(model, tokenizer, system_prompt, llm_config.get('reuse_turn_cache', True))
+
+    def warm(self, system_prompt):
+        """Prefill системного промпта; вызывается при загрузке модели"""
+        import torch
+        from transformers import DynamicCache
+
+        ids = self.tokenizer(system_prompt)['input_ids']
+        cache = DynamicCache()
+        with torch.no_grad():
+            self.model(input_ids=torch.tensor([ids], device=self.model.device), past_key_values=cache, use_cache=True)
+        self.system_prompt = system_prompt
+        self.system_entry = (ids, cache)
+        self.turn_entry = None
+        print(f"♻️ Системный промпт закэширован: {len(ids)} токенов")
+
+    def tokenize(self, prompt):
+        # Системный промпт токенизируется отдельно, чтобы граница токенов совпала с закэшированной
+        if self.system_entry is not None and prompt.startswith(self.system_prompt):
+            rest = self.tokenizer(prompt[len(self.system_prompt):], add_special_tokens=False)['input_ids']
+            return list(self.system_entry[0]) + list(rest)
+        return self.tokenizer(prompt)['input_ids']
+
+    def prepare(self, prompt):
+        """Аргументы generate для prompt: полные input_ids и копия кэша самого длинного совпадающего начала"""
+        import torch
+        from transformers import DynamicCache
+
+        ids = self.tokenize(prompt)
+        best, reused = None, 0
+        for entry in (self.system_entry, self.turn_entry):
+            if entry is None:
+                continue
+            # Хотя бы последний токен промпта модель должна прогнать сама
+            length = min(common_prefix(entry[0], ids), len(ids) - 1, entry[1].get_seq_length())
+            if length > reused:
+                best, reused = entry, length
+
+        inputs = {'input_ids': torch.tensor([ids], device=self.model.device)}
+        inputs['attention_mask'] = torch.ones_like(inputs['input_ids'])
+        if best is not None:
+            # generate дописывает кэш на месте, поэтому в него уходит копия
+            cache = copy.deepcopy(best[1])
+            cache.crop(reused)
+        else:
+            cache = DynamicCache()
+        inputs['past_key_values'] = cache
+
+        self.requests += 1
+        self.prompt_tokens += len(ids)
+        self.reused_tokens += reused
+        self.last = (reused, len(ids))
+        return inputs
+
+    def remember(self, inputs):
+        """Кэш после generate покрывает промпт и ответ; для следующего вопроса хранится он"""
+        if self.reuse_turns:
+            self.turn_entry = (inputs['input_ids'][0].tolist(), inputs['past_key_values'])
+
+    def reset_conversation(self):
+        """Новый диалог (очистка истории): кэш прошлого запроса больше не пригодится"""
+        self.turn_entry = None
+
+    def report(self):
+        reused, total = self.last
+        share = reused / total if total else 0.0
+        print(f"♻️ Prefill: {reused} из {total} токенов промпта из кэша ({share:.0%}), "
+              f"в среднем {self.reused_tokens / max(self.requests, 1):.0f} токенов на запрос")
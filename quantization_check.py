@@ -0,0 +1,56 @@
+import argparse
+import time
+import numpy as np
+import config
+from retrieval_system import RetrievalSystem
+
+
+def measure(retrieval, texts, batch_size=32):
+    start = time.perf_counter()
+    embeddings = retrieval.model.encode(texts, batch_size=batch_size)
+    elapsed = time.perf_counter() - start
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings, elapsed
+
+
+def check_quantization(sample_size=500, num_threads=None, top_k=8):
+    """Сравнение int8-энкодера с fp32 на чанках текущего корпуса: ускорение и дрейф косинуса"""
+    print("🔄 Проверка квантизованного энкодера...")
+    fp32 = RetrievalSystem(quantize=False, num_threads=num_threads)
+    fp32.load_index(config.SYSTEM_CONFIG['paths']['vector_db'])
+
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(fp32.metadata), min(sample_size, len(fp32.metadata)), replace=False)
+    texts = [fp32.metadata.text(pos) for pos in sample]
+
+    int8 = RetrievalSystem(quantize=True, num_threads=num_threads)
+
+    # Прогрев, чтобы не мерить инициализацию
+    measure(fp32, texts[:8])
+    measure(int8, texts[:8])
+
+    fp32_embeddings, fp32_time = measure(fp32, texts)
+    int8_embeddings, int8_time = measure(int8, texts)
+
+    drift = np.sum(fp32_embeddings * int8_embeddings, axis=1)
+
+    # Совпадение соседей: насколько меняется top_k внутри выборки
+    k = min(top_k, len(texts) - 1)
+    fp32_top = np.argsort(-fp32_embeddings @ fp32_embeddings.T, axis=1)[:, 1:k + 1]
+    int8_top = np.argsort(-int8_embeddings @ int8_embeddings.T, axis=1)[:, 1:k + 1]
+    overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(fp32_top, int8_top)]) if k else 1.0
+
+    print(f"\n📊 Текстов: {len(texts)}")
+    print(f"   fp32: {fp32_time:.2f} с ({len(texts) / fp32_time:.1f} текстов/с)")
+    print(f"   int8: {int8_time:.2f} с ({len(texts) / int8_time:.1f} текстов/с)")
+    print(f"   Ускорение: x{fp32_time / int8_time:.2f}")
+    print(f"   Косинус fp32/int8: средний {drift.mean():.4f}, минимальный {drift.min():.4f}")
+    print(f"   Совпадение top-{k} соседей: {overlap:.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Проверка int8-квантизации энкодера на текущем корпусе")
+    parser.add_argument("--sample", type=int, default=500, help="число чанков для сравнения")
+    parser.add_argument("--threads", type=int, default=None, help="число потоков torch")
+    args = parser.parse_args()
+    check_quantization(args.sample, args.threads)
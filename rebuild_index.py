@@ -1,29 +1,299 @@
 import os
-from document_processor import DocumentProcessor
+import argparse
+import ingestion
+from manifest import DocumentManifest
+from dedup import NearDuplicateFilter
 from retrieval_system import RetrievalSystem
+import sharded_index
 import config
 
-def rebuild_index():
+def chunking_settings(splitter, dedup=None):
+    if splitter is None:
+        settings = {'splitter': 'chars', 'chunk_size': 800, 'chunk_overlap': 150}
+    else:
+        settings = {'splitter': 'tokens', 'max_tokens': splitter.max_tokens, 'overlap_tokens': splitter.overlap_tokens}
+    settings['dedup'] = dedup.threshold if dedup is not None else None
+    settings['chunker'] = ingestion.CHUNKER_VERSION
+    return settings
+
+def manifest_settings(index_path):
+    """Настройки нарезки, с которыми построен индекс; None, если манифеста нет или чанки в нём
+    получены другой версией разбора и нарезки - тогда индекс нужно собрать полностью"""
+    if not (os.path.exists(f"{index_path}/faiss.index") and DocumentManifest.exists(index_path)):
+        return None
+    settings = DocumentManifest.load(index_path).settings
+    if not settings or settings.get('chunker') != ingestion.CHUNKER_VERSION:
+        return None
+    return settings
+
+def components_from_settings(settings, retrieval):
+    """Сплиттер и фильтр дубликатов, которыми построен индекс, - для фоновых обновлений"""
+    splitter = None
+    if settings['splitter'] == 'tokens':
+        splitter = ingestion.TokenSplitter.from_encoder(retrieval.model, settings['overlap_tokens'])
+    dedup = NearDuplicateFilter(settings['dedup']) if settings.get('dedup') is not None else None
+    return splitter, dedup
+
+def make_dedup(enabled=None):
+    ingestion_config = config.SYSTEM_CONFIG.get('ingestion', {})
+    if enabled is None:
+        enabled = ingestion_config.get('dedup', True)
+    return NearDuplicateFilter(ingestion_config.get('dedup_threshold', 0.85)) if enabled else None
+
+def save_dedup(retrieval, dedup, index_path):
+    """Ссылки на схлопнутые дубликаты и сигнатуры представителей для следующих обновлений"""
+    retrieval.metadata.references = dict(dedup.references)
+    retrieval.metadata.save_references(index_path)
+    dedup.save(index_path)
+    dedup.report(retrieval.index.d)
+
+def make_splitter(retrieval, token_chunks):
+    """Нарезка по токенам энкодера требует его токенизатор, поэтому модель загружается заранее"""
+    return ingestion.TokenSplitter.from_encoder(retrieval.model) if token_chunks else None
+
+def build_from_paths(paths, index_path, retrieval, splitter=None, dedup=None, workers=None):
+    """Полная сборка индекса из списка файлов потоком, вместе с манифестом. Возвращает файлы с ошибками"""
+    failed = []
+    manifest = DocumentManifest(settings=chunking_settings(splitter, dedup))
+    chunks = (chunk for _, file_chunks in ingestion.iter_file_chunks(paths, chunk_size=800, chunk_overlap=150,
+                                                                     workers=workers, failed=failed,
+                                                                     splitter=splitter, digests=manifest.digests)
+              for chunk in file_chunks)
+    chunks = manifest.track(chunks)
+    retrieval.build_index(dedup.filter(chunks) if dedup else chunks, index_path)
+    if dedup:
+        save_dedup(retrieval, dedup, index_path)
+    manifest.save(index_path)
+    return failed
+
+def rebuild_index_streaming(workers=None, token_chunks=False, dedup=None):
+    """Полное перестроение потоком: загрузка -> нарезка -> эмбеддинги пачками -> индекс.
+    Память не зависит от размера папки с документами"""
+    print("🔄 Потоковое перестроение векторного индекса...")
+    index_path = config.SYSTEM_CONFIG['paths']['vector_db']
+    folder = config.SYSTEM_CONFIG['paths'].get('documents', './data/documents')
+    paths = ingestion.list_documents(folder)
+    print(f"📂 Найдено документов: {len(paths)}")
+    retrieval = RetrievalSystem()
+    splitter = make_splitter(retrieval, token_chunks)
+    failed = build_from_paths(paths, index_path, retrieval, splitter, make_dedup(dedup), workers)
+    print(f"📊 Создано {len(retrieval.metadata)} чанков, файлов с ошибками: {len(failed)}")
+
+def rebuild_sharded(shard=None, workers=None, full=False, token_chunks=False, dedup=None):
+    """Перестроение шардированного индекса. Каждый шард обновляется по своему манифесту;
+    с shard перестраивается только указанная коллекция, остальные шарды не трогаются"""
+    index_path = config.SYSTEM_CONFIG['paths']['vector_db']
+    folder = config.SYSTEM_CONFIG['paths'].get('documents', './data/documents')
+    groups = sharded_index.documents_by_shard(folder)
+    known = set(sharded_index.load_shard_list(index_path)) \
+        if os.path.exists(os.path.join(index_path, sharded_index.SHARDS_FILE)) else set()
+    names = [shard] if shard else sorted(set(groups) | known)
+
+    parent = sharded_index.ShardedRetrievalSystem()
+    splitter = make_splitter(parent, token_chunks)
+    for name in names:
+        path = sharded_index.shard_path(index_path, name)
+        retrieval = parent.new_shard()
+        shard_dedup = make_dedup(dedup)
+        paths = groups.get(name, [])
+        print(f"\n🧩 Шард {name}: документов {len(paths)}")
+        if not paths:
+            sharded_index.remove_shard(index_path, name)
+            known.discard(name)
+            print("🗑️ Документов не осталось, шард удалён")
+            continue
+        if not full and manifest_settings(path) == chunking_settings(splitter, shard_dedup):
+            rebuild_changed(path, workers=workers, splitter=splitter, retrieval=retrieval, dedup=shard_dedup,
+                            paths=paths)
+        else:
+            failed = build_from_paths(paths, path, retrieval, splitter, shard_dedup, workers)
+            print(f"📊 Создано {len(retrieval.metadata)} чанков, файлов с ошибками: {len(failed)}")
+        known.add(name)
+    sharded_index.save_shard_list(index_path, known)
+
+def refresh_shards(live, index_path, workers=None, folder=None):
+    """Фоновое обновление шардированного индекса: новый экземпляр, в котором заменены только
+    изменившиеся шарды, или None, если менять нечего"""
+    folder = folder or config.SYSTEM_CONFIG['paths'].get('documents', './data/documents')
+    groups = sharded_index.documents_by_shard(folder)
+    updated = live.clone()
+    changed = False
+    for name in sorted(set(groups) | set(live.shards)):
+        path = sharded_index.shard_path(index_path, name)
+        if name not in groups:
+            del updated.shards[name]
+            sharded_index.remove_shard(index_path, name)
+            changed = True
+            continue
+
+        shard = live.shards[name].clone() if name in live.shards else updated.new_shard()
+        settings = manifest_settings(path)
+        if settings is not None:
+            splitter, dedup = components_from_settings(settings, shard)
+            if not rebuild_changed(path, workers=workers, splitter=splitter, retrieval=shard, dedup=dedup,
+                                   paths=groups[name]):
+                continue
+        else:
+            # Новая коллекция собирается с настройками уже существующих шардов
+            other = next((manifest_settings(sharded_index.shard_path(index_path, n)) for n in live.shards), None)
+            splitter, dedup = components_from_settings(other or chunking_settings(None, make_dedup()), shard)
+            build_from_paths(groups[name], path, shard, splitter, dedup, workers)
+        updated.shards[name] = shard
+        changed = True
+
+    if not changed:
+        return None
+    sharded_index.save_shard_list(index_path, updated.shards)
+    return updated
+
+def affected_by_dedup(metadata, manifest, changes):
+    """Неизменённые файлы, у которых есть дубликаты в удаляемых чанках. Они переводятся в changed,
+    пока таких файлов не останется: иначе их текст пропадёт из индекса вместе с представителем"""
+    affected = []
+    unchanged = {os.path.normpath(path): path for path in changes['unchanged']}
+    while True:
+        removed = set(manifest.chunk_ids(changes['changed'] + changes['removed']))
+        sources = {os.path.normpath(ref['source']) for cid in removed & metadata.references.keys()
+                   for ref in metadata.references[cid]}
+        paths = [unchanged.pop(source) for source in sources if source in unchanged]
+        if not paths:
+            return affected
+        changes['changed'].extend(paths)
+        changes['unchanged'] = list(unchanged.values())
+        affected.extend(paths)
+
+def rebuild_changed(index_path, workers=None, splitter=None, retrieval=None, dedup=None, paths=None):
+    """Обновление по манифесту: разбираются только новые и изменённые файлы,
+    чанки изменённых и удалённых файлов вычищаются из индекса. True, если индекс изменился"""
+    if isinstance(retrieval, sharded_index.ShardedRetrievalSystem):
+        raise ValueError("rebuild_changed обновляет один индекс с манифестом; шардированный индекс "
+                         "обновляется через rebuild_sharded (или refresh_shards в фоне)")
+    folder = config.SYSTEM_CONFIG['paths'].get('documents', './data/documents')
+    manifest = DocumentManifest.load(index_path)
+    changes = manifest.scan(ingestion.list_documents(folder) if paths is None else paths)
+    print(f"📋 Файлы: новых {len(changes['added'])}, изменённых {len(changes['changed'])}, "
+          f"удалённых {len(changes['removed'])}, без изменений {len(changes['unchanged'])}")
+    for kind, mark in (('added', '+'), ('changed', '~'), ('removed', '-')):
+        for path in changes[kind]:
+            print(f"   {mark} {os.path.basename(path)}")
+
+    if not (changes['added'] or changes['changed'] or changes['removed']):
+        manifest.save(index_path)
+        print("✅ Документы не изменились, индекс актуален")
+        return False
+
+    retrieval = retrieval or RetrievalSystem()
+    retrieval.load_index(index_path)
+    if dedup:
+        # Файлы, чьи дубликаты схлопнуты в удаляемые чанки, разбираются заново вместе с изменёнными
+        for path in affected_by_dedup(retrieval.metadata, manifest, changes):
+            print(f"   ~ {os.path.basename(path)} (дубликаты удаляемых чанков)")
+        retrieval.metadata.drop_references(changes['changed'] + changes['removed'])
+
+    remove_ids = manifest.chunk_ids(changes['changed'] + changes['removed'])
+    for path in changes['removed']:
+        manifest.forget(path)
+
+    add_chunks = []
+    failed = []
+    for path, chunks in ingestion.iter_file_chunks(changes['added'] + changes['changed'],
+                                                   chunk_size=800, chunk_overlap=150,
+                                                   workers=workers, failed=failed, splitter=splitter,
+                                                   digests=manifest.digests):
+        add_chunks.extend(chunks)
+        manifest.record(path, [chunk['id'] for chunk in chunks])
+    # Изменённый файл, который не удалось разобрать, выпадает из индекса и манифеста до исправления
+    for path in failed:
+        manifest.forget(path)
+
+    if not add_chunks and not remove_ids:
+        manifest.save(index_path)
+        print(f"✅ Индекс актуален, файлов с ошибками: {len(failed)}")
+        return False
+
+    if dedup:
+        dedup.load(index_path, drop_ids=remove_ids)
+        add_chunks = list(dedup.filter(add_chunks))
+        retrieval.metadata.add_references(dedup.references)
+    added, removed = retrieval.update_index(index_path, add_chunks=add_chunks, remove_ids=remove_ids)
+    if dedup:
+        dedup.save(index_path)
+        dedup.report(retrieval.index.d)
+    manifest.save(index_path)
+    print(f"📊 Чанков добавлено {added}, удалено {removed}, файлов с ошибками: {len(failed)}")
+    return True
+
+def rebuild_index(incremental=False, workers=None, full=False, token_chunks=False, dedup=None):
     """Перестроение векторного индекса с улучшенными настройками"""
+    if sharded_index.shard_config():
+        # У шардов свои манифесты и папки: общий индекс здесь не строится
+        print("🧩 В конфиге включены шарды, перестроение по шардам")
+        rebuild_sharded(workers=workers, full=full, token_chunks=token_chunks, dedup=dedup)
+        return
+    index_path = config.SYSTEM_CONFIG['paths']['vector_db']
+    retrieval = RetrievalSystem()
+    splitter = make_splitter(retrieval, token_chunks)
+    dedup = make_dedup(dedup)
+    settings = manifest_settings(index_path)
+    if not full and settings is not None:
+        if settings == chunking_settings(splitter, dedup):
+            print("🔄 Обновление векторного индекса по манифесту документов...")
+            rebuild_changed(index_path, workers=workers, splitter=splitter, retrieval=retrieval, dedup=dedup)
+            return
+        print("⚠️ Изменились параметры нарезки, индекс будет перестроен полностью")
+        incremental = False
+
     print("🔄 Перестроение векторного индекса с улучшенными настройками...")
     
-    # Создаем процессор с улучшенными настройками
-    processor = DocumentProcessor(
-        chunk_size=800,   # Меньшие чанки для лучшего качества
-        chunk_overlap=150
-    )
-    
-    # Обрабатываем документы заново
-    chunks = processor.process_documents()
-    
+    # Тот же разбор и нарезка, что у инкрементальных обновлений: id чанков в манифесте совпадут
+    manifest = DocumentManifest(settings=chunking_settings(splitter, dedup))
+    chunks = ingestion.process_documents(chunk_size=800, chunk_overlap=150, workers=workers, splitter=splitter,
+                                         digests=manifest.digests)
+
     if chunks:
-        print("🔨 Построение улучшенного векторного индекса...")
-        retrieval = RetrievalSystem()
-        retrieval.build_index(chunks, config.SYSTEM_CONFIG['paths']['vector_db'])
-        print("✅ Улучшенный индекс успешно построен!")
+        unique_chunks = list(dedup.filter(chunks)) if dedup else chunks
+        if incremental and os.path.exists(f"{index_path}/faiss.index"):
+            # Перекодируются только новые и изменённые чанки
+            print("🔨 Инкрементальное обновление векторного индекса...")
+            retrieval.load_index(index_path)
+            added, removed = retrieval.sync_chunks(unique_chunks, index_path)
+            print(f"✅ Индекс обновлён: добавлено {added}, удалено {removed} чанков")
+        else:
+            print("🔨 Построение улучшенного векторного индекса...")
+            retrieval.build_index(unique_chunks, index_path)
+            print("✅ Улучшенный индекс успешно построен!")
+        if dedup:
+            save_dedup(retrieval, dedup, index_path)
+        folder = config.SYSTEM_CONFIG['paths'].get('documents', './data/documents')
+        manifest.record_chunks(ingestion.list_documents(folder), chunks)
+        manifest.save(index_path)
         print(f"📊 Создано {len(chunks)} чанков")
     else:
         print("❌ Не удалось обработать документы")
 
 if __name__ == "__main__":
-    rebuild_index()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Перестроение векторного индекса")
+    parser.add_argument("--incremental", action="store_true",
+                        help="обновить существующий индекс, перекодируя только изменённые чанки")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="разбирать документы параллельно в N процессах")
+    parser.add_argument("--full", action="store_true",
+                        help="игнорировать манифест и разобрать все документы заново")
+    parser.add_argument("--token-chunks", action="store_true",
+                        help="резать документы по токенам энкодера, а не по символам")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="не схлопывать почти одинаковые чанки")
+    parser.add_argument("--shard", default=None,
+                        help="перестроить только указанный шард (коллекцию) шардированного индекса")
+    parser.add_argument("--stream", action="store_true",
+                        help="полное перестроение потоком с ограниченным расходом памяти")
+    args = parser.parse_args()
+    if args.shard or config.SYSTEM_CONFIG['retrieval'].get('shards'):
+        rebuild_sharded(shard=args.shard, workers=args.workers, full=args.full,
+                        token_chunks=args.token_chunks, dedup=False if args.no_dedup else None)
+    elif args.stream:
+        rebuild_index_streaming(workers=args.workers, token_chunks=args.token_chunks,
+                                dedup=False if args.no_dedup else None)
+    else:
+        rebuild_index(incremental=args.incremental, workers=args.workers, full=args.full,
+                      token_chunks=args.token_chunks, dedup=False if args.no_dedup else None)
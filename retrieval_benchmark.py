@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import config
+from retrieval_system import RetrievalSystem
+from llm_streaming import stream_question
+
+SIZES = (1000, 10000, 100000)
+SYLLABLES = ("ка", "ро", "ни", "те", "ла", "мо", "ст", "ви", "за", "пр", "об", "ге",
+             "ду", "ре", "на", "по", "ти", "ко", "ве", "ль", "ми", "со", "да", "ру")
+QUESTIONS = [
+    "Как полностью называется документ с обозначением РБ-089-14?",
+    "Какие требования к сварке?",
+    "Что такое НП-045-18?",
+]
+
+
+def vocabulary(rng, size, min_syllables=2, max_syllables=4):
+    words = set()
+    while len(words) < size:
+        count = rng.integers(min_syllables, max_syllables + 1)
+        words.add("".join(rng.choice(SYLLABLES, count)))
+    return sorted(words)
+
+
+def synthetic_chunks(n_chunks, seed=0, words_per_chunk=120, topics=50, chunks_per_page=4, pages_per_doc=20):
+    """Детерминированный корпус: у каждого документа своя тема, чанки - смесь слов темы и общей лексики,
+    в части чанков есть обозначения документов вида НП-012-15 для проверки поиска по коду"""
+    rng = np.random.default_rng(seed)
+    common = vocabulary(rng, 3000)
+    topic_words = [vocabulary(rng, 60, 3, 5) for _ in range(topics)]
+    per_doc = chunks_per_page * pages_per_doc
+
+    for i in range(n_chunks):
+        doc, offset = divmod(i, per_doc)
+        topic = topic_words[doc % topics]
+        n_topic = words_per_chunk * 3 // 5
+        words = list(rng.choice(topic, n_topic)) + list(rng.choice(common, words_per_chunk - n_topic))
+        rng.shuffle(words)
+        if rng.random() < 0.1:
+            words.insert(rng.integers(len(words)), f"НП-{rng.integers(1, 1000):03d}-{rng.integers(10, 24)}")
+        # Только первая буква: capitalize() перевёл бы в нижний регистр и обозначения (НП- -> Нп-)
+        words[0] = words[0][:1].upper() + words[0][1:]
+        yield {
+            'text': " ".join(words) + ".",
+            'source': os.path.join("synthetic", f"doc{doc:05d}.pdf"),
+            'page': offset // chunks_per_page + 1,
+        }
+
+
+def synthetic_queries(retrieval, n_queries, seed=1, words=8):
+    """Запросы - случайные слова из случайных чанков индекса; чанк-источник считается правильным ответом"""
+    rng = np.random.default_rng(seed)
+    positions = rng.choice(len(retrieval.metadata), min(n_queries, len(retrieval.metadata)), replace=False)
+    queries = []
+    for pos in positions:
+        chunk = retrieval.metadata[pos]
+        tokens = chunk['text'].rstrip('.').split()
+        codes = [token for token in tokens if token.startswith("НП-")]
+        if codes and rng.random() < 0.5:
+            query = codes[0]
+        else:
+            query = " ".join(rng.choice(tokens, min(words, len(tokens)), replace=False))
+        queries.append((query, chunk['id']))
+    return queries
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса; None там, где модуля resource нет (Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    return round(rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024, 1)
+
+
+def percentiles(seconds):
+    ms = np.array(seconds) * 1000
+    return {'p50_ms': round(float(np.percentile(ms, 50)), 3),
+            'p95_ms': round(float(np.percentile(ms, 95)), 3),
+            'p99_ms': round(float(np.percentile(ms, 99)), 3),
+            'mean_ms': round(float(ms.mean()), 3)}
+
+
+def benchmark_size(n_chunks, n_queries=200, workdir=None, use_cache=False, seed=0):
+    """Все замеры для корпуса из n_chunks чанков; вызывается в отдельном процессе, чтобы пиковый RSS
+    относился к одному размеру"""
+    top_k = config.SYSTEM_CONFIG['retrieval']['top_k']
+    threshold = config.SYSTEM_CONFIG['retrieval']['similarity_threshold']
+    result = {'chunks': n_chunks}
+
+    built = RetrievalSystem()
+    if not use_cache:
+        # Кэш эмбеддингов превратил бы повторный прогон в замер чтения с диска
+        built.embedding_cache = None
+    start = time.perf_counter()
+    built.model.encode(["прогрев"])
+    result['model_load_s'] = round(time.perf_counter() - start, 3)
+    result['rss_after_model_mb'] = peak_rss_mb()
+
+    with tempfile.TemporaryDirectory(dir=workdir) as index_path:
+        start = time.perf_counter()
+        built.build_index(synthetic_chunks(n_chunks, seed), index_path)
+        elapsed = time.perf_counter() - start
+        result['build_s'] = round(elapsed, 3)
+        result['build_chunks_per_s'] = round(n_chunks / elapsed, 1)
+        result['index_mb'] = round(sum(entry.stat().st_size for entry in os.scandir(index_path)
+                                       if entry.is_file()) / 1024 / 1024, 2)
+
+        retrieval = built.clone()
+        start = time.perf_counter()
+        retrieval.load_index(index_path)
+        result['load_s'] = round(time.perf_counter() - start, 3)
+
+        queries = synthetic_queries(retrieval, n_queries)
+        for query, _ in queries[:10]:
+            retrieval.search_batch([query], top_k, threshold)
+
+        # search_batch вместо search: в замер не должен попадать вывод в консоль
+        search_times, confidence_times, hits = [], [], 0
+        for query, expected in queries:
+            start = time.perf_counter()
+            chunks = retrieval.search_batch([query], top_k, threshold)[0]
+            search_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            retrieval.calculate_confidence(query, chunks)
+            confidence_times.append(time.perf_counter() - start)
+            hits += any(chunk['id'] == expected for chunk in chunks)
+
+        # Повтор тех же запросов пачкой, без кэша запросов из одиночного прогона
+        retrieval.clear_query_cache()
+        start = time.perf_counter()
+        retrieval.search_batch([query for query, _ in queries], top_k, threshold)
+        batch_elapsed = time.perf_counter() - start
+
+        result['search'] = percentiles(search_times)
+        result['search_batch_qps'] = round(len(queries) / batch_elapsed, 1)
+        result['confidence'] = percentiles(confidence_times)
+        result['hit_rate'] = round(hits / len(queries), 4)
+        result['queries'] = len(queries)
+        result['peak_rss_mb'] = peak_rss_mb()
+        # Отпускаем mmap файлов индекса, иначе на Windows временную папку не удалить
+        retrieval.detach_files()
+        built.detach_files()
+    return result
+
+
+def benchmark_rag(questions=QUESTIONS):
+    """Полный путь вопрос -> ответ через RAGSystem на текущем индексе, включая LLM"""
+    try:
+        from rag_system import RAGSystem
+    except ImportError as e:
+        print(f"⚠️ Сквозной замер пропущен: {e}")
+        return None
+
+    system = RAGSystem()
+    start = time.perf_counter()
+    if not system.initialize_system():
+        print("❌ Не удалось инициализировать систему")
+        return None
+    init_s = time.perf_counter() - start
+
+    # Главная метрика для чата - время до первого токена: дальше ответ уже виден пользователю
+    first_token, total = [], []
+    for question in questions:
+        stream = stream_question(system, question)
+        for _ in stream:
+            pass
+        first_token.append(stream.first_token_s if stream.first_token_s is not None else stream.total_s)
+        total.append(stream.total_s)
+    return {'first_token': percentiles(first_token), 'answer': percentiles(total), 'init_s': round(init_s, 3),
+            'questions': len(questions), 'peak_rss_mb': peak_rss_mb()}
+
+
+def run_benchmarks(sizes=SIZES, n_queries=200, workdir=None, use_cache=False, rag=False):
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'retrieval': {key: config.SYSTEM_CONFIG['retrieval'].get(key)
+                      for key in ('model', 'index_type', 'hybrid_search', 'quantize', 'num_threads', 'top_k')},
+        'sizes': [],
+    }
+    for n_chunks in sizes:
+        print(f"\n📏 Корпус: {n_chunks} чанков")
+        # Новый процесс на каждый размер: иначе пиковый RSS копится от прогона к прогону
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            report['sizes'].append(executor.submit(benchmark_size, n_chunks, n_queries, workdir, use_cache).result())
+    if rag:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            report['rag'] = executor.submit(benchmark_rag).result()
+    return report
+
+
+def print_report(report):
+    print(f"\n📊 {report['retrieval']['model']}, индекс {report['retrieval']['index_type']}")
+    print(f"{'чанков':>8}{'сборка/с':>10}{'загрузка':>10}{'p50':>8}{'p95':>8}{'p99':>8}"
+          f"{'conf p50':>10}{'hit':>7}{'RSS МБ':>9}")
+    for row in report['sizes']:
+        search = row['search']
+        print(f"{row['chunks']:>8}{row['build_chunks_per_s']:>10.0f}{row['load_s']:>9.2f}с"
+              f"{search['p50_ms']:>8.1f}{search['p95_ms']:>8.1f}{search['p99_ms']:>8.1f}"
+              f"{row['confidence']['p50_ms']:>10.2f}{row['hit_rate']:>7.2f}{row['peak_rss_mb'] or 0:>9.0f}")
+    if report.get('rag'):
+        rag = report['rag']
+        print(f"\n💬 Первый токен: p50 {rag['first_token']['p50_ms'] / 1000:.2f} с, "
+              f"p95 {rag['first_token']['p95_ms'] / 1000:.2f} с; "
+              f"ответ целиком: p50 {rag['answer']['p50_ms'] / 1000:.2f} с")
+
+
+def compare_reports(previous, current):
+    """Изменение основных метрик относительно прошлого прогона (одинаковые размеры корпуса)"""
+    metrics = [('build_chunks_per_s', 'сборка чанков/с', True), ('load_s', 'загрузка, с', False),
+               ('search.p50_ms', 'поиск p50, мс', False), ('search.p99_ms', 'поиск p99, мс', False),
+               ('confidence.p50_ms', 'уверенность p50, мс', False), ('peak_rss_mb', 'пиковый RSS, МБ', False)]
+    old_rows = {row['chunks']: row for row in previous['sizes']}
+    print(f"\n🔁 Сравнение с прогоном от {previous['created']}")
+    for row in current['sizes']:
+        old = old_rows.get(row['chunks'])
+        if old is None:
+            continue
+        print(f"   {row['chunks']} чанков:")
+        for path, name, higher_is_better in metrics:
+            before, after = old, row
+            for key in path.split('.'):
+                before, after = before.get(key), after.get(key)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            better = change > 0 if higher_is_better else change < 0
+            mark = "✅" if better else "⚠️" if abs(change) > 0.1 else "  "
+            print(f"   {mark} {name}: {before} -> {after} ({change:+.1%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замеры индексации и поиска на синтетическом корпусе")
+    parser.add_argument("--sizes", type=int, nargs='+', default=list(SIZES), help="размеры корпуса в чанках")
+    parser.add_argument("--queries", type=int, default=200, help="число запросов на размер")
+    parser.add_argument("--output", default=None, help="файл для JSON-отчёта (по умолчанию stdout)")
+    parser.add_argument("--compare", default=None, help="JSON-отчёт прошлого прогона для сравнения")
+    parser.add_argument("--workdir", default=None, help="папка для временных индексов")
+    parser.add_argument("--embedding-cache", action="store_true", help="не отключать кэш эмбеддингов")
+    parser.add_argument("--rag", action="store_true", help="сквозной замер RAGSystem на текущем индексе")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.sizes, args.queries, args.workdir, args.embedding_cache, args.rag)
+    print_report(report)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare_reports(json.load(f), report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 Отчёт сохранён: {args.output}")
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
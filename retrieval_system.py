@@ -1,30 +1,187 @@
 import numpy as np
-import faiss
 import json
 import os
-from sentence_transformers import SentenceTransformer
-import torch
-from sklearn.metrics.pairwise import cosine_similarity
-import config
+import itertools
+import numbers
 import time
-import requests
-from urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+import config
+from embedding_cache import EmbeddingCache
+from metadata_store import MetadataStore, MetadataWriter, chunk_id, faiss_id
+from lexical_index import LexicalIndex, is_code_query, query_codes
+
+# torch, sentence-transformers и faiss импортируются при первом использовании:
+# на холодном старте это секунды, а индекс и лексический поиск без них обходятся дольше всего
+
+# Версии индекса уникальны в пределах процесса, в том числе между клонами
+_index_versions = itertools.count(1)
+
+
+def rrf_fuse(*ranked_lists, rrf_k=60):
+    """Reciprocal rank fusion: ключи кандидатов по убыванию суммы 1 / (rrf_k + ранг) по спискам"""
+    fused = defaultdict(float)
+    for ranked in ranked_lists:
+        for rank, key in enumerate(ranked):
+            fused[key] += 1 / (rrf_k + rank + 1)
+    return sorted(fused, key=fused.get, reverse=True)
+
+
+def normalize_rows(vectors):
+    """L2-нормировка строк на месте (как faiss.normalize_L2, но без импорта faiss)"""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return vectors
+
+
+def batched(items, size):
+    """Пачки по size элементов из любого итерируемого, без материализации целиком"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def quantize_encoder(model):
+    """Динамическая int8-квантизация линейных слоёв энкодера для CPU"""
+    import torch
+
+    print("🔧 Квантизация линейных слоёв энкодера в int8...")
+    model = model.to('cpu')
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def print_startup_timings(rag_system, total):
+    """Разбивка времени запуска по этапам для всех RetrievalSystem внутри RAG-системы"""
+    print(f"⏱️ Запуск системы: {total:.2f} с")
+    for value in vars(rag_system).values():
+        if isinstance(value, RetrievalSystem):
+            for stage, seconds in value.timings.items():
+                print(f"   {stage}: {seconds:.2f} с")
 
 
 class RetrievalSystem:
-    def __init__(self, model_name=None):
+    def __init__(self, model_name=None, quantize=None, num_threads=None):
+        retrieval_config = config.SYSTEM_CONFIG['retrieval']
         if model_name is None:
-            model_name = config.SYSTEM_CONFIG['retrieval']['model']
-        
-        print("🔧 Загрузка модели для эмбеддингов...")
-        self.model = self._load_model_with_retry(model_name)
+            model_name = retrieval_config['model']
+        if quantize is None:
+            quantize = retrieval_config.get('quantize', False)
+        if num_threads is None:
+            num_threads = retrieval_config.get('num_threads')
+
+        self.model_name = model_name
+        self.quantized = quantize
+        self.num_threads = num_threads
+        self.offline = retrieval_config.get('offline', False)
+        self.models_dir = retrieval_config.get('models_dir', './data/models')
+        self.timings = OrderedDict()
+        self._model = None
+        self._model_source = None   # экземпляр, у которого клон берёт энкодер, не загружая свой
+        if not retrieval_config.get('lazy_model', True):
+            self._model = self._load_model()
+
+        self.index_type = retrieval_config.get('index_type', 'flat')
+        self.index_params = retrieval_config.get('index_params', {})
+        self.hybrid = retrieval_config.get('hybrid_search', True)
+        # Фильтр, оставляющий не больше стольких чанков, считается точным перебором их векторов
+        self.filter_exact_max = retrieval_config.get('filter_exact_max', 4096)
+        # Больше одного процесса - эмбеддинги при индексации считает пул энкодеров (parallel_encoder.py)
+        self.encode_workers = retrieval_config.get('encode_workers', 1)
+        self.encode_parallel_min = retrieval_config.get('encode_parallel_min', 2000)
+        self._encoder = None
+        self._index_version = 0
+        cache_dir = retrieval_config.get('embedding_cache_dir', './data/embedding_cache')
+        self._embedding_cache = None
+        self._embedding_cache_args = None
+        if cache_dir:
+            # У int8-модели эмбеддинги немного отличаются от fp32, поэтому кэш у неё свой
+            self._embedding_cache_args = (cache_dir, f"{model_name}-int8" if quantize else model_name,
+                                          retrieval_config.get('embedding_cache_max_mb', 2048))
         
         self.index = None
-        self.chunks = []
-        self.metadata = []
+        self.metadata = MetadataStore()
+        self.lexical = None
+        self._id_to_pos = {}
+        self._sorted_faiss_ids = np.empty(0, dtype=np.int64)
+        self._sorted_positions = np.empty(0, dtype=np.int64)
+        self._source_positions = None   # позиции чанков, сгруппированные по источнику (для фильтров)
+        self._query_embeddings = OrderedDict()   # последние запросы -> нормированный эмбеддинг
+
+    @property
+    def model(self):
+        """Энкодер загружается при первом обращении"""
+        if self._model is None:
+            self._model = self._model_source.model if self._model_source is not None else self._load_model()
+        return self._model
+
+    @property
+    def embedding_cache(self):
+        """Кэш эмбеддингов открывается при первой индексации: для ответов на вопросы он не нужен"""
+        if self._embedding_cache is None and self._embedding_cache_args is not None:
+            self._embedding_cache = EmbeddingCache(*self._embedding_cache_args)
+        return self._embedding_cache
+
+    @embedding_cache.setter
+    def embedding_cache(self, cache):
+        self._embedding_cache = cache
+        self._embedding_cache_args = None
+
+    def _load_model(self):
+        if self.offline:
+            # huggingface_hub читает эти переменные один раз, при первом импорте
+            os.environ['HF_HUB_OFFLINE'] = '1'
+            os.environ['TRANSFORMERS_OFFLINE'] = '1'
+        start = time.perf_counter()
+        import torch
+        import sentence_transformers  # noqa: F401 - время импорта учитывается отдельно от загрузки
+        self.timings['импорт torch и sentence-transformers'] = time.perf_counter() - start
+
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+
+        print("🔧 Загрузка модели для эмбеддингов...")
+        start = time.perf_counter()
+        if self.offline:
+            model = self._load_model_offline(self.model_name)
+        else:
+            model = self._load_model_with_retry(self.model_name)
+        if self.quantized:
+            model = quantize_encoder(model)
+        self.timings['загрузка энкодера'] = time.perf_counter() - start
+        return model
+
+    def _load_model_offline(self, model_name):
+        """Загрузка энкодера только с диска (models_dir): без сети, повторов и ожиданий.
+        local_files_only действует, даже если transformers уже импортирован без офлайн-переменных"""
+        from sentence_transformers import SentenceTransformer
+
+        candidates = [model_name,
+                      os.path.join(self.models_dir, model_name),
+                      os.path.join(self.models_dir, model_name.split('/')[-1])]
+        for path in candidates:
+            if os.path.isdir(path):
+                model = SentenceTransformer(path, local_files_only=True)
+                print(f"✅ Модель загружена из {path}")
+                return model
+        try:
+            # Модель, скачанная ранее в models_dir как кэш Hugging Face
+            model = SentenceTransformer(model_name, cache_folder=self.models_dir, local_files_only=True)
+        except Exception as e:
+            raise RuntimeError(f"Модель {model_name} не найдена в {self.models_dir} (офлайн-режим): {e}") from e
+        print("✅ Модель успешно загружена")
+        return model
 
     def _load_model_with_retry(self, model_name, max_retries=3, retry_delay=10):
+        import requests
+        from urllib3.util.retry import Retry
+        from requests.adapters import HTTPAdapter
+        from sentence_transformers import SentenceTransformer
+
         for attempt in range(max_retries):
             try:
                 print(f"Попытка {attempt + 1}/{max_retries} загрузки модели...")
@@ -57,33 +214,309 @@ class RetrievalSystem:
                     raise e
         raise Exception("Не удалось загрузить модель")
 
-    def build_index(self, chunks, index_path):
+    def build_index(self, chunks, index_path, batch_size=256):
+        """Полное построение индекса. chunks может быть генератором: тексты и эмбеддинги
+        обрабатываются пачками по batch_size и сразу уходят в индекс и хранилище на диске"""
+        import faiss
+        from vector_index import create_index, train_index, min_train_vectors
+
         print("🔨 Создание эмбеддингов...")
-        texts = [chunk['text'] for chunk in chunks]
-        embeddings = self.model.encode(texts, show_progress_bar=True, batch_size=32)
+        # Старое хранилище отпускаем до перезаписи его файлов
+        self.metadata.close()
+        self.metadata = MetadataStore()
+        self.index = None
+        self.lexical = LexicalIndex() if self.hybrid else None
+        writer = MetadataWriter(index_path)
 
-        dimension = embeddings.shape[1]
-        self.index = faiss.IndexFlatIP(dimension)
-        faiss.normalize_L2(embeddings)
-        self.index.add(embeddings.astype(np.float32))
-        
-        self.chunks = chunks
-        self.metadata = chunks
-        
-        os.makedirs(index_path, exist_ok=True)
+        # IVF/PQ сначала копит выборку для обучения, flat и HNSW пишут пачки сразу
+        needs_training = self.index_type.startswith('ivf')
+        # Выборка не меньше, чем нужно для обучения (у IVF-PQ с 8 битами - 9984 вектора)
+        train_sample = max(self.index_params.get('train_sample', 50000),
+                           min_train_vectors(self.index_type, self.index_params))
+        pending, buffered = [], 0
+
+        def start_index():
+            vectors = np.concatenate([embeddings for _, embeddings in pending])
+            self.index = create_index(vectors.shape[1], self.index_type, self.index_params,
+                                      n_vectors=len(vectors))
+            train_index(self.index, vectors, train_sample)
+            for batch, embeddings in pending:
+                self._append_batch(batch, embeddings, writer)
+
+        seen = set()
+        if self.encode_workers > 1:
+            # Пачка делится между процессами, поэтому должна быть крупнее
+            batch_size *= self.encode_workers
+        with self.parallel_encoding():
+            for number, batch in enumerate(batched(self._unique_stream(chunks, seen), batch_size), start=1):
+                embeddings = normalize_rows(self._encode_texts([chunk['text'] for chunk in batch],
+                                                               show_progress_bar=False, save_cache=False))
+                if self.index is not None:
+                    self._append_batch(batch, embeddings, writer)
+                else:
+                    pending.append((batch, embeddings))
+                    buffered += len(batch)
+                    if not needs_training or buffered >= train_sample:
+                        start_index()
+                        pending = []
+                if number % 20 == 0:
+                    print(f"⏳ Обработано чанков: {len(seen)}")
+        if self.index is None and pending:
+            start_index()
+        if self.index is None:
+            raise ValueError("Нет чанков для индексации")
+
+        if self.embedding_cache is not None:
+            self.embedding_cache.save()
+        self.metadata = writer.finish()
         faiss.write_index(self.index, f"{index_path}/faiss.index")
-        with open(f"{index_path}/metadata.json", 'w', encoding='utf-8') as f:
-            json.dump(chunks, f, ensure_ascii=False, indent=2)
-        
-        print(f"✅ Индекс построен. Чанков: {len(chunks)}")
+        if self.lexical is not None:
+            self.lexical.save(index_path)
+        self.set_search_params(self.index_params.get('nprobe'), self.index_params.get('ef_search'))
+        self._rebuild_id_map()
+
+        print(f"✅ Индекс построен. Чанков: {len(self.metadata)}")
+        self._report_cache()
+
+    def _append_batch(self, chunks, embeddings, writer):
+        ids = np.array([faiss_id(chunk['id']) for chunk in chunks], dtype=np.int64)
+        self.index.add_with_ids(embeddings, ids)
+        if self.lexical is not None:
+            self.lexical.add(ids, [chunk['text'] for chunk in chunks])
+        writer.add(chunks)
+
+    def _unique_stream(self, chunks, seen):
+        """Чанки без повторов id. seen растёт вместе с корпусом, поэтому в нём 64-битные faiss-id
+        (int), а не строки id: это вдвое меньше памяти на чанк"""
+        for chunk in chunks:
+            chunk = dict(chunk)
+            chunk['id'] = chunk_id(chunk)
+            key = faiss_id(chunk['id'])
+            if key not in seen:
+                seen.add(key)
+                yield chunk
 
     def load_index(self, index_path):
+        start = time.perf_counter()
+        import faiss
+        self.timings['импорт faiss'] = time.perf_counter() - start
+
+        start = time.perf_counter()
         self.index = faiss.read_index(f"{index_path}/faiss.index")
-        with open(f"{index_path}/metadata.json", 'r', encoding='utf-8') as f:
-            self.metadata = json.load(f)
+        self.timings['чтение faiss-индекса'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if MetadataStore.exists(index_path):
+            self.metadata = MetadataStore.load(index_path)
+        else:
+            # Старый metadata.json конвертируется в бинарное хранилище один раз
+            with open(f"{index_path}/metadata.json", 'r', encoding='utf-8') as f:
+                chunks = json.load(f)
+            for chunk in chunks:
+                chunk['id'] = chunk_id(chunk)
+            self.metadata = MetadataStore.from_chunks(chunks)
+            del chunks
+            self.metadata.save(index_path)
+        self.timings['метаданные'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.lexical = None
+        if LexicalIndex.exists(index_path):
+            self.lexical = LexicalIndex.load(index_path)
+        elif self.hybrid:
+            print("🔨 Построение лексического индекса...")
+            self.lexical = LexicalIndex()
+            self.lexical.add(self.metadata.faiss_ids, (self.metadata.text(pos) for pos in range(len(self.metadata))))
+            self.lexical.save(index_path)
+        self.timings['лексический индекс'] = time.perf_counter() - start
+
+        # Индексы старого формата (IndexFlatIP без id) переводим на IndexIDMap2 и сохраняем один раз
+        if isinstance(self.index, faiss.IndexFlat):
+            print("🔧 Перевод индекса старого формата на IndexIDMap2...")
+            vectors = self.index.reconstruct_n(0, self.index.ntotal)
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.index.d))
+            self.index.add_with_ids(vectors, self.metadata.faiss_ids)
+            del vectors
+            faiss.write_index(self.index, f"{index_path}/faiss.index.tmp")
+            os.replace(f"{index_path}/faiss.index.tmp", f"{index_path}/faiss.index")
+
+        self.set_search_params(self.index_params.get('nprobe'), self.index_params.get('ef_search'))
+        self._rebuild_id_map()
         print(f"✅ Индекс загружен. Чанков: {len(self.metadata)}")
 
-    def search(self, query, top_k=None, similarity_threshold=None):
+    @property
+    def chunks(self):
+        return self.metadata
+
+    def clone(self, cls=None):
+        """Экземпляр с теми же настройками, энкодером и кэшем эмбеддингов, но без индекса.
+        В нём фоновое обновление собирает новый индекс, пока этот продолжает отвечать на запросы"""
+        other = (cls or type(self)).__new__(cls or type(self))
+        other.__dict__.update(self.__dict__)
+        if self._model is None:
+            other._model_source = self
+        other.timings = OrderedDict()
+        other.index = None
+        other.metadata = MetadataStore()
+        other.lexical = None
+        other._id_to_pos = {}
+        other._sorted_faiss_ids = np.empty(0, dtype=np.int64)
+        other._sorted_positions = np.empty(0, dtype=np.int64)
+        other._source_positions = None
+        other._query_embeddings = OrderedDict()
+        other._encoder = None
+        return other
+
+    def detach_files(self):
+        """Перенос отображённых в память файлов индекса в ОЗУ, чтобы их можно было перезаписать
+        (Windows не даёт заменить файл, открытый через mmap)"""
+        self.metadata.load_into_memory()
+        if self.lexical is not None:
+            self.lexical.load_into_memory()
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """Баланс точности и скорости: nprobe для IVF, efSearch для HNSW"""
+        import vector_index
+        vector_index.set_search_params(self.index, nprobe=nprobe, ef_search=ef_search)
+
+    def save_index(self, index_path):
+        import faiss
+
+        os.makedirs(index_path, exist_ok=True)
+        faiss.write_index(self.index, f"{index_path}/faiss.index")
+        self.metadata.save(index_path)
+        if self.lexical is not None:
+            self.lexical.save(index_path)
+
+    def update_index(self, index_path, add_chunks=(), remove_ids=()):
+        """Инкрементальное обновление индекса: удаление и добавление чанков по id"""
+        if self.index is None:
+            raise ValueError("Индекс не загружен")
+
+        remove_ids = {str(cid) for cid in remove_ids}
+        add_chunks = [chunk for chunk in self._unique_chunks(add_chunks)
+                      if chunk['id'] not in self._id_to_pos or chunk['id'] in remove_ids]
+
+        if remove_ids:
+            ids = np.array([faiss_id(cid) for cid in remove_ids], dtype=np.int64)
+            kept = self.metadata.select([pos for pos, cid in enumerate(self.metadata.ids)
+                                         if cid not in remove_ids])
+            try:
+                self.index.remove_ids(ids)
+            except RuntimeError:
+                # HNSW не поддерживает удаление - пересобираем граф из оставшихся векторов
+                from vector_index import create_index
+                kept_ids = kept.faiss_ids
+                vectors = np.array([self.index.reconstruct(int(i)) for i in kept_ids],
+                                   dtype=np.float32).reshape(-1, self.index.d)
+                index = create_index(self.index.d, 'hnsw', self.index_params)
+                index.add_with_ids(vectors, kept_ids)
+                self.index = index
+            if self.lexical is not None:
+                self.lexical.remove(ids)
+            self.metadata = kept
+            self._rebuild_id_map()
+
+        if add_chunks:
+            print(f"🔨 Создание эмбеддингов для {len(add_chunks)} новых чанков...")
+            texts = [chunk['text'] for chunk in add_chunks]
+            with self.parallel_encoding(len(texts)):
+                embeddings = self._encode_texts(texts)
+            self._add_chunks(add_chunks, embeddings)
+
+        self.save_index(index_path)
+        print(f"✅ Индекс обновлён: +{len(add_chunks)} / -{len(remove_ids)}. Чанков: {len(self.metadata)}")
+        self._report_cache()
+        return len(add_chunks), len(remove_ids)
+
+    def replace_document(self, source, chunks, index_path):
+        """Замена чанков одного документа: перекодируются только новые и изменённые"""
+        new_chunks = self._unique_chunks(chunks)
+        new_ids = {chunk['id']: chunk['text'] for chunk in new_chunks}
+        ids = self.metadata.ids
+        stale = [ids[pos] for pos in self.metadata.positions_for_source(source)
+                 if new_ids.get(ids[pos]) != self.metadata.text(pos)]
+        return self.update_index(index_path, add_chunks=new_chunks, remove_ids=stale)
+
+    def sync_chunks(self, chunks, index_path):
+        """Приведение индекса к актуальному набору чанков всей коллекции"""
+        new_chunks = self._unique_chunks(chunks)
+        new_ids = {chunk['id']: chunk['text'] for chunk in new_chunks}
+        stale = [cid for pos, cid in enumerate(self.metadata.ids)
+                 if cid not in new_ids or new_ids[cid] != self.metadata.text(pos)]
+        return self.update_index(index_path, add_chunks=new_chunks, remove_ids=stale)
+
+    def _encode_texts(self, texts, show_progress_bar=True, save_cache=True):
+        def encode(batch):
+            if self._encoder is not None:
+                return self._encoder.encode(batch)
+            return self.model.encode(batch, show_progress_bar=show_progress_bar, batch_size=32)
+
+        if self.embedding_cache is None:
+            return encode(texts)
+        embeddings = self.embedding_cache.encode(texts, encode)
+        if save_cache:
+            self.embedding_cache.save()
+        return embeddings
+
+    @contextmanager
+    def parallel_encoding(self, n_texts=None):
+        """Пул процессов-энкодеров на время индексации; для мелких обновлений
+        (меньше encode_parallel_min текстов) запуск пула дороже самого кодирования"""
+        if self._encoder is not None or self.encode_workers <= 1 or \
+                (n_texts is not None and n_texts < self.encode_parallel_min):
+            yield
+            return
+        from parallel_encoder import ParallelEncoder
+
+        print(f"⚙️ Запуск {self.encode_workers} процессов-энкодеров...")
+        self._encoder = ParallelEncoder.from_config(self.model_name, self.quantized, self.encode_workers)
+        try:
+            self._encoder.warm_up()
+            yield
+        finally:
+            self._encoder.close()
+            self._encoder = None
+
+    def _report_cache(self):
+        if self._embedding_cache is None:
+            return
+        stats = self._embedding_cache.stats()
+        print(f"💾 Кэш эмбеддингов: попаданий {stats['hits']}, промахов {stats['misses']}, "
+              f"записей {stats['entries']} ({stats['size_mb']} МБ)")
+
+    def _unique_chunks(self, chunks):
+        unique = {}
+        for chunk in chunks:
+            chunk = dict(chunk)
+            chunk['id'] = chunk_id(chunk)
+            unique.setdefault(chunk['id'], chunk)
+        return list(unique.values())
+
+    def _add_chunks(self, chunks, embeddings):
+        embeddings = normalize_rows(embeddings)
+        ids = np.array([faiss_id(chunk['id']) for chunk in chunks], dtype=np.int64)
+        self.index.add_with_ids(embeddings, ids)
+        if self.lexical is not None:
+            self.lexical.add(ids, [chunk['text'] for chunk in chunks])
+        self.metadata.extend(chunks)
+        self._rebuild_id_map()
+
+    def index_version(self):
+        """Меняется при каждой загрузке, сборке и обновлении индекса (и у клона после его обновления)"""
+        return self._index_version
+
+    def _rebuild_id_map(self):
+        self._index_version = next(_index_versions)
+        self._id_to_pos = {cid: pos for pos, cid in enumerate(self.metadata.ids)}
+        # Отсортированные faiss-id для векторного перевода результатов поиска в позиции метаданных
+        faiss_ids = self.metadata.faiss_ids
+        order = np.argsort(faiss_ids)
+        self._sorted_faiss_ids = faiss_ids[order]
+        self._sorted_positions = order
+        self._source_positions = None
+
+    def search(self, query, top_k=None, similarity_threshold=None, filters=None):
         if top_k is None:
             top_k = config.SYSTEM_CONFIG['retrieval']['top_k']          # 8
         if similarity_threshold is None:
@@ -91,43 +524,269 @@ class RetrievalSystem:
 
         print(f"🔍 Поиск: top_k={top_k}, threshold={similarity_threshold}")
 
+        results = self.search_batch([query], top_k, similarity_threshold, filters)[0]
+
+        print(f"✅ Найдено релевантных чанков: {len(results)}")
+        return results
+
+    def search_batch(self, queries, top_k=None, similarity_threshold=None, filters=None):
+        """Поиск по списку запросов: один проход энкодера и один вызов FAISS на всю пачку.
+        filters ограничивает выдачу: {'source': имя или путь файла (или список),
+        'file_type': '.pdf' (или список), 'page': номер или (с, по)}"""
+        if top_k is None:
+            top_k = config.SYSTEM_CONFIG['retrieval']['top_k']
+        if similarity_threshold is None:
+            similarity_threshold = config.SYSTEM_CONFIG['retrieval']['similarity_threshold']
+
         if self.index is None:
             raise ValueError("Индекс не загружен")
-        
-        query_embedding = self.model.encode([query])
-        faiss.normalize_L2(query_embedding)
+        queries = list(queries)
+        if not queries:
+            return []
 
+        results = [[] for _ in queries]
+        positions = self.filter_positions(filters)
+        if positions is not None and not len(positions):
+            return results
+        dense = list(range(len(queries)))
+        if self.lexical is not None:
+            # Запросы из одних обозначений документов отвечаются по инвертированному индексу без энкодера
+            for i, query in enumerate(queries):
+                if is_code_query(query):
+                    results[i] = self._code_search(query, top_k, positions)
+            dense = [i for i in dense if not results[i]]
+        if not dense:
+            return results
+
+        query_embeddings = self.encode_queries([queries[i] for i in dense])
+        dense_results = self._search_embeddings(query_embeddings, top_k, similarity_threshold,
+                                                [queries[i] for i in dense], positions)
+        for i, result in zip(dense, dense_results):
+            results[i] = result
+        return results
+
+    def _dense_candidates(self, query_embeddings, top_k, allowed=None):
+        """(search_k, косинусы, позиции) кандидатов плотного поиска; позиция -1 - пустой или устаревший id"""
         # Ищем в 3 раза больше кандидатов, чтобы после фильтра осталось достаточно
-        search_k = min(top_k * 3, len(self.metadata))
-        scores, indices = self.index.search(query_embedding.astype(np.float32), search_k)
+        search_k = min(top_k * 3, len(self.metadata) if allowed is None else len(allowed))
+        if search_k == 0:
+            return 0, None, None
+        if allowed is None:
+            scores, ids = self.index.search(query_embeddings, search_k)
+        else:
+            scores, ids = self._search_subset(query_embeddings, search_k, allowed)
+        return search_k, scores, self._positions(ids)
+
+    def _search_embeddings(self, query_embeddings, top_k, similarity_threshold, queries=None, allowed=None):
+        query_embeddings = normalize_rows(query_embeddings)
+        search_k, scores, positions = self._dense_candidates(query_embeddings, top_k, allowed)
+        if search_k == 0:
+            return [[] for _ in range(len(query_embeddings))]
+        known = positions >= 0
+
+        if self.lexical is not None and queries is not None:
+            return [self._hybrid_rank(query, embedding, row_scores[row_known], row_positions[row_known],
+                                      search_k, top_k, similarity_threshold, allowed)
+                    for query, embedding, row_scores, row_positions, row_known
+                    in zip(queries, query_embeddings, scores, positions, known)]
+
+        # Порог и top_k применяются ко всей матрице сразу; кандидаты уже упорядочены по убыванию
+        keep = known & (scores >= similarity_threshold)
+        keep &= np.cumsum(keep, axis=1) <= top_k
 
         results = []
-        for score, idx in zip(scores[0], indices[0]):
-            if idx >= len(self.metadata):
-                continue
-            if score >= similarity_threshold:
-                results.append({
-                    'text': self.metadata[idx]['text'],
-                    'source': self.metadata[idx]['source'],
-                    'page': self.metadata[idx].get('page', 1),
-                    'similarity': float(score)
-                })
-                if len(results) >= top_k:
-                    break
+        for row_scores, row_positions, row_keep in zip(scores, positions, keep):
+            # Текст материализуется только для вернувшихся чанков
+            results.append([dict(self.metadata[pos], similarity=float(score))
+                            for score, pos in zip(row_scores[row_keep], row_positions[row_keep])])
+        return results
 
-        print(f"✅ Найдено релевантных чанков: {len(results)}")
-        return results[:top_k]
+    def filter_positions(self, filters):
+        """Отсортированные позиции чанков, проходящих фильтры; None - фильтров нет"""
+        if not filters:
+            return None
+        unknown = set(filters) - {'source', 'file_type', 'page'}
+        if unknown:
+            raise ValueError(f"Неизвестные фильтры: {', '.join(sorted(unknown))}. Доступны: source, file_type, page")
+
+        if self._source_positions is None:
+            # Позиции каждого источника считаются один раз после загрузки или изменения индекса
+            sources = np.asarray(self.metadata.records['source'])
+            order = np.argsort(sources, kind='stable')
+            bounds = np.searchsorted(sources[order], np.arange(len(self.metadata.sources) + 1))
+            self._source_positions = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.metadata.sources))]
+
+        source_ids = range(len(self.metadata.sources))
+        if filters.get('source'):
+            wanted = filters['source']
+            wanted = {wanted} if isinstance(wanted, str) else set(wanted)
+            source_ids = [i for i in source_ids
+                          if self.metadata.sources[i] in wanted or os.path.basename(self.metadata.sources[i]) in wanted]
+        if filters.get('file_type'):
+            types = filters['file_type']
+            types = {types} if isinstance(types, str) else set(types)
+            types = {t.lower() if t.startswith('.') else f".{t.lower()}" for t in types}
+            source_ids = [i for i in source_ids if os.path.splitext(self.metadata.sources[i])[1].lower() in types]
+
+        positions = [self._source_positions[i] for i in source_ids]
+        positions = np.sort(np.concatenate(positions)) if positions else np.empty(0, dtype=np.int64)
+        if filters.get('page') is not None:
+            page = filters['page']
+            # numbers.Integral: номер страницы может прийти как np.int64 из метаданных
+            first, last = (page, page) if isinstance(page, numbers.Integral) else page
+            pages = np.asarray(self.metadata.records['page'])[positions]
+            positions = positions[(pages >= first) & (pages <= last)]
+        return positions
+
+    def _search_subset(self, query_embeddings, k, positions):
+        """Поиск только среди чанков из positions: малый набор - точным перебором,
+        большой - в FAISS с IDSelector, который пропускает остальные векторы"""
+        import faiss
+        from vector_index import search_parameters
+
+        ids = self.metadata.faiss_ids[positions]
+        if len(ids) <= self.filter_exact_max:
+            try:
+                vectors = self.index.reconstruct_batch(ids)
+            except RuntimeError:
+                vectors = None
+            if vectors is not None:
+                similarity = query_embeddings @ vectors.T
+                top = np.argsort(-similarity, axis=1, kind='stable')[:, :k]
+                return np.take_along_axis(similarity, top, axis=1), ids[top]
+        selector = faiss.IDSelectorBatch(ids)
+        return self.index.search(query_embeddings, k, params=search_parameters(self.index, selector))
+
+    def _positions(self, ids):
+        """faiss-id -> позиция в метаданных, -1 для пустых и устаревших id"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self._sorted_faiss_ids):
+            return np.full(ids.shape, -1, dtype=np.int64)
+        slots = np.searchsorted(self._sorted_faiss_ids, ids)
+        slots = np.minimum(slots, len(self._sorted_faiss_ids) - 1)
+        return np.where(self._sorted_faiss_ids[slots] == ids, self._sorted_positions[slots], -1)
+
+    def _hybrid_rank(self, query, query_embedding, dense_scores, dense_positions, search_k, top_k,
+                     similarity_threshold, allowed=None, rrf_k=60):
+        """Reciprocal rank fusion плотного и BM25 списков кандидатов"""
+        dense, lexical, similarity, code_positions = self._hybrid_candidates(
+            query, query_embedding, dense_scores, dense_positions, search_k, allowed)
+        ranked = rrf_fuse(dense, [pos for pos, _ in lexical], rrf_k=rrf_k)
+        # Чанки с точным обозначением из запроса проходят порог независимо от косинусной близости
+        ranked = [pos for pos in ranked if similarity[pos] >= similarity_threshold or pos in code_positions]
+        return [dict(self.metadata[pos], similarity=similarity[pos]) for pos in ranked[:top_k]]
+
+    def _hybrid_candidates(self, query, query_embedding, dense_scores, dense_positions, search_k, allowed=None,
+                           stats=None):
+        """Кандидаты для RRF: позиции плотного списка, (позиция, BM25) лексического по убыванию,
+        косинусы всех кандидатов и позиции чанков со всеми обозначениями запроса.
+        stats - BM25-статистика всех шардов (LexicalIndex.stats)"""
+        dense = [int(pos) for pos in dense_positions]
+        similarity = {pos: float(score) for pos, score in zip(dense, dense_scores)}
+        if self.lexical is None:
+            return dense, [], similarity, set()
+
+        if allowed is None:
+            lexical_scores, lexical_ids = self.lexical.search(query, search_k, stats)
+            lexical_positions = self._positions(lexical_ids)
+        else:
+            lexical_scores, lexical_ids = self.lexical.search(query, len(self.lexical), stats)
+            lexical_positions = self._positions(lexical_ids)
+            inside = np.isin(lexical_positions, allowed)
+            lexical_scores, lexical_positions = lexical_scores[inside][:search_k], lexical_positions[inside][:search_k]
+        known = lexical_positions >= 0
+        lexical = list(zip(lexical_positions[known].tolist(), lexical_scores[known].tolist()))
+        for pos, _ in lexical:
+            if pos not in similarity:
+                try:
+                    vector = self.index.reconstruct(int(self.metadata.records['faiss_id'][pos]))
+                    similarity[pos] = float(vector @ query_embedding)
+                except RuntimeError:
+                    similarity[pos] = 0.0
+
+        codes = query_codes(query)
+        code_positions = set(self._positions(self.lexical.docs_with_all(codes)).tolist()) if codes else set()
+        return dense, lexical, similarity, code_positions
+
+    def _shard_candidates(self, query_embeddings, top_k, queries, allowed=None, stats=None):
+        """_hybrid_candidates каждого запроса: шардированный индекс сливает их по всем шардам"""
+        query_embeddings = normalize_rows(query_embeddings)
+        search_k, scores, positions = self._dense_candidates(query_embeddings, top_k, allowed)
+        if search_k == 0:
+            return [([], [], {}, set()) for _ in queries]
+        known = positions >= 0
+        return [self._hybrid_candidates(query, embedding, row_scores[row_known], row_positions[row_known],
+                                        search_k, allowed, query_stats)
+                for query, embedding, row_scores, row_positions, row_known, query_stats
+                in zip(queries, query_embeddings, scores, positions, known, stats or itertools.repeat(None))]
+
+    def _code_search(self, query, top_k, allowed=None, stats=None):
+        codes = query_codes(query)
+        code_ids = self.lexical.docs_with_all(codes)
+        if allowed is not None:
+            code_ids = np.intersect1d(code_ids, self.metadata.faiss_ids[allowed])
+        if not len(code_ids):
+            return []
+        scores, ids = self.lexical.search(query, len(self.lexical), stats)
+        mask = np.isin(ids, code_ids)
+        scores, positions = scores[mask][:top_k], self._positions(ids[mask][:top_k])
+        # Сырой BM25 остаётся в чанке: по нему сливаются результаты шардов
+        return [dict(self.metadata[pos], similarity=float(score / scores[0]), bm25=float(score), match='lexical')
+                for score, pos in zip(scores, positions) if pos >= 0]
 
     def calculate_confidence(self, query, context_chunks):
         if not context_chunks:
             return 0.0
-        
-        avg_similarity = sum(chunk['similarity'] for chunk in context_chunks) / len(context_chunks)
-        
-        context_text = " ".join([chunk['text'] for chunk in context_chunks])
-        query_emb = self.model.encode([query])
-        context_emb = self.model.encode([context_text])
-        cross_sim = cosine_similarity(query_emb, context_emb)[0][0]
-        
+
+        avg_similarity = float(np.mean([chunk['similarity'] for chunk in context_chunks]))
+        if all(chunk.get('match') == 'lexical' for chunk in context_chunks):
+            # Точное совпадение обозначения: энкодер для оценки не запускается
+            return round(avg_similarity, 4)
+
+        # Без энкодера: вектор запроса из search, векторы чанков из индекса
+        query_emb = self._query_embedding(query)
+        centroid = self._chunk_embeddings(context_chunks).sum(axis=0)
+        norm = np.linalg.norm(centroid)
+        cross_sim = float(query_emb @ centroid / norm) if norm > 0 else 0.0
+
         confidence = (avg_similarity + cross_sim) / 2
-        return round(confidence, 4)
\ No newline at end of file
+        return round(confidence, 4)
+
+    def clear_query_cache(self):
+        """Забыть эмбеддинги недавних запросов: следующий поиск кодирует запрос заново (замеры скорости)"""
+        self._query_embeddings.clear()
+
+    def _remember_query(self, query, embedding, max_queries=64):
+        self._query_embeddings[query] = embedding
+        self._query_embeddings.move_to_end(query)
+        while len(self._query_embeddings) > max_queries:
+            self._query_embeddings.popitem(last=False)
+
+    def encode_queries(self, queries):
+        """Нормированные эмбеддинги запросов; недавние (кэш ответов, повтор поиска) не кодируются заново"""
+        embeddings = [self._query_embeddings.get(query) for query in queries]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            encoded = normalize_rows(self.model.encode([queries[i] for i in missing], batch_size=64))
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+        for query, embedding in zip(queries, embeddings):
+            self._remember_query(query, embedding)
+        return np.array(embeddings, dtype=np.float32)
+
+    def _query_embedding(self, query):
+        embedding = self._query_embeddings.get(query)
+        if embedding is None:
+            embedding = normalize_rows(self.model.encode([query]))[0]
+            self._remember_query(query, embedding)
+        return embedding
+
+    def _chunk_embeddings(self, chunks):
+        if all(chunk.get('id') in self._id_to_pos for chunk in chunks):
+            try:
+                return np.array([self.index.reconstruct(faiss_id(chunk['id'])) for chunk in chunks],
+                                dtype=np.float32)
+            except RuntimeError:
+                # Индекс без прямого отображения id -> вектор
+                pass
+        return normalize_rows(self.model.encode([chunk['text'] for chunk in chunks], batch_size=32))
@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import zlib
+import heapq
+import shutil
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import config
+import ingestion
+from metadata_store import faiss_id
+from lexical_index import is_code_query
+from retrieval_system import RetrievalSystem, normalize_rows, rrf_fuse
+
+SHARDS_FILE = "shards.json"
+SHARDS_DIR = "shards"
+DEFAULT_SHARD = "_root"
+
+
+def shard_config():
+    """Настройки шардирования из конфига; None - один общий индекс"""
+    return config.SYSTEM_CONFIG['retrieval'].get('shards')
+
+
+def shard_name(path, folder, by='collection', count=8):
+    """Шард документа: подпапка верхнего уровня (коллекция) или хэш пути по модулю count"""
+    rel = os.path.relpath(path, folder)
+    if by == 'collection':
+        parts = os.path.normpath(rel).split(os.sep)
+        # Файлы вне папки документов коллекции не образуют
+        return parts[0] if len(parts) > 1 and parts[0] != os.pardir else DEFAULT_SHARD
+    if by == 'hash':
+        return f"part{zlib.crc32(rel.replace(os.sep, '/').encode('utf-8')) % count:03d}"
+    raise ValueError(f"Неизвестный способ шардирования: {by}. Доступны: collection, hash")
+
+
+def group_documents(paths, folder, by='collection', count=8):
+    groups = OrderedDict()
+    for path in paths:
+        groups.setdefault(shard_name(path, folder, by, count), []).append(path)
+    return groups
+
+
+def documents_by_shard(folder):
+    settings = shard_config() or {}
+    return group_documents(ingestion.list_documents(folder), folder,
+                           settings.get('by', 'collection'), settings.get('count', 8))
+
+
+def create_retrieval_system(**kwargs):
+    """RetrievalSystem для RAG-системы: шардированный, если шарды включены в конфиге"""
+    return ShardedRetrievalSystem(**kwargs) if shard_config() else RetrievalSystem(**kwargs)
+
+
+def use_configured_retrieval(slot, index_path=None):
+    """RAG-система создаёт обычный RetrievalSystem сама; если в конфиге включены шарды,
+    он заменяется в slot (index_watcher.RetrievalSlot) на create_retrieval_system() с тем же энкодером"""
+    retrieval = slot.get()
+    if retrieval is None or not shard_config() or isinstance(retrieval, ShardedRetrievalSystem):
+        return retrieval
+    sharded = create_retrieval_system(model_name=retrieval.model_name, quantize=retrieval.quantized,
+                                      num_threads=retrieval.num_threads)
+    if retrieval._model is not None:
+        sharded._model = retrieval._model
+    else:
+        sharded._model_source = retrieval
+    sharded.load_index(index_path or config.SYSTEM_CONFIG['paths']['vector_db'])
+    slot.swap(sharded)
+    return sharded
+
+
+def shard_path(index_path, name):
+    return os.path.join(index_path, SHARDS_DIR, name)
+
+
+def load_shard_list(index_path):
+    with open(os.path.join(index_path, SHARDS_FILE), 'r', encoding='utf-8') as f:
+        return json.load(f)['shards']
+
+
+def save_shard_list(index_path, names):
+    os.makedirs(index_path, exist_ok=True)
+    path = os.path.join(index_path, SHARDS_FILE)
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump({'shards': sorted(names)}, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def remove_shard(index_path, name):
+    shutil.rmtree(shard_path(index_path, name), ignore_errors=True)
+
+
+class ShardedRetrievalSystem(RetrievalSystem):
+    """Индекс из независимых шардов: у каждого свои faiss-индекс, метаданные, BM25 и манифест.
+    Шарды строятся и загружаются по отдельности, поиск идёт по всем параллельно в пуле потоков.
+    Кандидаты шардов сливаются в общие списки, поэтому результат тот же, что у одного индекса."""
+
+    def __init__(self, *args, search_threads=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shards = OrderedDict()
+        self.search_threads = search_threads or (shard_config() or {}).get('search_threads') \
+            or min(8, os.cpu_count() or 1)
+        self._executor = None
+        self._unsharded = False     # загружен индекс без шардов: он и есть единственный шард
+
+    def clone(self, cls=None):
+        other = super().clone(cls)
+        if isinstance(other, ShardedRetrievalSystem):
+            # Шарды, которые обновление не затронет, переходят в новый экземпляр как есть
+            other.shards = OrderedDict(self.shards)
+        else:
+            for key in ('shards', 'search_threads', '_executor', '_unsharded'):
+                other.__dict__.pop(key, None)
+        return other
+
+    def new_shard(self):
+        return self.clone(RetrievalSystem)
+
+    def clear_query_cache(self):
+        super().clear_query_cache()
+        for shard in self.shards.values():
+            shard.clear_query_cache()
+
+    def load_index(self, index_path):
+        self._unsharded = not os.path.exists(os.path.join(index_path, SHARDS_FILE))
+        if self._unsharded:
+            # Индекс, построенный без шардирования, работает как единственный шард
+            paths = OrderedDict([(DEFAULT_SHARD, index_path)])
+        else:
+            paths = OrderedDict((name, shard_path(index_path, name)) for name in load_shard_list(index_path))
+
+        def load(item):
+            name, path = item
+            shard = self.new_shard()
+            start = time.perf_counter()
+            shard.load_index(path)
+            return name, shard, time.perf_counter() - start
+
+        self.shards = OrderedDict()
+        for name, shard, seconds in self._pool().map(load, paths.items()):
+            self.shards[name] = shard
+            self.timings[f"шард {name}"] = seconds
+        print(f"✅ Загружено шардов: {len(self.shards)}, чанков: {self.chunk_count()}")
+
+    def chunk_count(self):
+        return sum(len(shard.metadata) for shard in self.shards.values())
+
+    def index_version(self):
+        return tuple((name, shard.index_version()) for name, shard in self.shards.items())
+
+    def search_batch(self, queries, top_k=None, similarity_threshold=None, filters=None):
+        """Поиск по всем шардам: запросы кодируются один раз, шарды опрашиваются параллельно.
+        С filters опрашиваются только шарды, в которых есть подходящие чанки"""
+        if top_k is None:
+            top_k = config.SYSTEM_CONFIG['retrieval']['top_k']
+        if similarity_threshold is None:
+            similarity_threshold = config.SYSTEM_CONFIG['retrieval']['similarity_threshold']
+
+        if not self.shards:
+            raise ValueError("Индекс не загружен")
+        queries = list(queries)
+        if not queries:
+            return []
+
+        results = [[] for _ in queries]
+        allowed = {name: shard.filter_positions(filters) for name, shard in self.shards.items()}
+        shards = [name for name, positions in allowed.items() if positions is None or len(positions)]
+        if not shards:
+            return results
+        dense = list(range(len(queries)))
+        if self.hybrid:
+            stats = [self._lexical_stats(query) for query in queries]
+            code_queries = [i for i in dense if is_code_query(queries[i])]
+            if code_queries:
+                per_shard = self._fan_out(lambda name, shard: [shard._code_search(queries[i], top_k, allowed[name],
+                                                                                  stats[i])
+                                                               if shard.lexical is not None else []
+                                                               for i in code_queries], shards)
+                for row, i in enumerate(code_queries):
+                    results[i] = self._merge_lexical([shard_results[row] for shard_results in per_shard], top_k)
+                dense = [i for i in dense if not results[i]]
+        if not dense:
+            return results
+
+        dense_queries = [queries[i] for i in dense]
+        query_embeddings = self.encode_queries(dense_queries)
+        if self.hybrid:
+            dense_stats = [stats[i] for i in dense]
+            per_shard = list(self._pool().map(lambda name: self.shards[name]._shard_candidates(
+                query_embeddings, top_k, dense_queries, allowed[name], dense_stats), shards))
+            total = sum(len(self.shards[name].metadata) if allowed[name] is None else len(allowed[name])
+                        for name in shards)
+            for row, i in enumerate(dense):
+                results[i] = self._hybrid_merge([(name, shard_rows[row]) for name, shard_rows in zip(shards, per_shard)],
+                                                min(top_k * 3, total), top_k, similarity_threshold)
+            return results
+
+        per_shard = self._fan_out(lambda name, shard: shard._search_embeddings(
+            query_embeddings, top_k, similarity_threshold, None, allowed[name]), shards)
+        for row, i in enumerate(dense):
+            results[i] = self._merge([shard_results[row] for shard_results in per_shard], top_k)
+        return results
+
+    def _lexical_stats(self, query):
+        """BM25-статистика запроса по всем шардам: оценки шардов считаются как по одному индексу"""
+        n_docs, total_len, df = 0, 0.0, Counter()
+        for shard in self.shards.values():
+            if shard.lexical is not None:
+                shard_docs, shard_len, shard_df = shard.lexical.stats(query)
+                n_docs += shard_docs
+                total_len += shard_len
+                df.update(shard_df)
+        return (n_docs, total_len, dict(df)) if n_docs else None
+
+    def _hybrid_merge(self, candidates, search_k, top_k, similarity_threshold, rrf_k=60):
+        """RRF по всем шардам, как _hybrid_rank по одному индексу: плотные кандидаты шардов сливаются
+        в общий список по косинусу, BM25-кандидаты - по BM25 с общей статистикой, списки - через rrf_fuse"""
+        dense, lexical, similarity, code_keys = [], [], {}, set()
+        for name, (shard_dense, shard_lexical, shard_similarity, shard_codes) in candidates:
+            dense.extend(((name, pos), shard_similarity[pos]) for pos in shard_dense)
+            lexical.extend(((name, pos), score) for pos, score in shard_lexical)
+            similarity.update(((name, pos), value) for pos, value in shard_similarity.items())
+            code_keys.update((name, pos) for pos in shard_codes)
+        dense = [key for key, _ in heapq.nlargest(search_k, dense, key=lambda item: item[1])]
+        lexical = [key for key, _ in heapq.nlargest(search_k, lexical, key=lambda item: item[1])]
+
+        ranked = rrf_fuse(dense, lexical, rrf_k=rrf_k)
+        ranked = [key for key in ranked if similarity[key] >= similarity_threshold or key in code_keys]
+        return [dict(self.shards[name].metadata[pos], similarity=similarity[(name, pos)], shard=name)
+                for name, pos in ranked[:top_k]]
+
+    def _fan_out(self, fn, names=None):
+        """fn(имя, шард) для шардов names (по умолчанию всех) в пуле потоков;
+        у результатов проставляется имя шарда"""
+        def call(name):
+            rows = fn(name, self.shards[name])
+            for row in rows:
+                for chunk in row:
+                    chunk['shard'] = name
+            return rows
+        return list(self._pool().map(call, list(self.shards) if names is None else names))
+
+    @staticmethod
+    def _merge(rows, top_k):
+        return heapq.nlargest(top_k, (chunk for row in rows for chunk in row), key=lambda chunk: chunk['similarity'])
+
+    @staticmethod
+    def _merge_lexical(rows, top_k):
+        """Оценки _code_search нормированы по лучшему чанку своего шарда, поэтому сливаются
+        по сырому BM25 и нормируются заново по лучшему чанку всех шардов"""
+        merged = heapq.nlargest(top_k, (chunk for row in rows for chunk in row), key=lambda chunk: chunk['bm25'])
+        for chunk in merged:
+            chunk['similarity'] = chunk['bm25'] / merged[0]['bm25']
+        return merged
+
+    def _chunk_embeddings(self, chunks):
+        vectors = []
+        for chunk in chunks:
+            shard = self.shards.get(chunk.get('shard'))
+            if shard is None or chunk.get('id') not in shard._id_to_pos:
+                break
+            try:
+                vectors.append(shard.index.reconstruct(faiss_id(chunk['id'])))
+            except RuntimeError:
+                break
+        else:
+            return np.array(vectors, dtype=np.float32)
+        return normalize_rows(self.model.encode([chunk['text'] for chunk in chunks], batch_size=32))
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.search_threads,
+                                                thread_name_prefix="shard-search")
+        return self._executor
+
+    # rebuild_index.rebuild_sharded ведёт манифест у каждого шарда; методы ниже раскладывают
+    # чанки по шардам по пути документа (shard_name) и делегируют шардам
+    def build_index(self, chunks, index_path, batch_size=256):
+        """Полное построение: чанки группируются по шардам, каждый шард строится в своей папке"""
+        self._unsharded = False
+        groups = OrderedDict()
+        for chunk in chunks:
+            groups.setdefault(self._route(chunk['source']), []).append(chunk)
+        if not groups:
+            raise ValueError("Нет чанков для индексации")
+
+        shards = OrderedDict()
+        for name, group in groups.items():
+            print(f"\n🧩 Шард {name}: чанков {len(group)}")
+            shard = self.new_shard()
+            shard.build_index(group, shard_path(index_path, name), batch_size)
+            shards[name] = shard
+        if os.path.exists(os.path.join(index_path, SHARDS_FILE)):
+            for name in set(load_shard_list(index_path)) - set(shards):
+                remove_shard(index_path, name)
+        self.shards = shards
+        save_shard_list(index_path, shards)
+
+    def update_index(self, index_path, add_chunks=(), remove_ids=()):
+        if not self.shards:
+            raise ValueError("Индекс не загружен")
+        add_groups = OrderedDict()
+        for chunk in add_chunks:
+            add_groups.setdefault(self._route(chunk['source']), []).append(chunk)
+        remove_groups = OrderedDict()
+        for cid in remove_ids:
+            name = next((name for name, shard in self.shards.items() if str(cid) in shard._id_to_pos), None)
+            if name is not None:
+                remove_groups.setdefault(name, []).append(cid)
+
+        added = removed = 0
+        for name in list(add_groups) + [name for name in remove_groups if name not in add_groups]:
+            result = self._update_shard(index_path, name, add_groups.get(name, []), remove_groups.get(name, []))
+            added += result[0]
+            removed += result[1]
+        if not self._unsharded:
+            save_shard_list(index_path, self.shards)
+        return added, removed
+
+    def replace_document(self, source, chunks, index_path):
+        name = self._route(source)
+        if name not in self.shards:
+            return self.update_index(index_path, add_chunks=chunks)
+        return self.shards[name].replace_document(source, chunks, self._shard_dir(index_path, name))
+
+    def sync_chunks(self, chunks, index_path):
+        if not self.shards:
+            raise ValueError("Индекс не загружен")
+        groups = OrderedDict((name, []) for name in self.shards)
+        for chunk in chunks:
+            groups.setdefault(self._route(chunk['source']), []).append(chunk)
+
+        added = removed = 0
+        for name, group in groups.items():
+            if name not in self.shards:
+                result = self._update_shard(index_path, name, group, [])
+            elif not group and not self._unsharded:
+                # Документов коллекции не осталось - шард удаляется целиком
+                removed += len(self.shards.pop(name).metadata)
+                remove_shard(index_path, name)
+                continue
+            else:
+                result = self.shards[name].sync_chunks(group, self._shard_dir(index_path, name))
+            added += result[0]
+            removed += result[1]
+        if not self._unsharded:
+            save_shard_list(index_path, self.shards)
+        return added, removed
+
+    def _route(self, source):
+        if self._unsharded:
+            return DEFAULT_SHARD
+        settings = shard_config() or {}
+        folder = config.SYSTEM_CONFIG['paths'].get('documents', './data/documents')
+        return shard_name(source, folder, settings.get('by', 'collection'), settings.get('count', 8))
+
+    def _shard_dir(self, index_path, name):
+        return index_path if self._unsharded else shard_path(index_path, name)
+
+    def _update_shard(self, index_path, name, add_chunks, remove_ids):
+        shard = self.shards.get(name)
+        if shard is not None:
+            return shard.update_index(self._shard_dir(index_path, name), add_chunks, remove_ids)
+        shard = self.new_shard()
+        shard.build_index(add_chunks, self._shard_dir(index_path, name))
+        self.shards[name] = shard
+        return len(shard.metadata), 0
+
+    def save_index(self, index_path):
+        for name, shard in self.shards.items():
+            shard.save_index(shard_path(index_path, name))
+        save_shard_list(index_path, self.shards)
@@ -0,0 +1,77 @@
+import argparse
+import time
+import numpy as np
+import config
+import ingestion
+from retrieval_system import RetrievalSystem
+
+
+def load_pages(max_files=None, workers=None):
+    folder = config.SYSTEM_CONFIG['paths'].get('documents', './data/documents')
+    paths = ingestion.list_documents(folder)[:max_files]
+    pages = []
+    for _, file_pages, error in ingestion.iter_loaded(paths, workers):
+        if not error:
+            pages.extend(file_pages)
+    return pages
+
+
+def token_stats(tokenizer, texts, window):
+    """Сколько токенов чанков энкодер реально видит и сколько отрезается за пределами окна"""
+    lengths = np.array([len(ids) + 2 for ids in tokenizer(texts, add_special_tokens=False,
+                                                          verbose=False)['input_ids']])
+    truncated = np.maximum(lengths - window, 0)
+    return {
+        'chunks': len(texts),
+        'mean_tokens': float(lengths.mean()) if len(lengths) else 0.0,
+        'truncated_chunks': int((truncated > 0).sum()),
+        'truncated_share': float(truncated.sum() / lengths.sum()) if len(lengths) else 0.0,
+    }
+
+
+def run(split, pages, repeats=3):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        texts = split(pages)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return texts, best
+
+
+def compare_splitters(max_files=None, overlap_tokens=24, workers=None):
+    """DocumentProcessor._split_text против нарезки по токенам: скорость и доля отрезанных энкодером токенов"""
+    print("🔄 Загрузка документов...")
+    pages = load_pages(max_files, workers)
+    total_chars = sum(len(page['text']) for page in pages)
+    print(f"📄 Страниц: {len(pages)}, символов: {total_chars}")
+
+    model = RetrievalSystem().model
+    window = model.max_seq_length
+    splitter = ingestion.TokenSplitter.from_encoder(model, overlap_tokens)
+
+    # Тот же экземпляр DocumentProcessor, которым режутся документы при сборке индекса
+    processor = ingestion.char_splitter(800, 150)
+    variants = {
+        'символы 800/150': lambda ps: [text for page in ps for text in processor._split_text(page['text'])],
+        f'токены {splitter.max_tokens}/{overlap_tokens}': lambda ps: [
+            text for texts in splitter.split_many([page['text'] for page in ps]) for text in texts],
+    }
+
+    print(f"\n📊 Окно энкодера: {window} токенов")
+    print(f"{'сплиттер':<20}{'МБ/с':>8}{'чанков':>9}{'токенов':>9}{'обрезано':>10}{'потери':>9}")
+    for name, split in variants.items():
+        texts, elapsed = run(split, pages)
+        stats = token_stats(model.tokenizer, texts, window)
+        speed = total_chars / 1024 / 1024 / elapsed if elapsed else float('inf')
+        print(f"{name:<20}{speed:>8.2f}{stats['chunks']:>9}{stats['mean_tokens']:>9.1f}"
+              f"{stats['truncated_chunks']:>10}{stats['truncated_share']:>9.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сравнение сплиттеров на папке документов")
+    parser.add_argument("--files", type=int, default=None, help="ограничить число файлов")
+    parser.add_argument("--overlap", type=int, default=24, help="перекрытие в токенах")
+    parser.add_argument("--workers", type=int, default=None, help="процессов для разбора файлов")
+    args = parser.parse_args()
+    compare_splitters(args.files, args.overlap, args.workers)
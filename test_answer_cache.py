@@ -0,0 +1,50 @@
+from answer_cache import AnswerCache, history_fingerprint
+from test_sharded_index import make_retrieval, make_chunks
+
+SOURCES = [{'id': 'a', 'text': "Насосы и арматура", 'source': "docs/a.txt", 'page': 1}]
+
+
+def built_retrieval(tmp_path):
+    retrieval = make_retrieval()
+    retrieval.build_index(make_chunks(), str(tmp_path))
+    return retrieval
+
+
+def ask(cache, retrieval, question, context=None):
+    entry, embedding, version = cache.lookup(retrieval, question, context)
+    if entry is None:
+        cache.store(question, embedding, version, f"ответ на «{question}»", SOURCES, 0.7, 1.5, context)
+        return None
+    return entry['answer']
+
+
+def test_same_and_similar_questions_hit(tmp_path):
+    retrieval = built_retrieval(tmp_path)
+    cache = AnswerCache(threshold=0.9)
+    assert ask(cache, retrieval, "Какие требования НП-089-15 к арматуре") is None
+    assert ask(cache, retrieval, "какие требования нп-089-15 к арматуре?") == \
+        "ответ на «Какие требования НП-089-15 к арматуре»"
+    assert ask(cache, retrieval, "К арматуре какие требования НП-089-15") is not None
+    # Другое обозначение документа - другой ответ, даже при близком эмбеддинге
+    assert ask(cache, retrieval, "Какие требования НП-089-16 к арматуре") is None
+    assert cache.stats()['hits'] == 2
+
+
+def test_follow_up_is_cached_per_conversation(tmp_path):
+    retrieval = built_retrieval(tmp_path)
+    cache = AnswerCache()
+    first = history_fingerprint([("user", "Что такое НП-089-15?"), ("ai", "Правила для трубопроводов")])
+    second = history_fingerprint([("user", "Что такое РБ-089-14?"), ("ai", "Руководство по безопасности")])
+    assert history_fingerprint([]) is None
+    assert ask(cache, retrieval, "А что в пункте 3?", first) is None
+    assert ask(cache, retrieval, "А что в пункте 3?", second) is None
+    assert ask(cache, retrieval, "А что в пункте 3?") is None
+    assert ask(cache, retrieval, "А что в пункте 3?", first) is not None
+
+
+def test_index_update_clears_cache(tmp_path):
+    retrieval = built_retrieval(tmp_path)
+    cache = AnswerCache()
+    ask(cache, retrieval, "Контроль изоляции кабелей")
+    retrieval.load_index(str(tmp_path))
+    assert ask(cache, retrieval, "Контроль изоляции кабелей") is None
@@ -0,0 +1,61 @@
+from transformers import PreTrainedTokenizerFast
+from tokenizers import Tokenizer, models, pre_tokenizers
+from context_builder import ContextBuilder, merge_adjacent, overlap_length
+from answer_generator import AnswerGenerator
+
+
+def word_tokenizer():
+    """Каждое слово - один токен: бюджет в токенах легко посчитать в уме"""
+    backend = Tokenizer(models.WordLevel({"<unk>": 0}, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    return PreTrainedTokenizerFast(tokenizer_object=backend, unk_token="<unk>")
+
+
+def chunk(text, similarity, source="docs/НП-089-15.pdf", page=1):
+    return {'id': text[:16], 'text': text, 'source': source, 'page': page, 'similarity': similarity}
+
+
+FIRST = "Сварные соединения трубопроводов подлежат контролю. Контроль выполняется после термообработки."
+SECOND = "Контроль выполняется после термообработки. Результаты контроля заносятся в журнал."
+
+
+def test_overlap_length():
+    assert overlap_length(FIRST, SECOND) == len("Контроль выполняется после термообработки.")
+    assert overlap_length(SECOND, FIRST) == 0
+
+
+def test_adjacent_chunks_are_merged_without_overlap():
+    blocks, removed = merge_adjacent([chunk(FIRST, 0.9), chunk(SECOND, 0.8)])
+    assert len(blocks) == 1
+    assert blocks[0]['text'].count("Контроль выполняется после термообработки.") == 1
+    assert removed == len("Контроль выполняется после термообработки.")
+    assert blocks[0]['similarity'] == 0.9
+
+    # С другой страницы чанки не склеиваются, даже если текст совпадает
+    blocks, removed = merge_adjacent([chunk(FIRST, 0.9), chunk(SECOND, 0.8, page=2)])
+    assert len(blocks) == 2 and removed == 0
+
+
+def test_context_fits_token_budget():
+    tokenizer = word_tokenizer()
+    chunks = [chunk(f"Раздел {i}. " + "слово " * 30 + "Конец раздела.", 0.5 + i / 100, source=f"docs/{i}.pdf")
+              for i in range(10)]
+    builder = ContextBuilder(tokenizer, max_tokens=120, min_tail_tokens=10)
+    context, used = builder.build(chunks)
+
+    assert len(tokenizer(context, add_special_tokens=False)['input_ids']) <= 120
+    # Блоки берутся по убыванию сходства
+    assert context.startswith("[9.pdf, стр. 1]")
+    assert used[0]['source'] == "docs/9.pdf"
+    assert builder.last['dropped'] > 0
+    assert builder.last['saved_tokens'] > 0
+
+
+def test_generator_prompt_uses_builder():
+    tokenizer = word_tokenizer()
+    generator = AnswerGenerator(None, tokenizer, system_prompt="Система.",
+                                context_builder=ContextBuilder(tokenizer, max_tokens=200))
+    prompt = generator.build_prompt("Как контролируются соединения?", [chunk(FIRST, 0.9), chunk(SECOND, 0.8)])
+    assert prompt.startswith("Система.")
+    assert prompt.count("Контроль выполняется после термообработки.") == 1
+    assert "Результаты контроля заносятся в журнал." in prompt
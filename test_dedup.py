@@ -0,0 +1,40 @@
+from dedup import NearDuplicateFilter
+from metadata_store import chunk_id
+
+BASE = ("Сварные соединения трубопроводов атомных станций подлежат контролю визуальным "
+        "и измерительным методом после термической обработки в объёме требований НП-089-15")
+
+
+def chunk(text, source, page=1):
+    item = {'text': text, 'source': source, 'page': page}
+    item['id'] = chunk_id(item)
+    return item
+
+
+def test_near_duplicates_are_referenced():
+    dedup = NearDuplicateFilter(threshold=0.8)
+    original = chunk(BASE, "a.pdf")
+    copy = chunk(BASE + " раздел", "b.pdf", 4)
+    other = chunk("Кабели и электрооборудование проверяются ежегодно", "c.pdf")
+    kept = list(dedup.filter([original, copy, other]))
+    assert kept == [original, other]
+    assert dedup.references == {original['id']: [{'id': copy['id'], 'source': "b.pdf", 'page': 4}]}
+    assert (dedup.seen, dedup.dropped) == (3, 1)
+
+
+def test_signatures_round_trip(tmp_path):
+    original = chunk(BASE, "a.pdf")
+    dedup = NearDuplicateFilter(threshold=0.8)
+    list(dedup.filter([original]))
+    dedup.save(str(tmp_path))
+
+    # Следующее обновление видит представителей, уже лежащих в индексе
+    loaded = NearDuplicateFilter(threshold=0.8)
+    loaded.load(str(tmp_path))
+    assert loaded.ids == [original['id']]
+    assert list(loaded.filter([chunk(BASE + " раздел", "b.pdf")])) == []
+
+    # Удаляемый представитель не мешает новому чанку попасть в индекс
+    dropped = NearDuplicateFilter(threshold=0.8)
+    dropped.load(str(tmp_path), drop_ids=[original['id']])
+    assert len(list(dropped.filter([chunk(BASE + " раздел", "b.pdf")]))) == 1
@@ -0,0 +1,45 @@
+import numpy as np
+from embedding_cache import EmbeddingCache
+
+
+class CountingEncoder:
+    def __init__(self, dim=8):
+        self.dim = dim
+        self.encoded = []
+
+    def __call__(self, texts):
+        self.encoded.extend(texts)
+        return np.array([[len(text) + i for i in range(self.dim)] for text in texts], dtype=np.float32)
+
+
+def test_vectors_survive_reopen(tmp_path):
+    encoder = CountingEncoder()
+    cache = EmbeddingCache(str(tmp_path), "org/model")
+    first = cache.encode(["а", "бб", "ввв"], encoder)
+    assert encoder.encoded == ["а", "бб", "ввв"]
+    cache.save()
+
+    encoder.encoded.clear()
+    reopened = EmbeddingCache(str(tmp_path), "org/model")
+    again = reopened.encode(["ввв", "а", "гггг"], encoder)
+    assert encoder.encoded == ["гггг"]
+    assert np.array_equal(again[:2], first[[2, 0]])
+    assert reopened.stats()['hits'] == 2 and reopened.stats()['misses'] == 1
+
+    # У другой модели свой кэш
+    assert EmbeddingCache(str(tmp_path), "org/other").stats()['entries'] == 0
+
+
+def test_lru_eviction_keeps_size_bound(tmp_path):
+    encoder = CountingEncoder(dim=256)   # 1 КБ на вектор
+    cache = EmbeddingCache(str(tmp_path), "model", max_size_mb=4 / 1024)
+    cache.encode(["1", "2", "3", "4"], encoder)
+    cache.encode(["1"], encoder)          # свежее обращение: вытесняется не он
+    cache.encode(["5"], encoder)
+    assert cache.stats()['entries'] == 4
+    assert cache.capacity <= 4
+
+    encoder.encoded.clear()
+    reopened = EmbeddingCache(str(tmp_path), "model", max_size_mb=4 / 1024)
+    reopened.encode(["1", "2", "5"], encoder)
+    assert encoder.encoded == ["2"]
@@ -0,0 +1,51 @@
+import os
+import numpy as np
+from lexical_index import LexicalIndex
+
+TEXTS = [
+    "Сварные соединения трубопроводов подлежат контролю по НП-089-15",
+    "Контроль сварных соединений выполняется после термообработки",
+    "Требования РБ-089-14 к оборудованию атомных станций",
+    "Трубопроводы и оборудование атомных станций",
+    "Результаты контроля заносятся в журнал",
+]
+
+
+def build(spill_postings, batch=2):
+    index = LexicalIndex(spill_postings=spill_postings)
+    for start in range(0, 40, batch):
+        ids = list(range(start, start + batch))
+        index.add(ids, [TEXTS[i % len(TEXTS)] + f" раздел{i}" for i in ids])
+    return index
+
+
+def assert_same(index, expected):
+    for query in ("сварные соединения", "НП-089-15", "атомных станций раздел7", "журнал"):
+        scores, ids = index.search(query, 10)
+        want_scores, want_ids = expected.search(query, 10)
+        assert np.array_equal(ids, want_ids)
+        assert np.allclose(scores, want_scores)
+
+
+def test_spilled_build_matches_in_memory(tmp_path):
+    expected = build(spill_postings=10 ** 9)
+    spilled = build(spill_postings=7)
+    assert spilled._runs
+    spilled.save(str(tmp_path))
+    assert spilled._spill_dir is None
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+    assert_same(spilled, expected)
+    assert_same(LexicalIndex.load(str(tmp_path)), expected)
+
+
+def test_spill_after_merge_and_remove(tmp_path):
+    expected = build(spill_postings=10 ** 9)
+    index = build(spill_postings=7, batch=1)
+    index.search("контроль", 3)     # слияние во временную папку до сохранения
+    index.add([100], ["Новый документ про контроль сварки"])
+    expected.add([100], ["Новый документ про контроль сварки"])
+    index.remove([3, 100])
+    expected.remove([3, 100])
+    index.save(str(tmp_path))
+    assert_same(LexicalIndex.load(str(tmp_path)), expected)
+    assert len(index) == len(expected) == 39
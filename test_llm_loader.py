@@ -0,0 +1,23 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from llm_loader import dynamic_linear_layers, load_quantized, quantize_linear_layers, save_quantized
+
+
+def toy_model():
+    return torch.nn.Sequential(torch.nn.Linear(16, 32), torch.nn.ReLU(), torch.nn.Linear(32, 4))
+
+
+def test_quantized_state_dict_round_trip(tmp_path):
+    torch.manual_seed(0)
+    model = quantize_linear_layers(toy_model()).eval()
+    path = str(tmp_path / "toy-int8.pt")
+    save_quantized(model, path)
+
+    # Скелет со случайными весами: после загрузки результат должен совпасть с сохранённой моделью
+    loaded = load_quantized(dynamic_linear_layers(toy_model()), path)
+    inputs = torch.randn(3, 16)
+    with torch.no_grad():
+        assert torch.equal(loaded(inputs), model(inputs))
+    assert not any(type(module) is torch.nn.Linear for module in loaded.modules())
@@ -0,0 +1,148 @@
+import numpy as np
+from llm_streaming import AnswerStream, generate_stream, stream_question
+from answer_generator import AnswerGenerator
+from retrieval_system import RetrievalSystem
+
+
+class StubEncoding(dict):
+    def to(self, device):
+        return self
+
+
+class StubTokenizer:
+    """Токен - слово; decode склеивает слова через пробел"""
+    eos_token_id = 0
+
+    def __init__(self):
+        self.vocab = ['</s>']
+
+    def __call__(self, text, return_tensors=None, **kwargs):
+        if isinstance(text, list):
+            return {'input_ids': [self(item)['input_ids'][0].tolist() for item in text]}
+        ids = []
+        for word in text.split():
+            if word not in self.vocab:
+                self.vocab.append(word)
+            ids.append(self.vocab.index(word))
+        return StubEncoding(input_ids=np.array([ids]))
+
+    def decode(self, ids, skip_special_tokens=False, **kwargs):
+        return " ".join(self.vocab[i] for i in ids if i or not skip_special_tokens)
+
+
+class StubModel:
+    """generate отдаёт стримеру промпт, затем заранее заданный ответ по одному токену"""
+    device = 'cpu'
+
+    def __init__(self, tokenizer, answer):
+        self.answer = tokenizer(answer)['input_ids'][0]
+        self.calls = []
+
+    def generate(self, input_ids, streamer=None, **kwargs):
+        self.calls.append(kwargs)
+        streamer.put(input_ids)
+        for token in self.answer:
+            streamer.put(np.array([token]))
+        streamer.end()
+
+
+class StubRetrieval(RetrievalSystem):
+    def __init__(self, chunks):
+        self.chunks_found = chunks
+
+    def search(self, query, top_k=None, similarity_threshold=None, filters=None):
+        return self.chunks_found
+
+    def calculate_confidence(self, query, context_chunks):
+        return 0.75 if context_chunks else 0.0
+
+
+class StubRAG:
+    def __init__(self, retrieval):
+        self.retrieval = retrieval
+
+    def process_question(self, question):
+        raise AssertionError("при потоковой генерации process_question не вызывается")
+
+
+CHUNK = {'id': 'a', 'text': 'Сварные соединения контролируются.', 'source': 'docs/НП-089-15.pdf', 'page': 3,
+         'similarity': 0.8}
+
+
+def test_generate_stream_yields_deltas():
+    tokenizer = StubTokenizer()
+    model = StubModel(tokenizer, "Контроль сварных соединений обязателен")
+    deltas = list(generate_stream(model, tokenizer, "Вопрос о сварке"))
+    assert len(deltas) > 1
+    assert "".join(deltas) == "Контроль сварных соединений обязателен"
+
+
+def test_stream_question_through_generator():
+    tokenizer = StubTokenizer()
+    model = StubModel(tokenizer, "Контроль сварных соединений обязателен")
+    generator = AnswerGenerator(model, tokenizer, max_new_tokens=16)
+    rag = StubRAG(StubRetrieval([CHUNK]))
+    stream = stream_question(rag, "Как контролируются сварные соединения?", generator=generator,
+                             retrieval=rag.retrieval)
+    assert stream.sources == [CHUNK]
+    assert stream.confidence == 0.75
+
+    deltas = list(stream)
+    assert len(deltas) > 1
+    assert stream.text == "Контроль сварных соединений обязателен"
+    assert stream.first_token_s is not None and stream.total_s >= stream.first_token_s
+    assert model.calls[0]['max_new_tokens'] == 16
+
+
+def test_no_chunks_skips_generation():
+    tokenizer = StubTokenizer()
+    model = StubModel(tokenizer, "не должно прозвучать")
+    stream = stream_question(StubRAG(StubRetrieval([])), "Вопрос", generator=AnswerGenerator(model, tokenizer),
+                             retrieval=StubRetrieval([]))
+    list(stream)
+    assert not model.calls
+    assert stream.sources == [] and stream.text
+
+
+class StubLLM:
+    """LocalLLM RAG-системы: модель, токенизатор и свой формат промпта"""
+    system_prompt = "Система."
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prompts = []
+
+    def format_prompt(self, question, chunks):
+        self.prompts.append((question, chunks))
+        return f"{self.system_prompt} {chunks[0]['text']} {question}"
+
+
+def test_streaming_is_opt_in_and_reuses_rag_llm(monkeypatch):
+    import config
+
+    tokenizer = StubTokenizer()
+    rag = StubRAG(StubRetrieval([CHUNK]))
+    rag.llm = StubLLM(StubModel(tokenizer, "Ответ по документу"), tokenizer)
+    monkeypatch.setattr(config, 'SYSTEM_CONFIG', {'llm': {}})
+    assert AnswerGenerator.from_config(rag) is None
+
+    monkeypatch.setattr(config, 'SYSTEM_CONFIG', {'llm': {'streaming': True, 'prefix_cache': False}})
+    generator = AnswerGenerator.from_config(rag)
+    assert generator.model is rag.llm.model and generator.tokenizer is tokenizer
+    stream = stream_question(rag, "Как контролируются сварные соединения?", generator=generator,
+                             retrieval=rag.retrieval)
+    assert "".join(stream) == "Ответ по документу"
+    assert rag.llm.prompts[0][0] == "Как контролируются сварные соединения?"
+
+
+def test_rag_stream_api_takes_precedence():
+    class StreamingRAG(StubRAG):
+        def process_question_stream(self, question):
+            return AnswerStream(iter(["из ", "RAG"]), [CHUNK], 0.5)
+
+    tokenizer = StubTokenizer()
+    model = StubModel(tokenizer, "не должно прозвучать")
+    stream = stream_question(StreamingRAG(StubRetrieval([CHUNK])), "Вопрос", generator=AnswerGenerator(model, tokenizer))
+    assert "".join(stream) == "из RAG"
+    assert not model.calls
@@ -0,0 +1,55 @@
+import os
+import manifest
+from manifest import DocumentManifest, file_hash
+
+
+def write(path, text):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def test_scan_after_save_load(tmp_path):
+    docs = tmp_path / "docs"
+    docs.mkdir()
+    paths = [str(docs / name) for name in ("a.txt", "b.txt", "c.txt")]
+    for path in paths:
+        write(path, f"текст {os.path.basename(path)}")
+
+    first = DocumentManifest(settings={'chunker': 2})
+    assert first.scan(paths)['added'] == paths
+    for i, path in enumerate(paths):
+        first.record(path, [f"id{i}"])
+    first.save(str(tmp_path))
+
+    write(paths[0], "новый текст a.txt")
+    os.utime(paths[1], ns=(0, 0))    # тот же текст с другим mtime
+    os.remove(paths[2])
+    write(str(docs / "d.txt"), "текст d.txt")
+
+    loaded = DocumentManifest.load(str(tmp_path))
+    assert loaded.settings == {'chunker': 2}
+    changes = loaded.scan(paths[:2] + [str(docs / "d.txt")])
+    assert changes['changed'] == [paths[0]]
+    assert changes['unchanged'] == [paths[1]]
+    assert changes['added'] == [str(docs / "d.txt")]
+    assert changes['removed'] == [os.path.normpath(paths[2])]
+    assert loaded.chunk_ids(changes['changed'] + changes['removed']) == ["id0", "id2"]
+
+    # Повторный скан сохранённого манифеста: изменений нет, mtime b.txt уже запомнен
+    loaded.record(paths[0], ["id0b"])
+    loaded.record(str(docs / "d.txt"), ["id3"])
+    loaded.forget(paths[2])
+    loaded.save(str(tmp_path))
+    again = DocumentManifest.load(str(tmp_path)).scan(paths[:2] + [str(docs / "d.txt")])
+    assert not (again['added'] or again['changed'] or again['removed'])
+
+
+def test_record_reuses_known_digest(tmp_path, monkeypatch):
+    path = str(tmp_path / "a.txt")
+    write(path, "текст")
+    digest = file_hash(path)
+    files = DocumentManifest()
+    files.digests[os.path.normpath(path)] = digest
+    monkeypatch.setattr(manifest, 'file_hash', lambda path: (_ for _ in ()).throw(AssertionError(path)))
+    files.record(path, ["id"])
+    assert files.files[os.path.normpath(path)]['sha1'] == digest
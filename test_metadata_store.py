@@ -0,0 +1,49 @@
+import numpy as np
+from metadata_store import MetadataStore, MetadataWriter, chunk_id
+
+
+def make_chunks(source, texts, first_page=1):
+    chunks = []
+    for page, text in enumerate(texts, start=first_page):
+        chunk = {'text': text, 'source': source, 'page': page}
+        chunk['id'] = chunk_id(chunk)
+        chunks.append(chunk)
+    return chunks
+
+
+def plain(chunks):
+    return [{key: chunk[key] for key in ('id', 'text', 'source', 'page')} for chunk in chunks]
+
+
+def test_save_load_select_round_trip(tmp_path):
+    first = make_chunks("docs/НП-089-15.pdf", ["Сварные соединения", "Контроль швов"])
+    second = make_chunks("docs/РБ-089-14.txt", ["Требования к оборудованию"])
+    store = MetadataStore.from_chunks(first)
+    store.references = {first[0]['id']: [{'id': 'dup', 'source': "docs/копия.pdf", 'page': 2}]}
+    store.save(str(tmp_path))
+    # Тексты, добавленные после загрузки, лежат после блоба и переживают повторное сохранение
+    store.extend(second)
+    store.save(str(tmp_path))
+
+    loaded = MetadataStore.load(str(tmp_path))
+    assert plain(loaded) == first + second
+    assert loaded[0]['also_in'] == [{'id': 'dup', 'source': "docs/копия.pdf", 'page': 2}]
+    assert np.array_equal(loaded.faiss_ids, store.faiss_ids)
+    assert list(loaded.positions_for_source("docs/РБ-089-14.txt")) == [2]
+
+    selected = loaded.select([2, 0])
+    assert plain(selected) == [second[0], first[0]]
+    loaded.close()
+
+
+def test_streamed_writer_matches_store(tmp_path):
+    chunks = make_chunks("a.txt", ["один", "два"]) + make_chunks("б.txt", ["три"])
+    writer = MetadataWriter(str(tmp_path / "streamed"))
+    writer.add(chunks[:2])
+    writer.add(chunks[2:])
+    assert len(writer) == 3
+    streamed = writer.finish()
+
+    store = MetadataStore.from_chunks(chunks)
+    store.save(str(tmp_path / "saved"))
+    assert plain(streamed) == plain(MetadataStore.load(str(tmp_path / "saved"))) == chunks
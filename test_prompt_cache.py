@@ -0,0 +1,58 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+from prompt_cache import PromptCache
+from answer_generator import AnswerGenerator
+from test_llm_streaming import StubRetrieval, CHUNK
+
+SYSTEM = "Ты помощник по нормативным документам. Отвечай только по фрагментам."
+
+
+def tiny_llm():
+    """Маленькая случайная Llama и словарный токенизатор: без скачивания весов"""
+    words = sorted(set((SYSTEM + " Фрагменты документов: Вопрос: Ответ: " + CHUNK['text'] +
+                        " НП-089-15.pdf стр. 3 Как контролируются сварные соединения? А трубопроводы?")
+                       .replace(",", " , ").replace("[", " [ ").replace("]", " ] ").split()))
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    for word in words:
+        vocab.setdefault(word, len(vocab))
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    backend.decoder = decoders.WordPiece()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, unk_token="<unk>", bos_token="<s>",
+                                        eos_token="</s>")
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(LlamaConfig(vocab_size=len(vocab), hidden_size=32, intermediate_size=64,
+                                         num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4,
+                                         max_position_embeddings=512)).eval()
+    return model, tokenizer
+
+
+def test_system_prompt_prefill_is_skipped():
+    model, tokenizer = tiny_llm()
+    cache = PromptCache(model, tokenizer, SYSTEM)
+    system_tokens = len(cache.system_entry[0])
+
+    # Сколько токенов промпта модель прогоняет в первом (prefill) вызове каждого generate
+    prefill = []
+    model.register_forward_pre_hook(lambda module, args, kwargs: prefill.append(kwargs['input_ids'].shape[1]),
+                                    with_kwargs=True)
+    generator = AnswerGenerator(model, tokenizer, system_prompt=SYSTEM, max_new_tokens=3, prompt_cache=cache)
+    retrieval = StubRetrieval([CHUNK])
+
+    for question in ("Как контролируются сварные соединения?", "А трубопроводы?"):
+        prefill.clear()
+        list(generator.stream(retrieval, question))
+        reused, total = cache.last
+        assert reused >= system_tokens
+        assert prefill[0] == total - reused
+
+    # Второй вопрос берёт из кэша прошлого запроса больше, чем один системный промпт
+    assert cache.last[0] > system_tokens
+    generator.reset_conversation()
+    prefill.clear()
+    list(generator.stream(retrieval, "А трубопроводы?"))
+    assert cache.last[0] == system_tokens
@@ -0,0 +1,93 @@
+import os
+import zlib
+import numpy as np
+import pytest
+import config
+import rebuild_index
+from metadata_store import chunk_id
+from retrieval_system import RetrievalSystem
+from sharded_index import ShardedRetrievalSystem, load_shard_list
+
+DOCS = "docs"
+
+
+class StubEncoder:
+    """Мешок слов, разложенный по 64 измерениям: похожие тексты дают близкие векторы.
+    Небольшой шум, свой у каждого текста, исключает равные оценки"""
+    max_seq_length = 128
+
+    def encode(self, texts, **kwargs):
+        vectors = np.zeros((len(texts), 64), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                vectors[row, zlib.crc32(word.encode('utf-8')) % 64] += 1.0
+            vectors[row] += np.random.RandomState(zlib.crc32(text.encode('utf-8'))).rand(64) * 0.05
+        return vectors
+
+
+def make_retrieval(cls=RetrievalSystem):
+    retrieval = cls()
+    retrieval._model = StubEncoder()
+    retrieval.embedding_cache = None
+    retrieval.index_type, retrieval.index_params = 'flat', {}
+    retrieval.hybrid = True
+    retrieval.encode_workers = 1
+    return retrieval
+
+
+def make_chunks():
+    texts = {
+        'colA/насосы.txt': ["Насосы и арматура трубопроводов по НП-089-15",
+                            "Арматура проверяется гидравлическими испытаниями",
+                            "Сварные соединения насосов контролируются"],
+        'colA/клапаны.txt': ["Клапаны предохранительные для систем давления",
+                             "Требования НП-089-15 к клапанам и арматуре"],
+        'colB/кабели.txt': ["Кабели и электрооборудование в помещениях",
+                            "Контроль изоляции кабелей выполняется ежегодно",
+                            "Сварные соединения кабельных конструкций и опор"],
+        'общие.txt': ["Общие положения для всех коллекций документов",
+                      "Трубопроводы и насосы атомных станций"],
+    }
+    chunks = []
+    for name, pages in texts.items():
+        for page, text in enumerate(pages, start=1):
+            chunk = {'text': text, 'source': os.path.join(DOCS, name), 'page': page}
+            chunk['id'] = chunk_id(chunk)
+            chunks.append(chunk)
+    return chunks
+
+
+@pytest.fixture
+def sharded_config(monkeypatch):
+    monkeypatch.setitem(config.SYSTEM_CONFIG['retrieval'], 'shards', {'by': 'collection'})
+    monkeypatch.setitem(config.SYSTEM_CONFIG['paths'], 'documents', DOCS)
+
+
+QUERIES = ["сварные соединения", "арматура трубопроводов", "кабели изоляции", "НП-089-15", "насосы НП-089-15"]
+
+
+def ranking(rows):
+    return [[(chunk['id'], round(chunk['similarity'], 5)) for chunk in row] for row in rows]
+
+
+def test_sharded_search_matches_single_index(tmp_path, sharded_config):
+    single = make_retrieval()
+    single.build_index(make_chunks(), str(tmp_path / "single"))
+    sharded = make_retrieval(ShardedRetrievalSystem)
+    sharded.build_index(make_chunks(), str(tmp_path / "sharded"))
+    assert sorted(load_shard_list(str(tmp_path / "sharded"))) == ['_root', 'colA', 'colB']
+
+    loaded = make_retrieval(ShardedRetrievalSystem)
+    loaded.load_index(str(tmp_path / "sharded"))
+    for top_k in (2, 4):
+        expected = ranking(single.search_batch(QUERIES, top_k, 0.0))
+        assert ranking(sharded.search_batch(QUERIES, top_k, 0.0)) == expected
+        assert ranking(loaded.search_batch(QUERIES, top_k, 0.0)) == expected
+    filters = {'file_type': 'txt', 'page': (1, 2)}
+    assert ranking(loaded.search_batch(QUERIES, 3, 0.0, filters)) == \
+        ranking(single.search_batch(QUERIES, 3, 0.0, filters))
+
+
+def test_rebuild_changed_rejects_sharded_index(tmp_path, sharded_config):
+    with pytest.raises(ValueError, match="rebuild_sharded"):
+        rebuild_index.rebuild_changed(str(tmp_path), retrieval=make_retrieval(ShardedRetrievalSystem))
@@ -0,0 +1,203 @@
+import argparse
+import time
+import numpy as np
+import faiss
+
+INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+
+# Меньше этого числа векторов кластеризация IVF не обучается осмысленно
+MIN_TRAIN_VECTORS = 1000
+# k-means в faiss нужно не меньше 39 точек на центроид, иначе центроиды выходят случайными
+MIN_POINTS_PER_CENTROID = 39
+
+
+def min_train_vectors(index_type, params=None):
+    """Сколько векторов нужно для обучения index_type: 39 на каждый список IVF (если nlist задан явно),
+    а для PQ ещё и 39 на каждый из 2^pq_nbits центроидов подпространства (9984 при 8 битах)"""
+    params = params or {}
+    if not index_type.startswith('ivf'):
+        return 0
+    needed = max(MIN_TRAIN_VECTORS, MIN_POINTS_PER_CENTROID * params.get('nlist', 0))
+    if index_type == 'ivf_pq':
+        needed = max(needed, MIN_POINTS_PER_CENTROID * 2 ** params.get('pq_nbits', 8))
+    return needed
+
+
+def create_index(dimension, index_type='flat', params=None, n_vectors=None):
+    """Создание индекса по конфигу; все типы поддерживают add_with_ids"""
+    params = params or {}
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Неизвестный тип индекса: {index_type}. Доступны: {', '.join(INDEX_TYPES)}")
+
+    needed = min_train_vectors(index_type, params)
+    if n_vectors is not None and n_vectors < needed:
+        print(f"⚠️ Слишком мало векторов для {index_type} ({n_vectors}, нужно {needed}), используется flat")
+        index_type = 'flat'
+
+    if index_type == 'flat':
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, params.get('hnsw_m', 32), faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params.get('ef_construction', 80)
+        index.hnsw.efSearch = params.get('ef_search', 64)
+        return faiss.IndexIDMap2(index)
+
+    nlist = params.get('nlist')
+    if nlist is None:
+        nlist = int(4 * np.sqrt(n_vectors or MIN_TRAIN_VECTORS))
+    if n_vectors is not None:
+        nlist = max(1, min(nlist, n_vectors // MIN_POINTS_PER_CENTROID))
+
+    quantizer = faiss.IndexFlatIP(dimension)
+    if index_type == 'ivf_flat':
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+    else:
+        pq_m = params.get('pq_m', 16)
+        if dimension % pq_m:
+            raise ValueError(f"pq_m={pq_m} должно делить размерность эмбеддингов {dimension}")
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, params.get('pq_nbits', 8),
+                                 faiss.METRIC_INNER_PRODUCT)
+    index.nprobe = params.get('nprobe', 16)
+    # Прямое отображение id -> вектор нужно для reconstruct по id чанка
+    index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index
+
+
+def train_index(index, embeddings, sample_size=50000, seed=0):
+    """Обучение IVF/PQ на случайной выборке нормированных эмбеддингов"""
+    if index.is_trained:
+        return
+    if len(embeddings) > sample_size:
+        rng = np.random.default_rng(seed)
+        embeddings = embeddings[rng.choice(len(embeddings), sample_size, replace=False)]
+    print(f"🎓 Обучение индекса на {len(embeddings)} векторах...")
+    index.train(np.ascontiguousarray(embeddings, dtype=np.float32))
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """Параметры точности/скорости поиска, задаваемые на этапе запроса"""
+    if nprobe is not None:
+        try:
+            faiss.extract_index_ivf(index).nprobe = nprobe
+        except RuntimeError:
+            pass
+    if ef_search is not None:
+        inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+        if isinstance(inner, faiss.IndexHNSW):
+            inner.hnsw.efSearch = ef_search
+
+
+def search_parameters(index, selector):
+    """Параметры одного запроса с IDSelector; nprobe/efSearch берутся текущие, чтобы фильтр не менял точность"""
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=inner.nprobe)
+    return faiss.SearchParameters(sel=selector)
+
+
+def index_type_of(index):
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(inner, faiss.IndexIVF):
+        return 'ivf_flat'
+    return 'flat'
+
+
+def all_vectors(index):
+    """Все векторы индекса в порядке добавления (для IVF-PQ - приближённые)"""
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexIVF):
+        vectors = [inner.reconstruct(int(i)) for i in _ivf_ids(inner)]
+        return np.array(vectors, dtype=np.float32).reshape(-1, inner.d)
+    return inner.reconstruct_n(0, inner.ntotal)
+
+
+def _ivf_ids(index):
+    invlists = index.invlists
+    for list_no in range(index.nlist):
+        size = invlists.list_size(list_no)
+        if size:
+            ids = faiss.rev_swig_ptr(invlists.get_ids(list_no), size)
+            yield from ids.copy()
+
+
+def index_memory(index):
+    return len(faiss.serialize_index(index))
+
+
+def compare_index_types(vectors, queries, k=8, params=None, index_types=INDEX_TYPES):
+    """Отчёт recall@k относительно flat, задержки p50/p99 и объёма памяти по типам индексов"""
+    params = params or {}
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    faiss.normalize_L2(queries)
+    ids = np.arange(len(vectors), dtype=np.int64)
+
+    exact = None
+    report = []
+    for index_type in ('flat',) + tuple(t for t in index_types if t != 'flat'):
+        start = time.perf_counter()
+        index = create_index(vectors.shape[1], index_type, params, n_vectors=len(vectors))
+        train_index(index, vectors, max(params.get('train_sample', 50000), min_train_vectors(index_type, params)))
+        index.add_with_ids(vectors, ids)
+        build_time = time.perf_counter() - start
+
+        latencies = []
+        found = []
+        for query in queries:
+            start = time.perf_counter()
+            _, result = index.search(query.reshape(1, -1), k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append(result[0])
+        found = np.array(found)
+        if exact is None:
+            exact = found
+
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, exact)])
+        report.append({
+            'index_type': index_type_of(index),
+            'recall_at_k': round(float(recall), 4),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+            'memory_mb': round(index_memory(index) / 1024 / 1024, 2),
+            'build_s': round(build_time, 2),
+        })
+    return report
+
+
+def print_report(report, k):
+    print(f"\n📊 Сравнение индексов (recall@{k} относительно flat)")
+    print(f"{'тип':<10}{'recall':>8}{'p50, мс':>10}{'p99, мс':>10}{'память, МБ':>12}{'сборка, с':>11}")
+    for row in report:
+        print(f"{row['index_type']:<10}{row['recall_at_k']:>8.3f}{row['p50_ms']:>10.3f}"
+              f"{row['p99_ms']:>10.3f}{row['memory_mb']:>12.2f}{row['build_s']:>11.2f}")
+
+
+if __name__ == "__main__":
+    import config
+    from retrieval_system import RetrievalSystem
+
+    parser = argparse.ArgumentParser(description="Сравнение типов векторных индексов на текущем корпусе")
+    parser.add_argument("--k", type=int, default=config.SYSTEM_CONFIG['retrieval']['top_k'])
+    parser.add_argument("--queries", type=int, default=200, help="число запросов из корпуса")
+    args = parser.parse_args()
+
+    retrieval = RetrievalSystem()
+    retrieval.load_index(config.SYSTEM_CONFIG['paths']['vector_db'])
+
+    # Запросы - начала случайных чанков, чтобы не совпадать с векторами корпуса дословно
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(retrieval.metadata), min(args.queries, len(retrieval.metadata)), replace=False)
+    query_texts = [retrieval.metadata[i]['text'][:200] for i in sample]
+    queries = retrieval.model.encode(query_texts, batch_size=32)
+
+    report = compare_index_types(all_vectors(retrieval.index), queries, k=args.k,
+                                 params=config.SYSTEM_CONFIG['retrieval'].get('index_params', {}))
+    print_report(report, args.k)